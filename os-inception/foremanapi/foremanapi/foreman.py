@@ -1,19 +1,41 @@
 import requests
+import errno
 import json
 import logging
+import socket
+import time
 import urllib
+from foremanapi import limiter, metrics
+
+# Responses worth retrying, the server being temporarily unavailable or rate limiting us
+RETRY_STATUSES = [429, 502, 503, 504]
+# Responses worth retrying a write on, where the server turned it away before acting on it. A 502 or 504 can
+# come from a gateway giving up on a write Foreman went on to make, and retrying that makes it twice.
+WRITE_RETRY_STATUSES = [429, 503]
+# Socket errors meaning a request never reached the server
+UNSENT_ERRNOS = [errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH]
+# Seconds to wait before a retry, multiplied by the number of retries so far
+RETRY_DELAY = 1
 
 class ForemanAPI:
     """
     Class for interacting with Foreman's API
     """
 
-    def __init__(self, server, auth_user, auth_passwd, version='v2', use_ssl=True):
+    def __init__(self, server, auth_user, auth_passwd, version='v2', use_ssl=True, metrics=None, retries=0,
+                 retry_delay=None, limits=None):
         """
         Initialize the class
         :param server: foreman API host
         :param version: API version
         :param use_ssl: use SSL for API calls
+        :param metrics: metrics sink, or list of sinks, to record every request to (see foremanapi.metrics)
+        :param retries: number of times to retry a request that failed to connect or got a 429/502/503/504.
+                        Writes are only retried if they never reached the server, or got a 429/503.
+        :param retry_delay: seconds to wait before a retry, multiplied by the number of retries so far. A
+                            Retry-After header asking for longer is honoured. Defaults to RETRY_DELAY.
+        :param limits: limiter.ServerLimits adapting how many requests are made at a time, to share with other
+                       ForemanAPIs talking to the server. Otherwise the ForemanAPI keeps its own.
         :return:
         """
         if use_ssl:
@@ -22,11 +44,110 @@ class ForemanAPI:
             self.api_url = "http://" + server + "/api/" + version + "/"
         self.auth_user = auth_user
         self.auth_passwd = auth_passwd
+        if metrics is None:
+            metrics = []
+        self.metrics = metrics if isinstance(metrics, list) else [metrics]
+        self.retries = retries
+        self.retry_delay = RETRY_DELAY if retry_delay is None else retry_delay
+        self.limits = limits or limiter.ServerLimits()
 
         # Disable the spammy insecure-request warning
         requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
 
+    def _request(self, method, url_extension, payload=None, parameters=None, headers=None):
+        """
+        Perform a Foreman API request, recording it to the metrics sinks
+        :param method: HTTP method
+        :param url_extension: call to make on the foreman web service
+        :param payload: payload to send, JSON-encoded
+        :param parameters: query parameters
+        :param headers: request headers
+        :return: decoded JSON response
+        """
+        url = self.api_url + url_extension
+        if parameters is not None:
+            url += "?" + urllib.urlencode(parameters)
+        data = json.dumps(payload) if payload is not None else None
+
+        limit = self.limits.for_method(method)
+        endpoint = metrics.endpoint_template(url_extension)
+        retry_statuses = RETRY_STATUSES if method == 'GET' else WRITE_RETRY_STATUSES
+        retries = 0
+        started = time.time()
+        while True:
+            request_started = limit.acquire()
+            try:
+                response = requests.request(method, url, data=data, headers=headers, verify=False,
+                                            auth=(self.auth_user, self.auth_passwd))
+            except requests.exceptions.ConnectionError as error:
+                limit.release(request_started, None, endpoint)
+                if retries < self.retries and (method == 'GET' or self._unsent(error)):
+                    retries += 1
+                    time.sleep(self.retry_delay * retries)
+                    continue
+                self._record(method, url_extension, None, started, 0, retries, limit)
+                raise
+            except Exception:
+                limit.release(request_started, None, endpoint)
+                raise
+            limit.release(request_started, response.status_code, endpoint)
+            if response.status_code in retry_statuses and retries < self.retries:
+                retries += 1
+                time.sleep(max(self.retry_delay * retries, self._retry_after(response)))
+                continue
+            break
+
+        self._record(method, url_extension, response.status_code, started, len(response.content), retries, limit)
+        if response.status_code >= 400:
+            logging.getLogger().debug("HTTP Request status code error: {0} {1}: {2}".format(
+                method, url_extension, response.status_code))
+        return response.json()
+
+
+    def _unsent(self, error):
+        """
+        Whether a request that failed to connect never reached the server, so even a write is safe to retry.
+        A connection dropped once the request was sent may have been dropped after Foreman acted on it.
+        """
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        cause = error.args[0] if error.args else None
+        # urllib3 wraps the socket error, in a MaxRetryError's reason or the args of a ProtocolError
+        cause = getattr(cause, 'reason', cause)
+        unsent_types = (socket.gaierror, getattr(requests.packages.urllib3.exceptions, 'NewConnectionError', socket.gaierror))
+        for reason in (cause,) + tuple(getattr(cause, 'args', ())):
+            if isinstance(reason, unsent_types):
+                return True
+            if isinstance(reason, socket.error) and reason.errno in UNSENT_ERRNOS:
+                return True
+        return False
+
+
+    def _retry_after(self, response):
+        """
+        Seconds a response asks us to wait before retrying
+        """
+        try:
+            return float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            return 0
+
+
+    def _record(self, method, url_extension, status, started, size, retries, limit):
+        if not self.metrics:
+            return
+        request = {'endpoint': metrics.endpoint_template(url_extension),
+                   'method': method,
+                   'status': status,
+                   'latency': time.time() - started,
+                   'size': size,
+                   'retries': retries,
+                   'concurrency_limit': round(limit.limit, 2)}
+        for sink in self.metrics:
+            sink.record(request)
+
+
     def _foreman_api_get(self, url_extension, parameters={}):
         """
         Perform a Foreman API GET
@@ -35,21 +156,11 @@ class ForemanAPI:
         """
 
         # add on additional mandatory parameters
-        parameters['per_page'] = '10000'
-        param_str = urllib.urlencode(parameters)
-
-        # build our calling URL
-        url = self.api_url + url_extension + "?" + param_str
+        parameters = dict(parameters, per_page='10000')
 
-        logging.getLogger().debug("Making API call to URL: %s" % url)
+        logging.getLogger().debug("Making API call to URL: %s" % (self.api_url + url_extension))
         headers = {'accept': 'version=2,application/json'}
-        response = requests.get(url, headers=headers, verify=False, auth=(self.auth_user, self.auth_passwd))
-        try:
-            response.raise_for_status
-        except requests.exceptions.HTTPError as e:
-            logging.getLogger().error("HTTP Request status code error: ", e.message)
-        result = response.json()
-        return result
+        return self._request('GET', url_extension, parameters=parameters, headers=headers)
 
 
     def _foreman_api_post(self, url_extension, payload, parameters={}):
@@ -61,21 +172,11 @@ class ForemanAPI:
         """
 
         # add on additional mandatory parameters
-        parameters['per_page'] = '10000'
-        param_str = urllib.urlencode(parameters)
-
-        # build our calling URL
-        url = self.api_url + url_extension + "?" + param_str
+        parameters = dict(parameters, per_page='10000')
         headers = {'Content-Type': 'application/json'}
 
-        logging.getLogger().debug("Submitting POST to {0}: {1}".format(url,json.dumps(payload)))
-        response = requests.post(url, data=json.dumps(payload), headers=headers, verify=False, auth=(self.auth_user, self.auth_passwd))
-        try:
-            response.raise_for_status
-        except requests.exceptions.HTTPError as e:
-            logging.getLogger().error("HTTP Request status code error: ", e.message)
-        result = response.json()
-        return result
+        logging.getLogger().debug("Submitting POST to {0}: {1}".format(url_extension,json.dumps(payload)))
+        return self._request('POST', url_extension, payload=payload, parameters=parameters, headers=headers)
 
 
     def _foreman_api_put(self, url_extension, payload):
@@ -85,17 +186,10 @@ class ForemanAPI:
         :param payload: payload to POST to service
         :return:
         """
-        url = self.api_url + url_extension
         headers = {'Content-Type': 'application/json'}
 
-        logging.getLogger().debug("Submitting PUT to {0}: {1}".format(url,json.dumps(payload)))
-        response = requests.put(url, data=json.dumps(payload), headers=headers, verify=False, auth=(self.auth_user, self.auth_passwd))
-        try:
-            response.raise_for_status
-        except requests.exceptions.HTTPError as e:
-            logging.getLogger().error("HTTP Request status code error: ", e.message)
-        result = response.json()
-        return result
+        logging.getLogger().debug("Submitting PUT to {0}: {1}".format(url_extension,json.dumps(payload)))
+        return self._request('PUT', url_extension, payload=payload, headers=headers)
 
 
     def _foreman_api_delete(self, url_extension, payload):
@@ -105,11 +199,8 @@ class ForemanAPI:
         :param payload:
         :return:
         """
-        url = self.api_url + url_extension
         headers = {'accept': 'version=2,application/json'}
-        response = requests.delete(url, data=json.dumps(payload), headers=headers, verify=False, auth=(self.auth_user, self.auth_passwd))
-        result = response.json()
-        return result
+        return self._request('DELETE', url_extension, payload=payload, headers=headers)
 
 
     def get_hosts_for_environment(self,environment_id):
@@ -0,0 +1,200 @@
+"""
+Adaptive limits on how many requests are made to a Foreman server at a time.
+
+Each limit is found AIMD-style, the way TCP finds its congestion window. Every request that completes
+without signs of overload, having seen the limit reached while it was in flight, adds 1/limit to it, so it
+grows by about one each round of requests, up to a ceiling. A 429 or 503 response, a connection error, or a
+request taking much longer than the quickest recent ones to the same endpoint, halves it. Requests already in flight when it was
+halved don't halve it again, so a burst of overload only counts once. Reads and writes load Foreman
+differently, so each has its own limit.
+"""
+import threading
+import time
+
+# Responses meaning the server is overloaded
+OVERLOAD_STATUSES = [429, 503]
+
+# Highest limits, for requests that only read and for those that change something
+DEFAULT_READ_CEILING = 8
+DEFAULT_WRITE_CEILING = 4
+# Limits start here, and never drop below MIN_LIMIT
+INITIAL_LIMIT = 2
+MIN_LIMIT = 1
+# Fraction of the limit kept when overloaded
+BACKOFF = 0.5
+# A request taking this many times as long as the quickest recent ones to its endpoint, plus the slack, counts
+# as overload.
+# The slack keeps jitter on very quick requests from being taken for overload.
+LATENCY_TOLERANCE = 2.0
+LATENCY_SLACK = 0.05
+# Fraction of the way the baseline latency moves towards each slower request, so it follows a server that
+# has become slower for good rather than counting every request as overload from then on
+BASELINE_DRIFT = 0.05
+
+
+class AdaptiveLimiter:
+    """
+    Limits how many requests are in flight at a time, adapting the limit to how the server copes
+    """
+
+    def __init__(self, name, ceiling, initial=INITIAL_LIMIT, minimum=MIN_LIMIT, tolerance=LATENCY_TOLERANCE,
+                 slack=LATENCY_SLACK):
+        """
+        :param name: Name of the limit, for its stats
+        :param ceiling: Highest the limit may grow to
+        :param initial: Limit to start at
+        :param minimum: Lowest the limit may drop to
+        :param tolerance: Multiple of its endpoint's baseline latency beyond which a request counts as overload
+        :param slack: Seconds added to the tolerated latency
+        :return:
+        """
+        self.name = name
+        self.ceiling = ceiling
+        self.minimum = min(minimum, ceiling)
+        self.limit = float(max(self.minimum, min(initial, ceiling)))
+        self.tolerance = tolerance
+        self.slack = slack
+        # baseline latency of each endpoint, as some are always much slower than others
+        self.baselines = {}
+        self.in_flight = 0
+        self.peak = 0
+        self.completed = 0
+        self.decreases = 0
+        self.overloads = {}
+        self.queued = 0.0
+        self._decreased = 0
+        self._reached = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until another request may be made
+        :return: Time the request started, to pass to release
+        """
+        waiting = time.time()
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            started = time.time()
+            if self.in_flight >= int(self.limit):
+                self._reached = started
+            self.queued += started - waiting
+        return started
+
+    def release(self, started, status, endpoint=None):
+        """
+        Note a request completed, adapting the limit to how it went
+        :param started: Time the request started, as returned by acquire
+        :param status: HTTP status of the response, or None if the request couldn't connect
+        :param endpoint: Endpoint requested, whose requests' latencies it's compared with
+        :return: Seconds the request took
+        """
+        latency = time.time() - started
+        with self._condition:
+            # whether the limit was reached while the request was in flight
+            full = self._reached >= started
+            self.in_flight -= 1
+            self.completed += 1
+
+            overload = None
+            if status is None:
+                overload = 'connection'
+            elif status in OVERLOAD_STATUSES:
+                overload = str(status)
+            elif status < 400:
+                baseline = self.baselines.get(endpoint)
+                if baseline is None or latency < baseline:
+                    self.baselines[endpoint] = latency
+                else:
+                    if latency > baseline * self.tolerance + self.slack:
+                        overload = 'latency'
+                    self.baselines[endpoint] = baseline + (latency - baseline) * BASELINE_DRIFT
+
+            if overload is not None:
+                self.overloads[overload] = self.overloads.get(overload, 0) + 1
+                if started > self._decreased:
+                    self.limit = max(self.minimum, self.limit * BACKOFF)
+                    self.decreases += 1
+                    self._decreased = time.time()
+            elif status is not None and status < 400 and full:
+                self.limit = min(self.ceiling, self.limit + 1.0 / self.limit)
+            # other errors say nothing about how the server is coping
+            self._condition.notify_all()
+        return latency
+
+    def stats(self):
+        """
+        :return: Dict of the limit's current value, ceiling, the most requests in flight at once, requests
+                 completed, times the limit was cut, overloads by cause and seconds requests spent queued
+        """
+        with self._condition:
+            return {'name': self.name,
+                    'limit': round(self.limit, 2),
+                    'ceiling': self.ceiling,
+                    'peak': self.peak,
+                    'completed': self.completed,
+                    'decreases': self.decreases,
+                    'overloads': dict(self.overloads),
+                    'queued': round(self.queued, 3)}
+
+
+class ServerLimits:
+    """
+    The read and write limits of a Foreman server
+    """
+
+    def __init__(self, read_ceiling=DEFAULT_READ_CEILING, write_ceiling=DEFAULT_WRITE_CEILING, **settings):
+        """
+        :param read_ceiling: Most reads to make at a time
+        :param write_ceiling: Most writes to make at a time
+        :param settings: Further AdaptiveLimiter arguments for both limits
+        :return:
+        """
+        self.reads = AdaptiveLimiter('reads', read_ceiling, **settings)
+        self.writes = AdaptiveLimiter('writes', write_ceiling, **settings)
+
+    def for_method(self, method):
+        """
+        :param method: HTTP method
+        :return: AdaptiveLimiter requests with the method are subject to
+        """
+        return self.reads if method == 'GET' else self.writes
+
+    def stats(self):
+        return [self.reads.stats(), self.writes.stats()]
+
+
+class SharedLimits:
+    """
+    ServerLimits for each Foreman server, shared by every ForemanAPI talking to it, so together they
+    adapt to the load they put on it
+    """
+
+    def __init__(self, **settings):
+        """
+        :param settings: ServerLimits arguments
+        :return:
+        """
+        self._settings = settings
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def get(self, server):
+        """
+        :param server: Foreman server
+        :return: ServerLimits of the server
+        """
+        with self._lock:
+            if server not in self._limits:
+                self._limits[server] = ServerLimits(**self._settings)
+            return self._limits[server]
+
+    def stats(self):
+        """
+        :return: Dict of server to the stats of its limits
+        """
+        with self._lock:
+            limits = dict(self._limits)
+        return dict((server, server_limits.stats()) for server, server_limits in limits.items())
@@ -0,0 +1,109 @@
+import json
+import math
+import re
+import threading
+import time
+
+# Path segments that identify a particular object, replaced so requests aggregate by endpoint
+ID_SEGMENT = re.compile(r'^\d+$')
+
+
+def endpoint_template(url_extension):
+    """
+    Reduce a request path to the endpoint it calls, e.g. hostgroups/42/parameters to hostgroups/:id/parameters
+    :param url_extension: API path, relative to the API root
+    :return: Endpoint template
+    """
+    path = url_extension.split('?', 1)[0].strip('/')
+    return '/'.join(':id' if ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+
+def percentile(ordered, fraction):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if not ordered:
+        return None
+    rank = max(0, min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1))
+    return ordered[rank]
+
+
+class InMemoryMetrics:
+    """
+    Metrics sink aggregating requests by method and endpoint
+    """
+
+    def __init__(self):
+        self._latencies = {}
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, request):
+        """
+        Record a request
+        :param request: dict of endpoint, method, status, latency (seconds), size (response bytes) and retries
+        :return:
+        """
+        key = (request['method'], request['endpoint'])
+        with self._lock:
+            self._latencies.setdefault(key, []).append(request['latency'])
+            totals = self._totals.setdefault(key, {'errors': 0, 'bytes': 0, 'retries': 0})
+            if request['status'] is None or request['status'] >= 400:
+                totals['errors'] += 1
+            totals['bytes'] += request['size']
+            totals['retries'] += request['retries']
+
+    def stats(self):
+        """
+        Aggregate statistics of the requests recorded so far
+        :return: List of dicts, one per method and endpoint, slowest total first
+        """
+        with self._lock:
+            items = [(key, sorted(latencies), dict(self._totals[key])) for key, latencies in self._latencies.items()]
+
+        stats = []
+        for (method, endpoint), latencies, totals in items:
+            stats.append({'method': method,
+                          'endpoint': endpoint,
+                          'count': len(latencies),
+                          'errors': totals['errors'],
+                          'retries': totals['retries'],
+                          'bytes': totals['bytes'],
+                          'total': sum(latencies),
+                          'p50': percentile(latencies, 0.5),
+                          'p95': percentile(latencies, 0.95),
+                          'max': latencies[-1]})
+        return sorted(stats, key=lambda s: -s['total'])
+
+    def summary(self):
+        """
+        Human-readable table of the aggregate statistics
+        :return: List of lines
+        """
+        lines = ['{:<7} {:<50} {:>6} {:>8} {:>8} {:>8} {:>6} {:>7}'.format(
+            'METHOD', 'ENDPOINT', 'COUNT', 'P50 MS', 'P95 MS', 'MAX MS', 'ERRORS', 'RETRIES')]
+        for s in self.stats():
+            lines.append('{:<7} {:<50} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>6} {:>7}'.format(
+                s['method'], s['endpoint'], s['count'], s['p50'] * 1000, s['p95'] * 1000, s['max'] * 1000,
+                s['errors'], s['retries']))
+        return lines
+
+
+class JsonLinesExporter:
+    """
+    Metrics sink appending each request to a file as a line of JSON
+    """
+
+    def __init__(self, path):
+        """
+        :param path: File to append to
+        :return:
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, request):
+        line = json.dumps(dict(request, time=time.time()), sort_keys=True)
+        with self._lock:
+            with open(self.path, 'a') as stream:
+                stream.write(line + '\n')
@@ -0,0 +1,144 @@
+import unittest
+import BaseHTTPServer
+import json
+import threading
+import time
+from foremanapi import foreman, limiter
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # number of requests left to turn away as too many
+    rate_limited = 0
+
+    def _respond(self):
+        if Handler.rate_limited:
+            Handler.rate_limited -= 1
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write('{}')
+            return
+        length = int(self.headers.getheader('content-length') or 0)
+        if length:
+            self.rfile.read(length)
+        body = json.dumps({'id': 1, 'results': []})
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    def _round(self, limit, status=200, started=None, endpoint=None):
+        """
+        Make as many requests at once as the limit allows
+        """
+        tokens = [limit.acquire() for i in range(int(limit.limit))]
+        for token in tokens:
+            limit.release(started or token, status, endpoint)
+
+    def test_limit_grows_with_full_rounds_up_to_the_ceiling(self):
+        limit = limiter.AdaptiveLimiter('writes', 4, initial=1)
+        self._round(limit)
+        self.assertEqual(limit.limit, 2)
+        self._round(limit)
+        self.assertEqual(round(limit.limit, 2), 2.9)
+        for i in range(10):
+            self._round(limit)
+        self.assertEqual(limit.limit, 4)
+        self.assertEqual(limit.peak, 4)
+
+        # requests made one at a time don't show the server copes with more
+        limit = limiter.AdaptiveLimiter('writes', 4, initial=2)
+        for i in range(10):
+            limit.release(limit.acquire(), 200)
+        self.assertEqual(limit.limit, 2)
+
+    def test_overload_halves_the_limit_once_per_burst(self):
+        limit = limiter.AdaptiveLimiter('writes', 8, initial=8)
+        self._round(limit, status=429)
+        self.assertEqual(limit.limit, 4)
+        self._round(limit, status=503)
+        self.assertEqual(limit.limit, 2)
+        limit.release(limit.acquire(), None)
+        limit.release(limit.acquire(), None)
+        self.assertEqual(limit.limit, 1)
+        # errors that aren't overload leave the limit be
+        limit.release(limit.acquire(), 404)
+        self.assertEqual(limit.stats()['overloads'], {'429': 8, '503': 4, 'connection': 2})
+        self.assertEqual(limit.stats()['decreases'], 4)
+
+    def test_slow_requests_count_as_overload(self):
+        limit = limiter.AdaptiveLimiter('reads', 8, initial=4, slack=0.01)
+        for i in range(3):
+            self._round(limit)
+        grown = limit.limit
+        self._round(limit, started=time.time() - 0.5)
+        self.assertEqual(limit.limit, grown / 2)
+        self.assertEqual(limit.stats()['overloads'], {'latency': int(grown)})
+
+    def test_slow_endpoints_are_compared_with_themselves(self):
+        limit = limiter.AdaptiveLimiter('reads', 8, initial=4, slack=0.01)
+        for i in range(5):
+            # a quick lookup, then a listing that always takes far longer
+            self._round(limit, endpoint='environments')
+            self._round(limit, started=time.time() - 0.5, endpoint='hosts')
+        self.assertEqual(limit.stats()['overloads'], {})
+        self.assertEqual(limit.stats()['decreases'], 0)
+        self.assertTrue(limit.limit > 4)
+
+        # but the listing slowing down further still counts
+        self._round(limit, started=time.time() - 2, endpoint='hosts')
+        self.assertEqual(limit.stats()['decreases'], 1)
+
+    def test_requests_wait_for_the_limit(self):
+        limit = limiter.AdaptiveLimiter('writes', 4, initial=1)
+        token = limit.acquire()
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(limit.acquire()))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(acquired, [])
+        limit.release(token, 200)
+        waiter.join(5)
+        self.assertEqual(len(acquired), 1)
+        self.assertTrue(limit.stats()['queued'] >= 0.1)
+
+
+class TestLimitedRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_rate_limited_writes_back_off_and_retry(self):
+        limits = limiter.SharedLimits(write_ceiling=8)
+        server = '127.0.0.1:{}'.format(self.server.server_port)
+        api = foreman.ForemanAPI(server, 'user', 'secret', use_ssl=False, retries=2, retry_delay=0,
+                                 limits=limits.get(server))
+        self.assertTrue(limits.get(server) is api.limits)
+
+        Handler.rate_limited = 1
+        self.assertEqual(api.create_hostgroup('compute')['id'], 1)
+        self.assertEqual(api.get_hostgroups(), {})
+        stats = limits.stats()[server]
+        self.assertEqual([s['name'] for s in stats], ['reads', 'writes'])
+        self.assertEqual(stats[1]['overloads'], {'429': 1})
+        self.assertEqual(stats[1]['decreases'], 1)
+        self.assertEqual(stats[0]['decreases'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+import BaseHTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+from foremanapi import foreman, metrics
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # number of requests left to answer with a 503
+    unavailable = 0
+    # number of requests left to answer with a 504, as a gateway giving up on Foreman would
+    timed_out = 0
+    # number of requests left to read and then drop the connection of, without a response
+    dropped = 0
+
+    def _respond(self):
+        if Handler.dropped:
+            Handler.dropped -= 1
+            self.close_connection = 1
+            return
+        if Handler.timed_out:
+            Handler.timed_out -= 1
+            self.send_response(504)
+            self.end_headers()
+            self.wfile.write('{}')
+            return
+        if Handler.unavailable:
+            Handler.unavailable -= 1
+            self.send_response(503)
+            self.end_headers()
+            self.wfile.write('{}')
+            return
+        length = int(self.headers.getheader('content-length') or 0)
+        if length:
+            self.rfile.read(length)
+        body = json.dumps({'results': [{'name': 'param', 'id': 1, 'title': 'param'}]})
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRequestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.retry_delay = foreman.RETRY_DELAY
+        foreman.RETRY_DELAY = 0
+
+    def tearDown(self):
+        foreman.RETRY_DELAY = self.retry_delay
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.base)
+
+    def test_endpoint_template(self):
+        self.assertEqual(metrics.endpoint_template('/puppetclasses/12'), 'puppetclasses/:id')
+        self.assertEqual(metrics.endpoint_template('hostgroups/4/parameters?per_page=10'), 'hostgroups/:id/parameters')
+        self.assertEqual(metrics.endpoint_template('hostgroups'), 'hostgroups')
+
+    def test_percentile(self):
+        latencies = range(1, 101)
+        self.assertEqual(metrics.percentile(latencies, 0.5), 50)
+        self.assertEqual(metrics.percentile(latencies, 0.95), 95)
+        self.assertEqual(metrics.percentile([7], 0.95), 7)
+
+    def test_requests_are_recorded(self):
+        aggregate = metrics.InMemoryMetrics()
+        log = os.path.join(self.base, 'requests.jsonl')
+        api = foreman.ForemanAPI('127.0.0.1:{}'.format(self.server.server_port), 'user', 'secret', use_ssl=False,
+                                 metrics=[aggregate, metrics.JsonLinesExporter(log)], retries=1)
+
+        for hostgroup_id in (1, 2, 3):
+            api._foreman_api_get('hostgroups/{}/parameters'.format(hostgroup_id))
+        Handler.unavailable = 1
+        self.assertEqual(api.get_hostgroups(), {'param': 1})
+        api.delete_hostgroup(7)
+
+        stats = dict(((s['method'], s['endpoint']), s) for s in aggregate.stats())
+        self.assertEqual(sorted(stats), [('DELETE', 'hostgroups/:id'), ('GET', 'hostgroups'),
+                                         ('GET', 'hostgroups/:id/parameters')])
+        parameters = stats[('GET', 'hostgroups/:id/parameters')]
+        self.assertEqual(parameters['count'], 3)
+        self.assertTrue(parameters['p50'] <= parameters['p95'] <= parameters['max'])
+        self.assertEqual(stats[('GET', 'hostgroups')]['retries'], 1)
+        self.assertEqual(stats[('GET', 'hostgroups')]['errors'], 0)
+        self.assertEqual(len(aggregate.summary()), 4)
+
+        with open(log) as fh:
+            logged = [json.loads(line) for line in fh]
+        self.assertEqual(len(logged), 5)
+        self.assertEqual(logged[-1]['endpoint'], 'hostgroups/:id')
+        self.assertEqual(logged[-1]['status'], 200)
+        self.assertTrue(logged[-1]['size'] > 0)
+
+    def test_writes_only_retried_when_not_acted_on(self):
+        aggregate = metrics.InMemoryMetrics()
+        api = foreman.ForemanAPI('127.0.0.1:{}'.format(self.server.server_port), 'user', 'secret', use_ssl=False,
+                                 metrics=aggregate, retries=2)
+
+        # Foreman may have created the hostgroup before the gateway gave up, or the connection dropped
+        Handler.timed_out = 1
+        self.assertEqual(api.create_hostgroup('compute'), {})
+        Handler.dropped = 1
+        with self.assertRaises(foreman.requests.exceptions.ConnectionError):
+            api.create_hostgroup('compute')
+        Handler.timed_out = Handler.dropped = 0
+        # turned away before being acted on
+        Handler.unavailable = 1
+        api.create_hostgroup('compute')
+        stats = dict(((s['method'], s['endpoint']), s) for s in aggregate.stats())
+        self.assertEqual((stats[('POST', 'hostgroups')]['count'], stats[('POST', 'hostgroups')]['retries']), (3, 1))
+
+        # reads are retried whatever went wrong
+        Handler.timed_out = 1
+        self.assertEqual(api.get_hostgroups(), {'param': 1})
+
+        # nothing listening, so the write never reached a server
+        refused = foreman.ForemanAPI('127.0.0.1:1', 'user', 'secret', use_ssl=False, metrics=aggregate, retries=2)
+        with self.assertRaises(foreman.requests.exceptions.ConnectionError):
+            refused.create_hostgroup('compute')
+        stats = dict(((s['method'], s['endpoint']), s) for s in aggregate.stats())
+        self.assertEqual(stats[('POST', 'hostgroups')]['retries'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
-from maxhammer import runner
 
 def main(args=None):
+    # imported here so importing any maxhammer module doesn't pull in the whole runner
+    from maxhammer import runner
     r = runner.Runner()
     r.run()
 
@@ -0,0 +1,109 @@
+import os
+import logging
+import threading
+import time
+import paramiko
+
+# Seconds allowed for a destination to accept a connection and complete authentication
+DEFAULT_CONNECT_TIMEOUT = 10
+# Seconds allowed for a command run over a pooled connection to complete
+DEFAULT_COMMAND_TIMEOUT = 60
+# Seconds to wait for more output from a command before checking whether it's timed out
+COMMAND_POLL_INTERVAL = 0.05
+COMMAND_CHUNK_SIZE = 32768
+
+
+class ConnectionPool:
+    """
+    Thread-safe cache of authenticated SSH connections to distribution destinations, so a host is only
+    connected to once per run however many checks and transfers target it. Pre-checks, destination
+    manifests and tar transfers go through it; rsync transfers start an ssh of their own.
+    """
+
+    def __init__(self, timeout=DEFAULT_CONNECT_TIMEOUT, logger=None, command_timeout=DEFAULT_COMMAND_TIMEOUT):
+        """
+        :param timeout: Connect/authentication timeout in seconds
+        :param command_timeout: Seconds allowed for a command run with exec_command to complete
+        :return:
+        """
+        self.timeout = timeout
+        self.command_timeout = command_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self._clients = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _key(self, dest_cfg):
+        return (dest_cfg.user(), dest_cfg.host(), int(dest_cfg.port()))
+
+    def get(self, dest_cfg):
+        """
+        Return a connected SSH client for a destination, connecting if there isn't a live one already
+        :param dest_cfg: distribution.Destination to connect to
+        :return: Connected paramiko SSHClient
+        """
+        key = self._key(dest_cfg)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        # connect to different hosts concurrently, but only once to each
+        with lock:
+            client = self._clients.get(key)
+            if client is not None and client.get_transport() is not None and client.get_transport().is_active():
+                return client
+
+            self.logger.debug("Connecting to remote destination {}@{}:{}".format(*key))
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            key_file = dest_cfg.auth_key()
+            client.connect(dest_cfg.host(), int(dest_cfg.port()), dest_cfg.user(),
+                           key_filename=os.path.expanduser(key_file) if key_file else None,
+                           timeout=self.timeout, banner_timeout=self.timeout)
+            self._clients[key] = client
+            return client
+
+    def exec_command(self, dest_cfg, command, stdin=None):
+        """
+        Run a command on a destination over its pooled connection
+        :param dest_cfg: distribution.Destination to run on
+        :param command: Shell command line
+        :param stdin: Data to send to the command's standard input
+        :return: Tuple of (return code, stdout, stderr)
+        """
+        deadline = time.time() + self.command_timeout
+        channel = self.get(dest_cfg).get_transport().open_session()
+        try:
+            channel.settimeout(self.command_timeout)
+            channel.exec_command(command)
+            if stdin:
+                channel.sendall(stdin)
+            channel.shutdown_write()
+
+            # stdout and stderr are read as they arrive, so neither fills up while the other is waited on
+            stdout = []
+            stderr = []
+            while True:
+                if channel.recv_ready():
+                    stdout.append(channel.recv(COMMAND_CHUNK_SIZE))
+                elif channel.recv_stderr_ready():
+                    stderr.append(channel.recv_stderr(COMMAND_CHUNK_SIZE))
+                elif channel.exit_status_ready() and channel.eof_received:
+                    break
+                elif time.time() > deadline:
+                    raise Exception("Command on {} did not complete within {}s: {}".format(
+                        dest_cfg.host(), self.command_timeout, command))
+                else:
+                    time.sleep(COMMAND_POLL_INTERVAL)
+            return channel.recv_exit_status(), ''.join(stdout), ''.join(stderr)
+        finally:
+            channel.close()
+
+    def close(self):
+        """
+        Close all pooled connections
+        :return:
+        """
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
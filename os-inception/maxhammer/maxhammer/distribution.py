@@ -1,13 +1,13 @@
 import os
-import yaml
+import re
 import tempfile
 import shutil
-import errno
-import paramiko
-import socket
 import logging
 from subprocess import Popen, PIPE, STDOUT
-from maxhammer import fileutil, processor
+from maxhammer import connection, fileutil, journal as runjournal, manifest, metrics, plan, preflight, processor, sftp, store, yamlfile
+
+# Supported per-module remote transfer methods, the first being the default
+TRANSFER_METHODS = ['rsync', 'tar']
 
 
 def deep_get(dictionary, *keys):
@@ -40,7 +40,7 @@ class Destination:
 
         self._auth_identity = None
         if identity_key_file is not None:
-            self.auth_identity = identity_key_file
+            self._auth_identity = identity_key_file
         else:
             # Attempt to use the maxhammer runner's local identity key if it exists
             homedir = os.getenv('HOME')
@@ -50,6 +50,8 @@ class Destination:
 
         self.logger = logger or logging.getLogger(__name__)
 
+    def alias(self):
+        return self._alias
     def host(self):
         return self._hostname
     def port(self):
@@ -66,7 +68,7 @@ class Distribution:
     """
 
     def __init__(self, manifest_path, clouddata_config=None, source_base=None, send_to_remote=True, send_to_local=True,
-                 logger=None):
+                 logger=None, connections=None, template_cache=None, journal=None):
         """
         Initialises the class
         :param manifest_path: Path to distribution config
@@ -74,6 +76,9 @@ class Distribution:
         :param source_base: Base directory to read file sources from
         :param send_to_remote: Global override on whether to perform remote distribution
         :param send_to_local: Global override on whether to perform local distribution
+        :param connections: connection.ConnectionPool to share, otherwise the distribution keeps its own
+        :param template_cache: processor.TemplateCache to share compiled templates through
+        :param journal: journal.Journal to record completed transfers to, and resume from
         :return:
         """
         self.manifest_path = manifest_path
@@ -82,7 +87,21 @@ class Distribution:
         self.send_to_remote = send_to_remote
         self.send_to_local = send_to_local
         self.logger = logger or logging.getLogger(__name__)
+        self.template_cache = template_cache
+        self.journal = journal
         self._load_config()
+        # processors and builds kept between refreshes, by module source
+        self._processors = {}
+        self._builds = {}
+
+        self._owns_connections = connections is None
+        if connections is None:
+            connections = connection.ConnectionPool(
+                timeout=self.config_data['maxhammer'].get('connect_timeout', connection.DEFAULT_CONNECT_TIMEOUT),
+                logger=self.logger,
+                command_timeout=self.config_data['maxhammer'].get('command_timeout',
+                                                                  connection.DEFAULT_COMMAND_TIMEOUT))
+        self.connections = connections
 
 
     def _load_config(self):
@@ -94,8 +113,7 @@ class Distribution:
             raise Exception("Distribution config file could not be read: {}".format(self.manifest_path))
 
         try:
-            with open(self.manifest_path, 'r') as stream:
-                self.config_data = yaml.load(stream)
+            self.config_data = yamlfile.load(self.manifest_path)
         except Exception as error:
             raise Exception("Distribution could file could not be parsed: {}".format(self.manifest_path))
 
@@ -109,6 +127,16 @@ class Distribution:
         if 'default_auth_identity' in self.config_data['maxhammer']:
             self.auth_identity = self.config_data['maxhammer']['default_auth_identity']
 
+        self.store = None
+        store_cfg = self.config_data['maxhammer'].get('artifact_store')
+        if store_cfg:
+            if not 'path' in store_cfg:
+                raise Exception("Missing required 'path' for the artifact_store in {}".format(self.manifest_path))
+            max_size = store_cfg.get('max_size_mb')
+            self.store = store.ArtifactStore(store_cfg['path'],
+                                             max_size=max_size * 1048576 if max_size is not None else None,
+                                             logger=self.logger)
+
         self._destinations = self._load_destinations()
         self._verify_config()
 
@@ -153,76 +181,87 @@ class Distribution:
         if not all((self.clouddata_config,self.source_base)):
             raise Exception("Missing required configuration")
 
-    def _check_all_local_destinations(self):
+    def _local_checks(self, checker):
         """
-        Pre-check that all defined local destinations are writable
-        :return: True if all local destinations are valid, False otherwise
+        Build pre-checks that all defined local destinations are writable
+        :param checker: preflight.Preflight to run the checks with
+        :return: List of check callables
         """
         modules = deep_get(self.config_data, 'maxhammer', 'process_paths')
 
         if modules is None:
-            return True
+            return []
 
+        checks = []
         for module in modules:
             module_cfg = modules[module]
 
             if not 'local_destination' in module_cfg:
                 continue
             local_path = self._apply_environment_substitution(module_cfg['local_destination'])
+            sources = [os.path.join(self.source_base, d) for d in module_cfg.get('sources', [])]
+            checks.append(lambda module=module, local_path=local_path, sources=sources:
+                          checker.check_local(module, local_path, sources))
+        return checks
 
-            # check if directory already exists
-            if os.path.exists(local_path):
-                # it does, try to create a temporary file
-                try:
-                    testfile = tempfile.TemporaryFile(dir=local_path)
-                    testfile.close()
-                except OSError as err:
-                    if err.errno == errno.EACCES:  # 13
-                        self.logger.error("Pre-check of module {} failed: local destination {} is not writable.".format(
-                            module,local_path))
-                    else:
-                        self.logger.error("Pre-check of module {} failed: unable to verify local destination {}, reason: {}".format(
-                            module,local_path,str(err)))
-                    return False
-            else:
-                # it doesn't, try to create it
-                try:
-                    os.makedirs(local_path, mode=0755)
-                except OSError as err:
-                        self.logger.error("Pre-check of module {} failed: unable to verify local destination {}.".format(
-                            module,local_path, str(err)))
-
-        return True
-
-    def _check_remote_destination(self):
+    def _remote_checks(self, checker):
         """
-        Pre-check that the defined remote destination is valid, can be connected to, and written to.
-        :return: True if remote destination is valid, False otherwise
+        Build pre-checks that each remote destination in use is valid, can be connected to, and written to
+        :param checker: preflight.Preflight to run the checks with
+        :return: List of check callables, one per remote destination
         """
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        for alias in self._destinations:
-            d = self._destinations.get(alias)
-            try:
-                ssh.connect(d.host(), d.port(), d.user(), d.auth_key())
-                ssh.close()
-            except (paramiko.BadHostKeyException, paramiko.AuthenticationException,
-                    paramiko.SSHException, socket.error) as e:
-                self.logger.error("Pre-check failed: Unable to successfully establish a connection to remote destination '{}@{}:{}', reason: {}".format(
-                    d.user(), d.host(), d.port(), str(e)))
-                return False
-        return True
+        modules = deep_get(self.config_data, 'maxhammer', 'process_paths')
+
+        if modules is None:
+            return []
+
+        by_alias = {}
+        for module in modules:
+            module_cfg = modules[module]
+            sources = [os.path.join(self.source_base, d) for d in module_cfg.get('sources', [])]
+            for remote_destination in module_cfg.get('remote_hosts') or []:
+                alias = remote_destination.get('host')
+                dest_path = remote_destination.get('destination')
+                if alias is None or dest_path is None:
+                    continue
+                by_alias.setdefault(alias, []).append(
+                    (module, self._apply_environment_substitution(dest_path), sources))
+
+        checks = []
+        for alias in by_alias:
+            dest_cfg = self._destinations.get(alias)
+            if dest_cfg is None:
+                checks.append(lambda alias=alias: [
+                    'Pre-check failed: Missing clouddata maxhammer definition for destination "{}"'.format(alias)])
+                continue
+            checks.append(lambda alias=alias, dest_cfg=dest_cfg:
+                          checker.check_remote(alias, dest_cfg, by_alias[alias]))
+        return checks
 
-    def _rsync_to_remote(self, source_path, dest_cfg, remote_path):
+    def _rsync_to_remote(self, source_path, dest_cfg, remote_path, changes=None):
         """
-        Perform rsync-based delivery to a remote destination
+        Perform rsync-based delivery to a remote destination. rsync connects with an ssh of its own, rather
+        than through the connection pool.
         :param source_path: Source path to rsync
         :param dest_cfg: Destination host configuration
         :param remote_path: Remote path on destination to deliver to
-        :return:
+        :param changes: Changes from the destination's manifest, as returned by manifest.diff, to send only
+                        the changed paths rather than have rsync scan the whole tree. The deleted paths are
+                        listed too, for --delete-missing-args to remove them from the destination. Without
+                        changes, files already at the destination that the tree doesn't have are left be.
+        :return: Bytes sent
         """
-        cmd = "rsync -Pavz --rsync-path='mkdir -p {} && rsync' -e 'ssh -i {} -p {}' {}/ {}@{}:{}/".format(remote_path,
-                dest_cfg.auth_key(), dest_cfg.port(), source_path, dest_cfg.user(), dest_cfg.host(), remote_path)
+        files_from = ''
+        if changes is not None:
+            # paths replaced by an entry of another kind are sent, and --force has rsync replace them
+            paths = changes['changed'] + [path for path in changes['deleted'] if path not in changes['changed']]
+            fd, list_path = tempfile.mkstemp(prefix='mh-files-from.')
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(''.join(path + '\n' for path in paths))
+            files_from = '--files-from={} --delete-missing-args --force '.format(list_path)
+        cmd = "rsync -Pavz {}--rsync-path='mkdir -p {} && rsync' -e 'ssh -i {} -p {}' {}/ {}@{}:{}/".format(files_from,
+                remote_path, dest_cfg.auth_key(), dest_cfg.port(), source_path, dest_cfg.user(), dest_cfg.host(),
+                remote_path)
 
         self.logger.debug("Issuing sync to remote host: {}".format(cmd))
         try:
@@ -236,6 +275,44 @@ class Distribution:
             error = str(error)
             raise Exception("Failed to sync to remote host (FROM: {} TO: {}), Error: {}".format(
                 source_path, remote_path, error))
+        finally:
+            if changes is not None:
+                os.remove(list_path)
+
+        # rsync -v finishes with a "sent N bytes  received N bytes" line
+        sent = re.search(r'sent ([\d,]+) bytes', output[0] or '')
+        return int(sent.group(1).replace(',', '')) if sent else 0
+
+    def _connect(self, dest_cfg):
+        """
+        Open an SFTP session to a remote destination, over its pooled SSH connection
+        :param dest_cfg: Destination host configuration
+        :return: Connected sftp.Server
+        """
+        return sftp.Server.from_transport(self.connections.get(dest_cfg).get_transport())
+
+    def _tar_to_remote(self, source_path, dest_cfg, remote_path, changes=None):
+        """
+        Perform tar-stream delivery to a remote destination, swapping the delivered tree into place
+        :param source_path: Source path to deliver
+        :param dest_cfg: Destination host configuration
+        :param remote_path: Remote path on destination to deliver to
+        :param changes: Changes from the destination's manifest, as returned by manifest.diff, to send only
+                        the changed paths over a copy of the current tree
+        :return: Bytes sent, before compression
+        """
+        self.logger.debug("Streaming tar to remote host {}:{}".format(dest_cfg.host(), remote_path))
+        try:
+            with self._connect(dest_cfg) as server:
+                if changes is None:
+                    return server.upload_tar(source_path, remote_path)['bytes']
+                dirs = [p for p in changes['changed'] if os.path.isdir(os.path.join(source_path, p))]
+                files = [p for p in changes['changed'] if not os.path.isdir(os.path.join(source_path, p))]
+                return server.upload_tar(source_path, remote_path, dirs=dirs, files=files, update=True,
+                                         deletes=changes['deleted'])['bytes']
+        except Exception as error:
+            raise Exception("Failed to stream to remote host (FROM: {} TO: {}), Error: {}".format(
+                source_path, remote_path, str(error)))
 
     def _apply_environment_substitution(self, orig_path):
         """
@@ -248,58 +325,170 @@ class Distribution:
             raise Exception("Missing expected 'environment' key in clouddata.")
         return orig_path.replace('%environment%',self.clouddata_config['environment'])
 
-    def _distribute(self, module_cfg, proc_build_dir, dist_staging_dir):
+    def _remote_targets(self, module_cfg):
+        """
+        Resolve the remote destinations of a module
+        :param module_cfg: configuration of the module
+        :return: List of (alias, destination path, Destination)
+        """
+        targets = []
+        for remote_destination in module_cfg.get('remote_hosts') or []:
+            remote_alias = remote_destination.get('host')
+            dest_path = remote_destination.get('destination')
+
+            if remote_alias is None:
+                self.logger.error('Missing mandatory "host" field in remote_hosts manifest entry')
+            if dest_path is None:
+                self.logger.error('Missing mandatory "destination" field in remote_hosts manifest entry')
+
+            dest_path = self._apply_environment_substitution(dest_path)
+            dest_cfg = self._destinations.get(remote_alias)
+            if dest_cfg is None:
+                self.logger.error('Missing clouddata maxhammer definition for destination "{}"'.format(remote_alias))
+            targets.append((remote_alias, dest_path, dest_cfg))
+        return targets
+
+    def _send_to_remote(self, module_name, transfer_method, source_path, dest_cfg, dest_path):
+        """
+        Deliver a tree to a remote destination with the module's transfer method, unless the destination's
+        manifest shows it already has the tree
+        :return: Root hash of the tree the destination now has
+        """
+        built = manifest.build(source_path)
+        current_root = manifest.read_remote_root(self.connections, dest_cfg, dest_path)
+        if current_root == built['root']:
+            self.logger.debug("Skipping remote distribution of {} to {}:{}: unchanged".format(
+                source_path, dest_cfg.host(), dest_path))
+            metrics.count('transfers_skipped', module=module_name, destination=dest_cfg.alias())
+            return built['root']
+
+        changes = None
+        if current_root is not None:
+            previous = manifest.take_remote(self.connections, dest_cfg, dest_path)
+            changes = manifest.diff(built, previous) if previous else None
+
+        self.logger.debug("Initiating remote distribution of {} to {}:{}".format(source_path, dest_cfg.host(), dest_path))
+        with metrics.timer('transfer', module=module_name, destination=dest_cfg.alias()):
+            if transfer_method == 'tar':
+                sent = self._tar_to_remote(source_path, dest_cfg, dest_path, changes)
+            else:
+                sent = self._rsync_to_remote(source_path, dest_cfg, dest_path, changes)
+            manifest.save_remote(self.connections, dest_cfg, dest_path, built)
+        metrics.count('bytes_transferred', sent, module=module_name, destination=dest_cfg.alias())
+        return built['root']
+
+    def _send_to_local(self, module_name, source_path, local_path):
+        """
+        Deliver a tree to a local destination, unless the destination's manifest shows it already has the tree
+        :return: Root hash of the tree the destination now has, or None if it couldn't be delivered
+        """
+        try:
+            built = manifest.build(source_path)
+            if manifest.read_root(local_path) == built['root']:
+                self.logger.debug("Skipping local destination {}: unchanged".format(local_path))
+                metrics.count('transfers_skipped', module=module_name, destination='local')
+                return built['root']
+            previous = manifest.load(local_path)
+            changed = set(manifest.diff(built, previous)['changed']) if previous else None
+
+            with metrics.timer('transfer', module=module_name, destination='local'):
+                manifest.remove(local_path)
+                totals = fileutil.staged_sync(source_path, local_path, changed)
+                manifest.save(local_path, built)
+            metrics.count('bytes_copied', totals['bytes'], module=module_name, destination='local')
+            self.logger.debug("Synced local destination {}: {} files unchanged, {} files copied".format(
+                local_path, totals['linked'], totals['copied']))
+            return built['root']
+        except Exception as error:
+            self.logger.error("Unable to create local destination {}: {}".format(local_path, str(error)))
+
+    def _stage(self, module_name, proc_build_dir, dist_staging_dir):
+        """
+        Prepare our distribution staging area, minus any files we need to exclude
+        :return:
+        """
+        with metrics.timer('stage', module=module_name):
+            totals = fileutil.clone_with_filter(proc_build_dir, dist_staging_dir, job="distribution",
+                                                hardlink=self.store is not None)
+        metrics.count('bytes_copied', totals['bytes'], module=module_name)
+
+    def _distribute(self, module_name, module_cfg, proc_build_dir, dist_staging_dir, source=None, inputs=None):
         """
         Distribute a maxhammer module
+        :param module_name:
         :param module_cfg:
         :param proc_build_dir:
         :param dist_staging_dir:
+        :param source: Module source the build is of, relative to the source base, to journal transfers by
+        :param inputs: Fingerprint of what the build was made from, to journal transfers with
         :return:
         """
         if self.send_to_remote and 'remote_hosts' in module_cfg:
-            # Prepare our distribution staging area, minus any files we need to exclude
-            remote_destinations = module_cfg['remote_hosts']
-
-            for remote_destination in remote_destinations:
-                remote_alias = remote_destination.get('host')
-                dest_path = remote_destination.get('destination')
+            transfer_method = module_cfg.get('transfer_method', TRANSFER_METHODS[0])
+            self._stage(module_name, proc_build_dir, dist_staging_dir)
 
-                if remote_alias is None:
-                    self.logger.error('Missing mandatory "host" field in remote_hosts manifest entry')
-                if dest_path is None:
-                    self.logger.error('Missing mandatory "destination" field in remote_hosts manifest entry')
-
-                dest_path = self._apply_environment_substitution(dest_path)
-                dest_cfg = self._destinations.get(remote_alias)
-                if dest_cfg is None:
-                    self.logger.error('Missing clouddata maxhammer definition for destination "{}"'.format(remote_alias))
-
-                fileutil.clone_with_filter(proc_build_dir, dist_staging_dir, job="distribution")
-                self.logger.debug("Initiating remote distribution of {} to {}:{}".format(dist_staging_dir, dest_cfg.host(), dest_path))
-                self._rsync_to_remote(dist_staging_dir, dest_cfg, dest_path)
+            for remote_alias, dest_path, dest_cfg in self._remote_targets(module_cfg):
+                root = self._send_to_remote(module_name, transfer_method, dist_staging_dir, dest_cfg, dest_path)
+                self._record_transfer(module_name, source, remote_alias, dest_path, inputs, root)
 
         if self.send_to_local and 'local_destination' in module_cfg:
             local_path = self._apply_environment_substitution(module_cfg['local_destination'])
+            root = self._send_to_local(module_name, proc_build_dir, local_path)
+            self._record_transfer(module_name, source, 'local', local_path, inputs, root)
 
-            try:
-                os.makedirs(local_path, mode=0755)
-            except OSError as error:
-                pass
+    def _record_transfer(self, module_name, source, destination, path, inputs, root):
+        """
+        Journal a completed transfer, with the root hash of the tree delivered
+        :return:
+        """
+        if self.journal is not None and inputs is not None and root is not None:
+            self.journal.record('transfer', module=module_name, source=source, destination=destination, path=path,
+                                inputs=inputs, root=root)
 
-            try:
-                shutil.rmtree(local_path)
-                shutil.copytree(proc_build_dir, local_path)
-            except Exception as error:
-                self.logger.error("Unable to create local destination {}: {}".format(local_path, str(error)))
+    def _inputs(self, module_cfg, source_path):
+        """
+        Fingerprint what a module source's build is made from: the source tree, the module's configuration
+        and the clouddata
+        :return: Fingerprint
+        """
+        return runjournal.fingerprint(manifest.build(source_path)['root'], module_cfg, self.clouddata_config)
 
-    def _process_module(self, module_name, module_cfg):
+    def _resumable(self, module_name, module_cfg, source, inputs):
         """
-        Pre-process and distribute each manifest module
+        Check whether the journal shows a module source was delivered to each of its destinations from the
+        same inputs, and whether each destination's manifest shows it still has what was delivered
+        :return: True if the source needn't be built or delivered again
+        """
+        targets = []
+        if self.send_to_remote and 'remote_hosts' in module_cfg:
+            targets.extend(self._remote_targets(module_cfg))
+        if self.send_to_local and 'local_destination' in module_cfg:
+            targets.append(('local', self._apply_environment_substitution(module_cfg['local_destination']), None))
+        if not targets:
+            return False
+
+        for destination, path, dest_cfg in targets:
+            entry = self.journal.find('transfer', module=module_name, source=source, destination=destination,
+                                      path=path, inputs=inputs)
+            if entry is None:
+                return False
+            if destination == 'local':
+                root = manifest.read_root(path)
+            elif dest_cfg is not None:
+                root = manifest.read_remote_root(self.connections, dest_cfg, path)
+            else:
+                return False
+            if root != entry['root']:
+                return False
+        return True
+
+    def _validate_module(self, module_name, module_cfg):
+        """
+        Validate a manifest module's configuration
         :param module_name: name of the module
         :param module_cfg: configuration of the module
-        :return:
+        :return: List of the module's source paths
         """
-
         if not 'sources' in module_cfg:
             raise Exception("Missing source path(s) in configuration of module: {}".format(module_name))
         if not 'remote_destination' and not 'local_destination' in module_cfg:
@@ -314,30 +503,96 @@ class Distribution:
         if not process_method in ['ansible', 'overcloud', 'none']:
             raise Exception("Don't understand process_method {} for module {}".format(process_method, module_name))
 
-        for source_path in source_list:
+        transfer_method = module_cfg.get('transfer_method', TRANSFER_METHODS[0])
+        if not transfer_method in TRANSFER_METHODS:
+            raise Exception("Don't understand transfer_method {} for module {}".format(transfer_method, module_name))
 
+        for source_path in source_list:
             # Verify the source path exists
             if not os.path.exists(source_path):
                 raise Exception("Error in configuration for module {}, source path does not exist: {}".format(module_name, source_path))
 
-            # Create a temporary directory to house our post-processed files
-            proc_build_dir = tempfile.mkdtemp(module_name)
-            # Create a temporary directory to house our to-be-distributed files
-            dist_staging_dir = tempfile.mkdtemp(module_name)
+        return source_list
 
-            self.logger.debug("Pre-processing {} with method {} into {}".format(source_path, process_method, proc_build_dir))
+    def _processor(self, source_path):
+        """
+        Get the processor for a module source, reusing it (and the templates it's compiled) if there is one
+        :return: processor.Processor
+        """
+        if source_path not in self._processors:
+            self._processors[source_path] = processor.Processor(source_path, logger=self.logger, store=self.store,
+                                                                template_cache=self.template_cache)
+        return self._processors[source_path]
+
+    def _build(self, module_name, module_cfg, source_path, mkdtemp, build=None, changed=None):
+        """
+        Pre-process a module source into new build directories
+        :param mkdtemp: Function creating the build directories
+        :param build: Tuple of (post-processed build directory, distribution staging directory) from an
+                      earlier build of the source, to update rather than building from scratch
+        :param changed: With build, the source paths changed since it was built, relative to the source
+        :return: Tuple of (post-processed build directory, empty distribution staging directory)
+        """
+        process_method = module_cfg['process_method']
+        if build is None:
+            proc_build_dir = mkdtemp(module_name)
+            dist_staging_dir = mkdtemp(module_name)
+            fileutil.DIGESTS.transient(proc_build_dir)
+            fileutil.DIGESTS.transient(dist_staging_dir)
+        else:
+            proc_build_dir, dist_staging_dir = build
+            shutil.rmtree(dist_staging_dir)
+            os.mkdir(dist_staging_dir, 0700)
+            if process_method == "none":
+                shutil.rmtree(proc_build_dir)
+                os.mkdir(proc_build_dir, 0700)
 
-            proc = processor.Processor(source_path,logger=self.logger)
+        self.logger.debug("Pre-processing {} with method {} into {}".format(source_path, process_method, proc_build_dir))
+
+        proc = self._processor(source_path)
+        with metrics.timer('render', module=module_name):
             if process_method == "ansible":
-                proc.run(self.clouddata_config, proc_build_dir, process_method=processor.ANSIBLE)
+                counts = proc.run(self.clouddata_config, proc_build_dir, process_method=processor.ANSIBLE, changed=changed)
             elif process_method == "overcloud":
-                proc.run(self.clouddata_config, proc_build_dir, process_method=processor.GENERIC)
+                counts = proc.run(self.clouddata_config, proc_build_dir, process_method=processor.GENERIC, changed=changed)
             elif process_method == "none":
-                # Delete the temp dir because copytree wants it to not exist first
-                fileutil.clone_with_filter(source_path,proc_build_dir,job="distribution")
+                totals = fileutil.clone_with_filter(source_path,proc_build_dir,job="distribution",store=self.store)
+                counts = {'copied': totals['linked'] + totals['copied']}
+        metrics.count('templates_rendered', counts.get('rendered', 0), module=module_name)
+        metrics.count('renders_reused', counts.get('reused', 0), module=module_name)
+        metrics.count('files_copied', counts['copied'], module=module_name)
+        metrics.count('files_static', counts.get('static', 0), module=module_name)
+
+        return proc_build_dir, dist_staging_dir
+
+    def _process_module(self, module_name, module_cfg):
+        """
+        Pre-process and distribute each manifest module
+        :param module_name: name of the module
+        :param module_cfg: configuration of the module
+        :return:
+        """
+        source_list = self._validate_module(module_name, module_cfg)
+
+        for source_path in source_list:
+            source = os.path.relpath(source_path, self.source_base)
+            inputs = None
+            # sources are only fingerprinted for journaled runs, which --resume or --journal-dir ask for
+            if self.journal is not None:
+                inputs = self._inputs(module_cfg, source_path)
+                if self._resumable(module_name, module_cfg, source, inputs):
+                    self.logger.info("Skipping module {} source {}: delivered by the run being resumed".format(
+                        module_name, source_path))
+                    metrics.count('transfers_resumed', module=module_name)
+                    continue
+
+            # Create temporary directories to house our post-processed and to-be-distributed files,
+            # alongside the artifact store if there is one so they can be built from hardlinks
+            mkdtemp = self.store.mkdtemp if self.store else tempfile.mkdtemp
+            proc_build_dir, dist_staging_dir = self._build(module_name, module_cfg, source_path, mkdtemp)
 
             self.logger.info("Distributing module {} source {}".format(module_name, source_path))
-            self._distribute(module_cfg, proc_build_dir, dist_staging_dir)
+            self._distribute(module_name, module_cfg, proc_build_dir, dist_staging_dir, source, inputs)
 
             # clean out our tmp build directories
             shutil.rmtree(proc_build_dir)
@@ -345,17 +600,29 @@ class Distribution:
 
     def precheck(self):
         """
-        Pre-check that all conditions are met for a successful distribution
+        Pre-check that all conditions are met for a successful distribution. Every local and remote
+        destination is checked concurrently, and remote connections are kept for the distribution.
         :return: True if successful, false otherwise
         """
-        success = True
+        checker = preflight.Preflight(self.connections, self.logger)
+        checks = []
         if self.send_to_local:
-            success = success and self._check_all_local_destinations()
+            checks.extend(self._local_checks(checker))
+        if self.send_to_remote:
+            checks.extend(self._remote_checks(checker))
 
-        # if self.send_to_remote:
-        #     success = success and self._check_remote_destination()
+        failures = preflight.run_concurrently(checks)
+        for failure in failures:
+            self.logger.error(failure)
+        return not failures
 
-        return success
+    def close(self):
+        """
+        Release any connections held for the distribution
+        :return:
+        """
+        if self._owns_connections:
+            self.connections.close()
 
     def distribute(self):
         """
@@ -364,6 +631,125 @@ class Distribution:
         """
         modules = self.config_data['maxhammer']['process_paths']
 
-        for module in modules:
-            module_cfg = modules[module]
-            self._process_module(module, module_cfg)
+        try:
+            for module in modules:
+                module_cfg = modules[module]
+                self._process_module(module, module_cfg)
+        finally:
+            if self.store:
+                self.store.evict()
+
+    def refresh(self, changed=None):
+        """
+        Rebuild and redistribute the modules affected by a set of changes. Each module source's build is
+        kept between refreshes so only the files affected by a change are processed again.
+        :param changed: Absolute paths that changed, or None to rebuild every module from scratch
+        :return: Number of module sources redistributed
+        """
+        modules = self.config_data['maxhammer']['process_paths']
+        mkdtemp = self.store.mkdtemp if self.store else tempfile.mkdtemp
+        refreshed = 0
+
+        try:
+            for module_name in modules:
+                module_cfg = modules[module_name]
+                for source_path in self._validate_module(module_name, module_cfg):
+                    build = self._builds.pop((module_name, source_path), None)
+                    source_changes = None
+                    if changed is not None and build is not None:
+                        source_root = os.path.abspath(source_path)
+                        source_changes = [os.path.relpath(path, source_root) for path in changed
+                                          if path == source_root or path.startswith(source_root + os.sep)]
+                        if not source_changes:
+                            self._builds[(module_name, source_path)] = build
+                            continue
+                    if build is not None and (source_changes is None or '.' in source_changes):
+                        shutil.rmtree(build[0])
+                        shutil.rmtree(build[1])
+                        build = None
+                        source_changes = None
+
+                    try:
+                        build = self._build(module_name, module_cfg, source_path, mkdtemp, build, source_changes)
+                    except Exception:
+                        # start afresh next time rather than from a half-updated build
+                        if build is not None:
+                            shutil.rmtree(build[0], ignore_errors=True)
+                            shutil.rmtree(build[1], ignore_errors=True)
+                        raise
+                    self._builds[(module_name, source_path)] = build
+
+                    self.logger.info("Distributing module {} source {}".format(module_name, source_path))
+                    self._distribute(module_name, module_cfg, *build)
+                    refreshed += 1
+        finally:
+            if self.store:
+                self.store.evict()
+        return refreshed
+
+    def release(self):
+        """
+        Remove the builds kept by refresh()
+        :return:
+        """
+        for proc_build_dir, dist_staging_dir in self._builds.values():
+            shutil.rmtree(proc_build_dir, ignore_errors=True)
+            shutil.rmtree(dist_staging_dir, ignore_errors=True)
+        self._builds = {}
+
+    def plan(self, change_plan):
+        """
+        Render every module and record what distributing it would change, without changing anything.
+        The rendered trees are kept in the plan's build_root so the plan can later be applied as-is.
+        :param change_plan: plan.Plan to add transfers to
+        :return:
+        """
+        modules = self.config_data['maxhammer']['process_paths']
+        mkdtemp = lambda suffix: tempfile.mkdtemp(suffix, dir=change_plan.build_root)
+
+        for module_name in modules:
+            module_cfg = modules[module_name]
+            for source_path in self._validate_module(module_name, module_cfg):
+                source = os.path.relpath(source_path, self.source_base)
+                proc_build_dir, dist_staging_dir = self._build(module_name, module_cfg, source_path, mkdtemp)
+
+                if self.send_to_remote and 'remote_hosts' in module_cfg:
+                    transfer_method = module_cfg.get('transfer_method', TRANSFER_METHODS[0])
+                    self._stage(module_name, proc_build_dir, dist_staging_dir)
+                    built = plan.local_snapshot(dist_staging_dir)
+                    for remote_alias, dest_path, dest_cfg in self._remote_targets(module_cfg):
+                        current = plan.remote_snapshot(self.connections, dest_cfg, dest_path)
+                        # rsync leaves files it wasn't given in place, a tar swap replaces the whole tree
+                        diff = plan.diff_snapshots(built, current, deletes=transfer_method == 'tar')
+                        change_plan.add_transfer(module_name, source, remote_alias, dest_path, transfer_method,
+                                                 dist_staging_dir, diff)
+
+                if self.send_to_local and 'local_destination' in module_cfg:
+                    local_path = self._apply_environment_substitution(module_cfg['local_destination'])
+                    diff = plan.diff_snapshots(plan.local_snapshot(proc_build_dir), plan.local_snapshot(local_path))
+                    change_plan.add_transfer(module_name, source, 'local', local_path, 'local', proc_build_dir, diff)
+
+    def apply_plan(self, change_plan):
+        """
+        Deliver the rendered trees recorded in a plan, skipping transfers that had no changes
+        :param change_plan: plan.Plan to apply
+        :return:
+        """
+        for transfer in change_plan.transfers:
+            if not change_plan.has_changes(transfer):
+                self.logger.info("Skipping module {} source {} to {}: no changes planned".format(
+                    transfer['module'], transfer['source'], transfer['destination']))
+                continue
+
+            self.logger.info("Distributing module {} source {} to {}".format(
+                transfer['module'], transfer['source'], transfer['destination']))
+            if transfer['method'] == 'local':
+                if self.send_to_local:
+                    self._send_to_local(transfer['module'], transfer['build_dir'], transfer['path'])
+            elif self.send_to_remote:
+                dest_cfg = self._destinations.get(transfer['destination'])
+                if dest_cfg is None:
+                    raise Exception('Missing clouddata maxhammer definition for destination "{}"'.format(
+                        transfer['destination']))
+                self._send_to_remote(transfer['module'], transfer['method'], transfer['build_dir'], dest_cfg,
+                                     transfer['path'])
@@ -1,8 +1,60 @@
 import os
+import cPickle
+import ctypes
+import ctypes.util
+import errno
 import fnmatch
+import hashlib
+import logging
+import mmap
 import ConfigParser
+import Queue
+import re
 import shutil
+import stat
+import sys
+import tempfile
+import threading
 from dirtools import Dir
+from maxhammer import metrics
+
+# renameat2() flag asking the kernel to atomically exchange two paths
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+# Files at least this big are hashed straight from a memory map rather than read into strings
+MMAP_THRESHOLD = 1048576
+HASH_CHUNK_SIZE = 1048576
+# Number of threads hashing files at once; hashing releases the GIL, so they run in parallel
+DEFAULT_HASH_WORKERS = 4
+# Default location of the persistent cache of file digests
+DEFAULT_DIGEST_CACHE_PATH = '~/.cache/maxhammer/digests'
+# Digest cache format, bumped whenever the layout changes
+DIGEST_CACHE_FORMAT = 2
+# Number of runs a cached digest may go unused before it's dropped
+DIGEST_CACHE_GENERATIONS = 10
+
+
+def read_umask():
+    """
+    Read the process umask. It's process-wide and os.umask can only read it by changing it, which would
+    race with other threads creating files, so it's read from /proc where possible and otherwise only
+    while this module is first imported, before any threads are started.
+    :return: umask
+    """
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except IOError:
+        pass
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# umask of the process, for files created with modes of their own
+UMASK = read_umask()
 
 
 class DirWithSymlinks(Dir):
@@ -96,7 +148,14 @@ def get_files_with_exclusion_status(fromdir,job="processing",ignorefile=".mhigno
     return stuff
 
 
-def clone_with_filter(fromdir,todir,job="processing",ignorefile=".mhignore"):
+def clone_with_filter(fromdir,todir,job="processing",ignorefile=".mhignore",store=None,hardlink=False):
+    """
+    Copy a directory tree, minus anything excluded by its ignore files
+    :param store: Optional store.ArtifactStore to hardlink the copied files from
+    :param hardlink: Hardlink files rather than copying them, where the filesystem allows
+    :return: Dict of the number of files linked and copied, and the bytes copied
+    """
+    totals = {'linked': 0, 'copied': 0, 'bytes': 0}
 
     exclude_files = _get_exclude_files(fromdir,ignorefile)
     exclude_list = _build_exclude_list(fromdir,job,exclude_files)
@@ -111,7 +170,22 @@ def clone_with_filter(fromdir,todir,job="processing",ignorefile=".mhignore"):
     for file in d.files():
         from_file = os.path.join(fromdir,file)
         to_file = os.path.join(todir,file)
+        if store:
+            store.link(store.put_file(from_file, os.stat(from_file).st_mode), to_file)
+            totals['linked'] += 1
+            continue
+        if hardlink:
+            try:
+                os.link(from_file, to_file)
+                totals['linked'] += 1
+                continue
+            except OSError:
+                pass
         shutil.copy2(from_file,to_file)
+        totals['copied'] += 1
+        totals['bytes'] += os.lstat(to_file).st_size
+
+    return totals
 
 
 def check_include(rootdir, path, include_list):
@@ -132,3 +206,386 @@ def check_include(rootdir, path, include_list):
     return False
 
 
+def _compile_patterns(path_list):
+    """
+    Resolve and compile a list of paths into the patterns check_include matches against
+    """
+    return [re.compile(fnmatch.translate(os.path.normpath(os.path.realpath(i)) + '*')) for i in path_list]
+
+
+def compile_path_filter(include_list=None, exclude_list=None):
+    """
+    Build a filter of walked directory entries equivalent to checking each with check_include against
+    an exclude list and an include list, with the paths in the lists resolved and compiled only once
+    :param include_list: Paths (directories or files) an entry must be in, if given
+    :param exclude_list: Paths (directories or files) an entry must not be in
+    :return: Function of (rootdir, name) returning True if the entry passes both lists
+    """
+    included = _compile_patterns(include_list) if include_list else None
+    excluded = _compile_patterns(exclude_list) if exclude_list else None
+    realdirs = {}
+
+    def wanted(rootdir, name):
+        if included is None and excluded is None:
+            return True
+        path = os.path.join(rootdir, name)
+        if not name or os.sep in name or name in (os.curdir, os.pardir) or os.path.islink(path):
+            path = os.path.realpath(path)
+        else:
+            # a plain entry resolves to itself under its resolved directory
+            if rootdir not in realdirs:
+                realdirs[rootdir] = os.path.realpath(rootdir)
+            path = os.path.join(realdirs[rootdir], name)
+        if excluded is not None and any(pattern.match(path) for pattern in excluded):
+            return False
+        return included is None or any(pattern.match(path) for pattern in included)
+    return wanted
+
+
+def file_digest(path):
+    """
+    SHA-1 of a file's content, hashed from a memory map of the file when it's large
+    :param path: File to hash
+    :return: Hex digest
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as stream:
+        size = os.fstat(stream.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            digest.update(stream.read())
+        else:
+            mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, HASH_CHUNK_SIZE):
+                    digest.update(buffer(mapped, offset, HASH_CHUNK_SIZE))
+            finally:
+                mapped.close()
+    return digest.hexdigest()
+
+
+class DigestCache:
+    """
+    Cache of file digests, keyed by device, inode, size, modification time and inode change time, so a file
+    is only read again once it changes. Copies can carry over another file's size and modification time, and
+    take over its inode once it's removed, but never its change time. Hardlinks of a file share its digest.
+    With a path, the cache is kept on disk between runs, dropping digests that go unused for
+    DIGEST_CACHE_GENERATIONS runs. Digests of files in the temporary directories builds are made in are
+    only kept in memory.
+    """
+
+    def __init__(self, path=None, logger=None, workers=DEFAULT_HASH_WORKERS):
+        """
+        :param path: File to persist the cache to, or None to cache in memory only
+        :param workers: Number of threads hashing files at once
+        :return:
+        """
+        self.path = os.path.abspath(os.path.expanduser(path)) if path else None
+        self.logger = logger or logging.getLogger(__name__)
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._generation, self._entries = self._read()
+        # digests of files in temporary directories, not worth keeping beyond the run
+        self._unsaved = {}
+        self._transient = []
+        self._dirty = False
+
+    def _read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return 0, {}
+        try:
+            with open(self.path, 'rb') as stream:
+                cached = cPickle.load(stream)
+            if cached.get('format') == DIGEST_CACHE_FORMAT:
+                return cached['generation'] + 1, cached['entries']
+        except Exception as error:
+            self.logger.warning("Ignoring unreadable digest cache {}: {}".format(self.path, str(error)))
+        return 0, {}
+
+    def _key(self, st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+    def transient(self, directory):
+        """
+        Only keep the digests of files in a directory in memory, it being removed once the run is done with it
+        :param directory: Temporary directory
+        :return:
+        """
+        with self._lock:
+            self._transient.append(os.path.join(os.path.realpath(directory), ''))
+
+    def _persisted(self, path):
+        path = os.path.realpath(path)
+        return not any(path.startswith(directory) for directory in self._transient)
+
+    def lookup(self, path, st=None):
+        """
+        Look up a file's digest without hashing it
+        :param st: The file's stat result, if already known
+        :return: Hex digest, or None if the file isn't cached as it is now
+        """
+        key = self._key(st or os.stat(path))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._unsaved.get(key)
+                if entry is None:
+                    return None
+                metrics.count('digests_cached')
+                return entry[0]
+            if entry[1] != self._generation:
+                self._entries[key] = (entry[0], self._generation)
+                self._dirty = True
+        metrics.count('digests_cached')
+        return entry[0]
+
+    def record(self, path, digest, st):
+        """
+        Record the digest of a file hashed elsewhere
+        :param st: The file's stat result from before it was read
+        """
+        persisted = self._persisted(path)
+        with self._lock:
+            if persisted:
+                self._entries[self._key(st)] = (digest, self._generation)
+                self._dirty = True
+            else:
+                self._unsaved[self._key(st)] = (digest, self._generation)
+
+    def digest(self, path):
+        """
+        Get a file's digest, hashing it only if it changed since it was last cached
+        :return: Hex digest
+        """
+        st = os.stat(path)
+        digest = self.lookup(path, st)
+        if digest is None:
+            digest = file_digest(path)
+            metrics.count('files_hashed')
+            self.record(path, digest, st)
+        return digest
+
+    def digests(self, paths):
+        """
+        Get the digests of many files, hashing those not cached across the worker threads
+        :param paths: Files to get the digests of
+        :return: Dict of path to hex digest
+        """
+        results = {}
+        misses = []
+        for path in paths:
+            st = os.stat(path)
+            digest = self.lookup(path, st)
+            if digest is None:
+                misses.append((path, st))
+            else:
+                results[path] = digest
+        if not misses:
+            return results
+
+        tasks = Queue.Queue()
+        for miss in misses:
+            tasks.put(miss)
+        errors = []
+
+        def worker():
+            while True:
+                try:
+                    path, st = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    digest = file_digest(path)
+                except Exception as error:
+                    errors.append(error)
+                    return
+                self.record(path, digest, st)
+                results[path] = digest
+
+        threads = [threading.Thread(target=worker) for i in range(max(1, min(self.workers, len(misses))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        metrics.count('files_hashed', len(misses))
+        return results
+
+    def save(self):
+        """
+        Persist the cache, dropping digests unused for DIGEST_CACHE_GENERATIONS runs
+        :return:
+        """
+        if self.path is None or not self._dirty:
+            return
+        with self._lock:
+            oldest = self._generation - DIGEST_CACHE_GENERATIONS
+            entries = dict((k, v) for k, v in self._entries.items() if v[1] > oldest)
+            self._dirty = False
+
+        cache_dir = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0700)
+            # written aside and renamed into place, so concurrent runs never see a partial cache
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.digests')
+            with os.fdopen(fd, 'wb') as stream:
+                cPickle.dump({'format': DIGEST_CACHE_FORMAT, 'generation': self._generation, 'entries': entries},
+                             stream, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except Exception as error:
+            self.logger.warning("Could not save digest cache {}: {}".format(self.path, str(error)))
+
+
+# Cache used for all file digests, in memory only unless replaced with a persistent one
+DIGESTS = DigestCache()
+
+
+def _exchange_paths(path1, path2):
+    """
+    Atomically exchange two paths via renameat2(RENAME_EXCHANGE) where the platform supports it
+    :return: True if the paths were exchanged, False if unsupported
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError, TypeError):
+        return False
+    # ctypes would pass unicode paths as wide strings
+    encoding = sys.getfilesystemencoding()
+    path1, path2 = [p.encode(encoding) if isinstance(p, unicode) else p for p in (path1, path2)]
+    if renameat2(AT_FDCWD, path1, AT_FDCWD, path2, RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL):
+        return False
+    raise OSError(err, os.strerror(err), path2)
+
+
+def _may_be_unchanged(srcfile, existing):
+    """
+    Check whether an already-delivered file matches the newly built one in type, size and mode,
+    without looking at their content
+    """
+    try:
+        src_st = os.stat(srcfile)
+        dst_st = os.lstat(existing)
+    except OSError:
+        return False
+    return stat.S_ISREG(dst_st.st_mode) and src_st.st_size == dst_st.st_size and \
+        stat.S_IMODE(src_st.st_mode) == stat.S_IMODE(dst_st.st_mode)
+
+
+def _populate_staging(fromdir, stagedir, currentdir, changed=None):
+    """
+    Fill a staging directory with the contents of fromdir, hardlinking files that are unchanged
+    from those in currentdir and copying the rest
+    :param changed: Files known to differ from currentdir, relative to it. Any others are taken to be
+                    unchanged without comparing them.
+    :return: Dict of the number of files linked and copied, and the bytes copied
+    """
+    totals = {'linked': 0, 'copied': 0, 'bytes': 0}
+    files_found = []
+    dir_modes = []
+    for root, dirs, files in os.walk(fromdir, followlinks=True):
+        reldir = os.path.relpath(root, fromdir)
+        for d in dirs:
+            os.mkdir(os.path.join(stagedir, reldir, d), 0700)
+            dir_modes.append((os.path.join(stagedir, reldir, d), stat.S_IMODE(os.stat(os.path.join(root, d)).st_mode)))
+        for f in files:
+            existing = os.path.join(currentdir, reldir, f) if currentdir else None
+            files_found.append((os.path.normpath(os.path.join(reldir, f)), os.path.join(root, f),
+                                os.path.join(stagedir, reldir, f), existing))
+
+    if changed is not None:
+        unchanged = set(relpath for relpath, srcfile, stagedfile, existing in files_found
+                        if existing and relpath not in changed)
+    else:
+        # compare content by digest, hashing both sides in parallel and the delivered side from the cache
+        candidates = [(relpath, srcfile, existing) for relpath, srcfile, stagedfile, existing in files_found
+                      if existing and _may_be_unchanged(srcfile, existing)]
+        digests = DIGESTS.digests([srcfile for relpath, srcfile, existing in candidates] +
+                                  [existing for relpath, srcfile, existing in candidates])
+        unchanged = set(relpath for relpath, srcfile, existing in candidates
+                        if digests[srcfile] == digests[existing])
+
+    for relpath, srcfile, stagedfile, existing in files_found:
+        if relpath in unchanged:
+            try:
+                os.link(existing, stagedfile)
+                totals['linked'] += 1
+                continue
+            except OSError:
+                pass
+        shutil.copy2(srcfile, stagedfile)
+        totals['copied'] += 1
+        totals['bytes'] += os.path.getsize(stagedfile)
+
+    # directories get their source modes, unmasked by the umask, once nothing more is written into them
+    for path, mode in dir_modes:
+        os.chmod(path, mode)
+    return totals
+
+
+def staged_sync(fromdir, todir, changed=None):
+    """
+    Replace the tree at todir with the contents of fromdir without readers ever seeing a missing or
+    half-written tree.
+
+    The new tree is assembled in a sibling staging directory, reusing unchanged files from the current
+    tree as hardlinks. If todir is a symlink, the new tree becomes a versioned sibling directory and the
+    symlink is flipped over to it; otherwise the staging directory is atomically exchanged with todir
+    (falling back to back-to-back renames where the kernel can't exchange).
+    :param fromdir: Directory holding the newly built tree
+    :param todir: Destination to replace
+    :param changed: Set of files known to differ from those at todir, relative to it, such as from a manifest.
+                    Any others are linked without comparing them.
+    :return: Dict of the number of files linked and copied, and the bytes copied
+    """
+    todir = os.path.abspath(todir).rstrip(os.sep)
+    parent, name = os.path.split(todir)
+    if not os.path.isdir(parent):
+        os.makedirs(parent, 0755)
+
+    current = os.path.realpath(todir) if os.path.isdir(todir) else None
+
+    if os.path.islink(todir):
+        # Symlink flip: build a new versioned tree, then atomically repoint the link at it
+        version_prefix = '.{}.mh-'.format(name)
+        stagedir = tempfile.mkdtemp(prefix=version_prefix, dir=parent)
+        totals = _populate_staging(fromdir, stagedir, current, changed)
+        os.chmod(stagedir, stat.S_IMODE(os.stat(fromdir).st_mode))
+
+        templink = os.path.join(parent, '.{}.mh-link'.format(name))
+        if os.path.lexists(templink):
+            os.remove(templink)
+        os.symlink(os.path.basename(stagedir), templink)
+        os.rename(templink, todir)
+
+        if current and os.path.basename(current).startswith(version_prefix):
+            shutil.rmtree(current, ignore_errors=True)
+        return totals
+
+    stagedir = os.path.join(parent, '.{}.mh-staging'.format(name))
+    if os.path.lexists(stagedir):
+        shutil.rmtree(stagedir)
+    os.mkdir(stagedir, 0700)
+    totals = _populate_staging(fromdir, stagedir, current, changed)
+    os.chmod(stagedir, stat.S_IMODE(os.stat(fromdir).st_mode))
+
+    if current is None:
+        if os.path.lexists(todir):
+            os.remove(todir)
+        os.rename(stagedir, todir)
+    elif _exchange_paths(stagedir, todir):
+        # the staging path now holds the previous tree
+        shutil.rmtree(stagedir)
+    else:
+        previous = os.path.join(parent, '.{}.mh-previous'.format(name))
+        if os.path.lexists(previous):
+            shutil.rmtree(previous)
+        os.rename(todir, previous)
+        os.rename(stagedir, todir)
+        shutil.rmtree(previous)
+    return totals
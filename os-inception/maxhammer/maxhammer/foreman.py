@@ -1,11 +1,75 @@
-import yaml
 import json
 import re
 import os
-import yaml
+import Queue
+import sys
+import threading
 from jinja2 import Template, Environment, FileSystemLoader
 from zenlog import logging
 from foremanapi import foreman
+from foremanapi import limiter
+from maxhammer import journal as runjournal, metrics, yamlfile
+
+# Number of hostgroup templates rendered at a time
+DEFAULT_RENDER_WORKERS = 4
+
+# Times to retry a Foreman request turned away as overloaded, or that failed to connect
+DEFAULT_API_RETRIES = 3
+
+# Attributes of the base hostgroup: (create_hostgroup argument, clouddata setting, lookup table)
+BASE_ATTRIBUTES = [('environment_id', 'environment', 'environments'),
+                   ('domain_id', 'domain', 'domains'),
+                   ('subnet_id', 'subnet', 'subnets'),
+                   ('realm_id', 'realm', 'realms'),
+                   ('architecture_id', 'architecture', 'architectures'),
+                   ('operatingsystem_id', 'operatingsystem', 'operatingsystems'),
+                   ('media_id', 'media', 'media'),
+                   ('ptable_id', 'ptable', 'ptables')]
+
+
+class MeasuredAPI:
+    """
+    Wraps a ForemanAPI, timing every call made through it
+    """
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with metrics.timer('foreman_api', call=name):
+                return attr(*args, **kwargs)
+        return call
+
+
+class LookupCache:
+    """
+    Foreman reference data (environments, puppetclasses, domains and so on) shared between Foreman
+    instances using the same build server, so it's only fetched once however many clouds are built
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, buildserver, load):
+        """
+        Get a build server's reference data, loading it if it hasn't been already
+        :param buildserver: Build server the data comes from
+        :param load: Function loading the data from the build server
+        :return: Dict of reference data
+        """
+        with self._lock:
+            lock = self._locks.setdefault(buildserver, threading.Lock())
+        with lock:
+            if buildserver not in self._tables:
+                self._tables[buildserver] = load()
+            return self._tables[buildserver]
 
 
 class Foreman:
@@ -13,16 +77,36 @@ class Foreman:
     Class for creating an openstack Puppet-driven deployment environment within Foreman
     """
 
-    def __init__(self, clouddata_config, hostgroup_config_path, logger=None):
+    def __init__(self, clouddata_config, hostgroup_config_path, logger=None, lookups=None, template_cache=None,
+                 request_metrics=None, render_workers=DEFAULT_RENDER_WORKERS, journal=None, limits=None):
         """
         :param clouddata_config: de-serialized YAML of clouddata configuration
         :param hostgroup_config: de-serialized YAML of hostgroup configuration
+        :param lookups: LookupCache to share Foreman reference data through
+        :param template_cache: processor.TemplateCache to share compiled hostgroup templates through
+        :param request_metrics: foremanapi metrics sink, or list of sinks, to record Foreman requests to
+        :param render_workers: Number of hostgroup templates to render at a time
+        :param journal: journal.Journal to record the hostgroups built to, and resume from
+        :param limits: foremanapi.limiter.ServerLimits to share with anything else using the build server.
+                       Writes are made by as many threads as its write ceiling, and it decides how many of
+                       them reach Foreman at once.
         :return:
         """
         self.clouddata = clouddata_config
         self.hostgroup_config_path = hostgroup_config_path
-        self.foremanapi = foreman.ForemanAPI(clouddata_config['buildserver'], 'hammer', 'hammer')
+        limits = limits or limiter.ServerLimits()
+        self.foremanapi = MeasuredAPI(foreman.ForemanAPI(clouddata_config['buildserver'], 'hammer', 'hammer',
+                                                         metrics=request_metrics, retries=DEFAULT_API_RETRIES,
+                                                         limits=limits))
+        self.write_workers = limits.writes.ceiling
         self.logger = logger or logging.getLogger(__name__)
+        self.lookups = lookups
+        self.template_cache = template_cache
+        self.render_workers = render_workers
+        self.journal = journal
+        self.hostgroups = None
+        # template environments are kept, along with the templates they've compiled, by directory
+        self._environments = {}
 
 
     def _load_config_from_foreman(self):
@@ -33,139 +117,424 @@ class Foreman:
 
         # All of these structures represent a map of name to id
         self.hostgroups = self.foremanapi.get_hostgroups()
-        self.environments = self.foremanapi.get_environments()
-        self.proxyfeatures = self.foremanapi.get_smart_proxy_features()
-        self.puppetclasses = self.foremanapi.get_puppetclasses()
-        self.domains = self.foremanapi.get_domains()
-        self.subnets = self.foremanapi.get_subnets()
-        self.realms = self.foremanapi.get_realms()
-        self.architectures = self.foremanapi.get_architectures()
-        self.operatingsystems = self.foremanapi.get_operatingsystems()
-        self.media = self.foremanapi.get_media()
-        self.ptables = self.foremanapi.get_ptables()
-
-
-    def _delete_hostgroups(self):
+        if self.lookups is not None:
+            tables = self.lookups.get(self.clouddata['buildserver'], self._load_reference_data)
+        else:
+            tables = self._load_reference_data()
+        self.environments = tables['environments']
+        self.proxyfeatures = tables['proxyfeatures']
+        self.puppetclasses = tables['puppetclasses']
+        self.domains = tables['domains']
+        self.subnets = tables['subnets']
+        self.realms = tables['realms']
+        self.architectures = tables['architectures']
+        self.operatingsystems = tables['operatingsystems']
+        self.media = tables['media']
+        self.ptables = tables['ptables']
+
+
+    def _load_reference_data(self):
+        """
+        Query the build server for the reference data hostgroups are built from
+        :return: dict of lookup table name to map of name to id
+        """
+        return {'environments': self.foremanapi.get_environments(),
+                'proxyfeatures': self.foremanapi.get_smart_proxy_features(),
+                'puppetclasses': self.foremanapi.get_puppetclasses(),
+                'domains': self.foremanapi.get_domains(),
+                'subnets': self.foremanapi.get_subnets(),
+                'realms': self.foremanapi.get_realms(),
+                'architectures': self.foremanapi.get_architectures(),
+                'operatingsystems': self.foremanapi.get_operatingsystems(),
+                'media': self.foremanapi.get_media(),
+                'ptables': self.foremanapi.get_ptables()}
+
+
+    def _delete_hostgroups(self, keep=()):
         """
         Delete any currently-existing versions of the cloud environment hostgroups from the build server
+        :param keep: Titles of hostgroups to leave be
         :return:
         """
-        for hostgroup in self.hostgroups:
-            if re.match('^' + self.clouddata['name']+'/.*', hostgroup):
-                self.logger.info("Deleting hostgroup: %s" % hostgroup)
-                self.foremanapi.delete_hostgroup(self.hostgroups[hostgroup])
-        if self.clouddata['name'] in self.hostgroups:
+        def delete(hostgroup):
+            self.logger.info("Deleting hostgroup: %s" % hostgroup)
+            self.foremanapi.delete_hostgroup(self.hostgroups[hostgroup])
+            metrics.count('hostgroups_deleted')
+
+        self._in_parallel(delete, [hostgroup for hostgroup in self.hostgroups if hostgroup not in keep
+                                   and re.match('^' + self.clouddata['name']+'/.*', hostgroup)])
+        if self.clouddata['name'] in self.hostgroups and self.clouddata['name'] not in keep:
             self.logger.info("Deleting base hostgroup: %s" % self.clouddata['name'])
             self.foremanapi.delete_hostgroup(self.hostgroups[self.clouddata['name']])
+            metrics.count('hostgroups_deleted')
 
 
-    def _create_hostgroup_parameters(self, hostgroup_id, hostgroup_config):
+    def _in_parallel(self, function, items):
         """
-        Create hostgroup-specific parameters in Foreman for any listed in the hostgroup template
-        :param hostgroup_name: name of the hostgroup as it appears in foreman
-        :param hostgroup_config: hostgroup configuration
+        Call a function making Foreman writes on each of a list of items, write_workers at a time. The Foreman
+        API's adaptive limits decide how many of the writes are made at once. One call failing doesn't stop
+        the others.
+        :param function: Function taking an item
+        :param items: List of items
         :return:
         """
-        if not 'hostgroup_parameters' in hostgroup_config or hostgroup_config['hostgroup_parameters'] is None:
-            self.logger.debug("No parameters to apply for hostgroup id '{}'".format(hostgroup_id))
-            return
-
-        hostgroup_parameters = hostgroup_config['hostgroup_parameters']
-        for parameter in hostgroup_parameters:
-            self.logger.debug("Setting hostgroup '{}' param {}={}".format(hostgroup_id,
-                                                                                  parameter,
-                                                                                  hostgroup_parameters[parameter]))
-            self.foremanapi.create_hostgroup_parameter(parameter, hostgroup_id, hostgroup_parameters[parameter])
+        pending = Queue.Queue()
+        for item in items:
+            pending.put(item)
+        failures = []
+
+        def work():
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    function(item)
+                except Exception:
+                    failures.append(sys.exc_info())
+
+        workers = [threading.Thread(target=work) for i in range(max(1, min(self.write_workers, len(items))))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if failures:
+            raise failures[0][0], failures[0][1], failures[0][2]
+
+
+    def _create_hostgroup_parameters(self, hostgroup_id, parameters):
+        """
+        Create hostgroup-specific parameters in Foreman
+        :param hostgroup_id: id of the hostgroup
+        :param parameters: list of (name, value) pairs
+        :return:
+        """
+        for parameter, value in parameters:
+            self.logger.debug("Setting hostgroup '{}' param {}={}".format(hostgroup_id, parameter, value))
+            self.foremanapi.create_hostgroup_parameter(parameter, hostgroup_id, value)
 
 
-    def _apply_parameter_overrides(self, hostgroup_name, hostgroup_config):
+    def _apply_parameter_overrides(self, hostgroup_name, overrides):
         """
-        Apply any puppetclass parameter overrides associated with the hostgroup
+        Apply puppetclass parameter overrides to a hostgroup
         :param hostgroup_name: name of the hostgroup as it appears in foreman
-        :param hostgroup_config: hostgroup configuration
+        :param overrides: list of (smart class parameter id, value) pairs
         :return:
         """
-        if not 'parameterconfig' in hostgroup_config or hostgroup_config['parameterconfig'] is None:
-            self.logger.debug("No puppetclass parameters to apply for hostgroup '{}'".format(hostgroup_name))
-            return
-        hostgroup_parameters = hostgroup_config['parameterconfig']
+        for smart_class_parameter_id, value in overrides:
+            self.foremanapi.create_parameter_override(hostgroup_name, smart_class_parameter_id, value)
 
 
-        if 'puppetclasses' in hostgroup_config:
-            hostgroup_puppetclasses = hostgroup_config['puppetclasses']
-        else:
-            self.logger.warning("No puppetclasses found for hostgroup '{}'".format(hostgroup_name))
-            hostgroup_puppetclasses = []
+    def process_config(self, reload_foreman=True):
+        """
+        Build up the hostgroup configuration based on the union of hostgroup templates and
+        clouddata configuration
+        :param reload_foreman: Reload every lookup table from Foreman. Otherwise only the hostgroups are
+                               reloaded, if the tables have been loaded before.
+        :return:
+        """
 
-        # build up our list of puppetclass ids corresponding to our configured puppetclasses
-        puppetclass_ids = map(lambda puppetclass: self.puppetclasses[puppetclass], hostgroup_puppetclasses)
+        # Loading from Foreman and rendering the templates don't depend on each other, so they overlap
+        failures = []
+
+        def load():
+            try:
+                if reload_foreman or self.hostgroups is None:
+                    self._load_config_from_foreman()
+                else:
+                    self.hostgroups = self.foremanapi.get_hostgroups()
+            except Exception:
+                failures.append(sys.exc_info())
+
+        loader = threading.Thread(target=load)
+        loader.start()
+        try:
+            templates = self._hostgroup_templates()
+            documents = self._render_hostgroups(templates)
+        finally:
+            loader.join()
+        if failures:
+            raise failures[0][0], failures[0][1], failures[0][2]
 
-        # get the smart class parameters assigned against those puppetclass ids in foreman
-        smart_class_params = self.foremanapi.get_puppetclass_smart_class_parameters(puppetclass_ids)
+        final_docs = {}
+        sources = {}
+        duplicates = []
+        for (environ, fname, path), loaded_hostgroups in zip(templates, documents):
+            # For each hostgroup we've loaded, move the internal parameterconfig contents
+            # out into the base tree of the hostgroup
+            for hostgroup in loaded_hostgroups:
+                if hostgroup in sources:
+                    duplicates.append("'{}' in {} and {}".format(hostgroup, sources[hostgroup], path))
+                sources[hostgroup] = path
+                final_docs[hostgroup] = loaded_hostgroups[hostgroup]
+        if duplicates:
+            raise Exception("Hostgroups defined more than once: {}".format(', '.join(duplicates)))
 
-        for puppetclass in hostgroup_parameters:
-            for parameter in hostgroup_parameters[puppetclass]:
-                if parameter not in smart_class_params[puppetclass]['smart_class_parameters']:
-                    self.logger.warning(
-                            "Parameter '{}' not found for hostgroup '{}' in Foreman".format(parameter,hostgroup_name))
-                    raise Exception("Creating of hostgroup '{}' parameters failed.".format(hostgroup_name))
+        hostgroupconfig = {'hostgroups': final_docs}
+        CloudConfig = dict(hostgroupconfig.items() + self.clouddata.items())
+        return CloudConfig
 
-                self.foremanapi.create_parameter_override(hostgroup_name,
-                                                          smart_class_params[puppetclass]['smart_class_parameters'][parameter],
-                                                          hostgroup_parameters[puppetclass][parameter])
+
+    def _hostgroup_templates(self):
+        """
+        Find every hostgroup template
+        :return: List of (template environment, template name, path), in a stable order
+        """
+        templates = []
+        for rootdir, subdirList, fileList in os.walk(self.hostgroup_config_path):
+            subdirList.sort()
+            if rootdir not in self._environments:
+                self._environments[rootdir] = Environment(loader=FileSystemLoader(rootdir),
+                                                          bytecode_cache=self.template_cache)
+            for fname in sorted(fileList):
+                templates.append((self._environments[rootdir], fname, os.path.join(rootdir, fname)))
+        return templates
 
 
-    def process_config(self):
+    def _render_hostgroups(self, templates):
         """
-        Build up the hostgroup configuration based on the union of hostgroup templates and
-        clouddata configuration
-        :param Cloud:
-        :param Config:
+        Render and parse hostgroup templates against the clouddata, several at a time
+        :param templates: List of (template environment, template name, path)
+        :return: List of parsed hostgroup documents, in the same order as the templates
+        """
+        pending = Queue.Queue()
+        for item in enumerate(templates):
+            pending.put(item)
+        documents = [None] * len(templates)
+        errors = []
+
+        def render():
+            while True:
+                try:
+                    index, (environ, fname, path) = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                self.logger.debug("Processing file %s" % fname)
+                try:
+                    template = environ.get_template(fname)
+                    documents[index] = yamlfile.parse(template.render(cloud=self.clouddata))
+                    metrics.count('hostgroup_templates_rendered')
+                except Exception as error:
+                    errors.append("{}: {}".format(path, str(error)))
+
+        workers = [threading.Thread(target=render) for i in range(max(1, min(self.render_workers, len(templates))))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise Exception("Hostgroup templates could not be processed: {}".format('; '.join(sorted(errors))))
+        return documents
+
+
+    def plan(self, cloudconfig):
+        """
+        Compare a processed cloud configuration against the live Foreman state, without changing anything
+        :param cloudconfig: processed cloud configuration, as returned by process_config
+        :return: dict describing the hostgroups cloud_create would create, recreate and delete, and any names
+                 that would stop it
+        """
+        basehostgroup = cloudconfig['name']
+        live = dict((title, hg_id) for title, hg_id in self.hostgroups.items()
+                    if title == basehostgroup or re.match('^' + basehostgroup + '/.*', title))
+        wanted = dict((basehostgroup if hostgroup == 'Base' else basehostgroup + '/' + hostgroup, hostgroup)
+                      for hostgroup in cloudconfig['hostgroups'])
+
+        puppetclass_changes = {}
+        for title in sorted(set(wanted) & set(live)):
+            current = set(self.foremanapi.get_hostgroup_puppetclasses(live[title]))
+            configured = set(cloudconfig['hostgroups'][wanted[title]].get('puppetclasses') or [])
+            if current != configured:
+                puppetclass_changes[title] = {'add': sorted(configured - current),
+                                              'remove': sorted(current - configured)}
+
+        active_hosts = []
+        if cloudconfig['environment'] in self.environments:
+            active_hosts = self.foremanapi.get_hosts_for_environment(self.environments[cloudconfig['environment']])
+
+        unresolved = self._resolve(cloudconfig)[1]
+
+        return {'create': sorted(set(wanted) - set(live)),
+                'recreate': sorted(set(wanted) & set(live)),
+                'delete': sorted(set(live) - set(wanted)),
+                'puppetclass_changes': puppetclass_changes,
+                'hosts_to_migrate': len(active_hosts),
+                'unresolved': unresolved,
+                'config': cloudconfig}
+
+
+    def apply_plan(self, hostgroup_plan):
+        """
+        Create the cloud deployment configuration recorded in a plan, without re-rendering the hostgroup templates
+        :param hostgroup_plan: hostgroup section of a plan, as returned by plan()
         :return:
         """
-
-        # Load the current Foreman config
         self._load_config_from_foreman()
+        self.cloud_create(hostgroup_plan['config'])
 
-        final_docs = {}
-        # Iterate over each file found in the hostgroup
-        for rootdir, subdirList, fileList in os.walk(self.hostgroup_config_path):
-            environ = Environment(loader=FileSystemLoader(rootdir))
-            for fname in fileList:
 
-                self.logger.debug("Processing file %s" % fname)
+    def resolve(self, cloudconfig):
+        """
+        Resolve every name a cloud configuration refers to into Foreman ids, so it can be created without
+        any further lookups. Nothing is changed in Foreman.
+        :param cloudconfig: processed cloud configuration, as returned by process_config
+        :return: dict of the environment id and the hostgroups to create, Base first, each with the ids
+                 of its attributes, puppetclasses and parameter overrides
+        """
+        resolved, unresolved = self._resolve(cloudconfig)
+        if unresolved:
+            raise Exception("Foreman has nothing matching {} name(s) in the cloud configuration: {}".format(
+                len(unresolved), '; '.join(unresolved)))
+        return resolved
 
-                template = environ.get_template(fname)
-                loaded_hostgroups = yaml.load(template.render(cloud=self.clouddata))
 
-                # For each hostgroup we've loaded, move the internal parameterconfig contents
-                # out into the base tree of the hostgroup
-                for hostgroup in loaded_hostgroups:
-                    final_docs[hostgroup] = loaded_hostgroups[hostgroup]
+    def _resolve(self, cloudconfig):
+        """
+        Resolve a cloud configuration into Foreman ids, noting every name that can't be
+        :param cloudconfig: processed cloud configuration
+        :return: (resolved configuration, list of descriptions of the names that couldn't be resolved)
+        """
+        # Verify we loaded a Base hostgroup, which is mandatory
+        if 'Base' not in cloudconfig['hostgroups']:
+            self.logger.error("Missing mandatory Base hostgroup (check for a Base configuration file in {})".format(self.hostgroup_config_path))
+            raise Exception("Cloud configuration read error.")
 
-        hostgroupconfig = {'hostgroups': final_docs}
-        CloudConfig = dict(hostgroupconfig.items() + self.clouddata.items())
-        return CloudConfig
+        unresolved = []
+
+        def lookup(table, kind, name, where):
+            if name is None:
+                return None
+            if table.get(name) is None:
+                unresolved.append("{} '{}' ({})".format(kind, name, where))
+                return None
+            return table[name]
+
+        def setting(key):
+            if key not in cloudconfig:
+                unresolved.append("clouddata setting '{}'".format(key))
+            return cloudconfig.get(key)
+
+        base_attributes = {}
+        for attribute, key, table in BASE_ATTRIBUTES:
+            base_attributes[attribute] = lookup(getattr(self, table), key, setting(key), 'clouddata')
+        proxy = lookup(self.proxyfeatures, 'smart proxy', setting('buildserver'), 'clouddata')
+        base_attributes['puppet_proxy'] = base_attributes['puppet_ca'] = proxy['id'] if proxy else None
+
+        basehostgroup = cloudconfig['name']
+        # We'll treat all hostgroups as a child of 'Base', but..
+        # ..TODO: maybe infer parental hierachy based on directory structure of hostgroup files instead?
+        names = ['Base'] + sorted(hostgroup for hostgroup in cloudconfig['hostgroups'] if hostgroup != 'Base')
+        hostgroups = []
+        for hostgroup in names:
+            hostgroup_config = cloudconfig['hostgroups'][hostgroup] or {}
+            title = basehostgroup if hostgroup == 'Base' else basehostgroup + '/' + hostgroup
+            puppetclasses = hostgroup_config.get('puppetclasses') or []
+            parameterconfig = hostgroup_config.get('parameterconfig') or {}
+            if parameterconfig and not puppetclasses:
+                self.logger.warning("No puppetclasses found for hostgroup '{}'".format(title))
+            for puppetclass in sorted(set(parameterconfig) - set(puppetclasses)):
+                unresolved.append("puppetclass '{}' with parameters, but not assigned to the hostgroup ({})".format(
+                    puppetclass, title))
+            hostgroups.append({'name': basehostgroup if hostgroup == 'Base' else hostgroup,
+                               'title': title,
+                               'attributes': base_attributes if hostgroup == 'Base' else {},
+                               'puppetclass_ids': [lookup(self.puppetclasses, 'puppetclass', puppetclass, title)
+                                                   for puppetclass in puppetclasses],
+                               'parameterconfig': parameterconfig,
+                               'parameters': sorted((hostgroup_config.get('hostgroup_parameters') or {}).items())})
+
+        # Smart class parameters are looked up once for every puppetclass that has overrides, whichever hostgroups use it
+        overridden = set(puppetclass for hostgroup in hostgroups for puppetclass in hostgroup['parameterconfig']
+                         if self.puppetclasses.get(puppetclass) is not None)
+        smart_class_params = {}
+        if overridden:
+            smart_class_params = self.foremanapi.get_puppetclass_smart_class_parameters(
+                sorted(self.puppetclasses[puppetclass] for puppetclass in overridden))
+
+        for hostgroup in hostgroups:
+            parameterconfig = hostgroup.pop('parameterconfig')
+            overrides = []
+            for puppetclass in sorted(parameterconfig):
+                if puppetclass not in overridden:
+                    continue
+                parameters = smart_class_params.get(puppetclass, {}).get('smart_class_parameters', {})
+                for parameter in sorted(parameterconfig[puppetclass] or {}):
+                    overrides.append((lookup(parameters, 'smart class parameter', parameter,
+                                             '{}, {}'.format(puppetclass, hostgroup['title'])),
+                                      parameterconfig[puppetclass][parameter]))
+            hostgroup['overrides'] = overrides
+
+        return {'environment_id': base_attributes['environment_id'], 'hostgroups': hostgroups}, unresolved
+
+
+    def _completed_hostgroups(self, resolved, config):
+        """
+        Find the hostgroups the journal shows were completely built from the same configuration, and which
+        Foreman still has as they were built
+        :param resolved: resolved configuration, as returned by resolve
+        :param config: fingerprint of the resolved configuration
+        :return: dict of title to id of the completed hostgroups
+        """
+        completed = {}
+        if self.journal is None:
+            return completed
+        for hostgroup in resolved['hostgroups']:
+            entry = self.journal.find('hostgroup', config=config, title=hostgroup['title'])
+            if entry is not None and self.hostgroups.get(hostgroup['title']) == entry['id']:
+                completed[hostgroup['title']] = entry['id']
+            elif not completed:
+                # the children of a base hostgroup being rebuilt have to be rebuilt with it
+                return completed
+        return completed
+
+
+    def _hosts_to_restore(self, active_hosts, environment_id):
+        """
+        Work out which hosts to reassign to their hostgroups once they're rebuilt, including any that the
+        journal shows were cleared by a run that failed before reassigning them
+        :param active_hosts: hosts of the environment
+        :param environment_id: id of the environment
+        :return: list of hosts, each with its id, name and hostgroup_name
+        """
+        restore = [dict((key, host[key]) for key in ('id', 'name', 'hostgroup_name'))
+                   for host in active_hosts if 'hostgroup_name' in host]
+        if self.journal is not None:
+            recorded = self.journal.find('hosts', environment_id=environment_id)
+            if recorded is not None:
+                seen = set(host['id'] for host in restore)
+                restore.extend(host for host in recorded['hosts'] if host['id'] not in seen)
+            # recorded before any host is cleared, so a failure part way through still knows where they belong
+            self.journal.record('hosts', environment_id=environment_id, hosts=restore)
+        return restore
 
 
     def cloud_create(self, cloudconfig):
         """
-        Create the cloud deployment configuration within foreman
+        Create the cloud deployment configuration within foreman. Every name in the configuration is resolved
+        before anything is changed, so a configuration Foreman can't satisfy leaves the existing hostgroups be.
+        With a journal, each hostgroup is recorded as it's completed, and hostgroups the journal of a failed
+        run shows were completed from the same configuration are kept rather than rebuilt.
         :param cloudconfig:
         :return:
         """
-
-        # Check if our environment already exists, if so, get its ID
-        if not cloudconfig['environment'] in self.environments:
-            raise Exception("No cloud environment with name %s exists. Import it into Foreman first."
-                            % cloudconfig['environment'])
-        environment_id = self.environments[cloudconfig['environment']]
-        if environment_id is None:
-            raise Exception("Could not find environment ID associated with environment %s." % cloudconfig['environment'])
-
-        # If an environment did exist, check if any hosts in a hostgroup need to be temporarily migrated out
-        active_hosts = self.foremanapi.get_hosts_for_environment(environment_id)
-        for host in active_hosts:
+        resolved = self.resolve(cloudconfig)
+        config = runjournal.fingerprint(resolved)
+        completed = self._completed_hostgroups(resolved, config)
+        if completed:
+            self.logger.info("Keeping {} hostgroup(s) completed by the run being resumed".format(len(completed)))
+            metrics.count('hostgroups_resumed', len(completed))
+            if (len(completed) == len(resolved['hostgroups'])
+                    and self.journal.find('hosts_restored', config=config) is not None):
+                return
+
+        # Check if any hosts in a hostgroup of the environment need to be temporarily migrated out
+        active_hosts = self.foremanapi.get_hosts_for_environment(resolved['environment_id'])
+        restore = self._hosts_to_restore(active_hosts, resolved['environment_id'])
+        # hosts of hostgroups being kept stay where they are
+        untouched = set(host['id'] for host in active_hosts if host.get('hostgroup_name') in completed)
+
+        def clear(host):
             # We have hosts to temporarily migrate out prior to deletion
             self.logger.debug("Temporarily clearing hostgroup of host %s" % host['name'])
             hostid =  host['id']
@@ -174,60 +543,42 @@ class Foreman:
                 self.logger.error("Unable to clear hostgroup for host %s: %s" %
                                           (host['name'], json.dumps(result['error'])))
 
-        # Delete currently-existing hostgroups, they'll be recreated in the next step
-        self._delete_hostgroups()
-
-        # Create the base hostgroup
-        basehostgroup = cloudconfig['name']
-
-        # Verify we loaded a Base hostgroup, which is mandatory
-        if 'Base' not in cloudconfig['hostgroups']:
-            self.logger.error("Missing mandatory Base hostgroup (check for a Base configuration file in %s".format(self.hostgroup_config_path))
-            raise Exception("Cloud configuration read error.")
+        self._in_parallel(clear, [host for host in active_hosts if host['id'] not in untouched])
 
-        basepuppetclass_ids = map(lambda basepuppetclass: self.puppetclasses[basepuppetclass], cloudconfig['hostgroups']['Base']['puppetclasses'])
-        self.logger.info("Creating the Base Hostgroup: %s" % basehostgroup)
-
-        cloud_hostgroup = self.foremanapi.create_hostgroup(name=basehostgroup,
-                                                      environment_id=self.environments[cloudconfig['environment']],
-                                                      domain_id=self.domains[cloudconfig['domain']],
-                                                      subnet_id=self.subnets[cloudconfig['subnet']],
-                                                      realm_id=self.realms[cloudconfig['realm']],
-                                                      architecture_id=self.architectures[cloudconfig['architecture']],
-                                                      operatingsystem_id=self.operatingsystems[cloudconfig['operatingsystem']],
-                                                      media_id=self.media[cloudconfig['media']],
-                                                      ptable_id=self.ptables[cloudconfig['ptable']],
-                                                      puppet_proxy=self.proxyfeatures[cloudconfig['buildserver']]['id'],
-                                                      puppet_ca=self.proxyfeatures[cloudconfig['buildserver']]['id'],
-                                                      puppetclass_ids=basepuppetclass_ids)
-        parent = cloud_hostgroup['id']
-        # apply the smart class parameter overrides for the base hostgroup
-        self.logger.debug("Applying the parameter overrides for Hostgroup %s" % basehostgroup)
-        self._apply_parameter_overrides(cloudconfig['name'], cloudconfig['hostgroups']['Base'])
-        self._create_hostgroup_parameters(parent, cloudconfig['hostgroups']['Base'])
-
-        # We'll treat all hostgroups as a child of 'Base', but..
-        # ..TODO: maybe infer parental hierachy based on directory structure of hostgroup files instead?
-        child_hostgroups = {hostgroup: cloudconfig['hostgroups'][hostgroup] for hostgroup in cloudconfig['hostgroups'] if hostgroup != 'Base'}
-        for hostgroup in child_hostgroups:
-            puppetclass_ids = map(lambda puppetclass: self.puppetclasses[puppetclass], child_hostgroups[hostgroup]['puppetclasses'])
+        # Delete currently-existing hostgroups, they'll be recreated in the next step
+        self._delete_hostgroups(keep=completed)
 
-            # Create the child hostgroups
-            fullhostgroupname = basehostgroup+'/'+hostgroup
-            self.logger.info("Creating Hostgroup: %s" % fullhostgroupname)
-            child_hostgroup = self.foremanapi.create_hostgroup(name=hostgroup,
-                                  parent_id=parent,
-                                  puppetclass_ids=puppetclass_ids)
+        def create(hostgroup, parent):
+            self.logger.info("Creating Hostgroup: %s" % hostgroup['title'])
+            created = self.foremanapi.create_hostgroup(name=hostgroup['name'],
+                                                       parent_id=parent,
+                                                       puppetclass_ids=hostgroup['puppetclass_ids'],
+                                                       **hostgroup['attributes'])
+            metrics.count('hostgroups_created')
 
             # apply the smart class parameter overrides
-            self.logger.debug("Applying the parameter overrides for Hostgroup %s/%s" % (cloudconfig['name'], hostgroup))
-            self._apply_parameter_overrides(fullhostgroupname, child_hostgroups[hostgroup])
-            self._create_hostgroup_parameters(child_hostgroup['id'], child_hostgroups[hostgroup])
+            self.logger.debug("Applying the parameter overrides for Hostgroup %s" % hostgroup['title'])
+            self._apply_parameter_overrides(hostgroup['title'], hostgroup['overrides'])
+            self._create_hostgroup_parameters(created['id'], hostgroup['parameters'])
+            if self.journal is not None:
+                self.journal.record('hostgroup', config=config, title=hostgroup['title'], id=created['id'])
+            return created['id']
+
+        # Create the base hostgroup, then its children alongside each other
+        base = resolved['hostgroups'][0]
+        parent = completed.get(base['title'])
+        if parent is None:
+            parent = create(base, None)
+        self._in_parallel(lambda hostgroup: create(hostgroup, parent),
+                          [hostgroup for hostgroup in resolved['hostgroups'][1:] if hostgroup['title'] not in completed])
 
         # Lastly we want to reassign any previously-assigned hosts back to their rightful hostgroup
-        for host in active_hosts:
+        def restore_host(host):
             # Foreman seems to be smart enough to assign the correct hostgroup id if we supply just the name, so
             # we don't need to do any id lookup
-            if 'hostgroup_name' in host:
-                self.logger.debug("Restoring hostgroup of host %s to %s" % (host['name'], host['hostgroup_name']))
-                self.foremanapi.set_hostgroup(host['id'], hostgroup_name=host['hostgroup_name'])
+            self.logger.debug("Restoring hostgroup of host %s to %s" % (host['name'], host['hostgroup_name']))
+            self.foremanapi.set_hostgroup(host['id'], hostgroup_name=host['hostgroup_name'])
+
+        self._in_parallel(restore_host, [host for host in restore if host['id'] not in untouched])
+        if self.journal is not None:
+            self.journal.record('hosts_restored', config=config)
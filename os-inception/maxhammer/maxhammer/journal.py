@@ -0,0 +1,132 @@
+"""
+Run journals, recording the work a run has completed so a run that fails part way can be resumed.
+
+A journal is one JSON document per line: a header line, then one line per completed piece of work, each
+written and flushed as the work completes so the journal survives the run dying. Entries carry fingerprints
+of what the work was done from, so a resumed run only skips work done from the same inputs, and only once
+it has verified the work is still in place.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+# Bumped whenever entries are recorded differently, so older journals are never resumed from
+JOURNAL_VERSION = 1
+
+# Directory journals are kept in, one per branch
+DEFAULT_JOURNAL_DIR = '~/.cache/maxhammer/journals'
+
+
+def fingerprint(*values):
+    """
+    Fingerprint what a piece of work is done from
+    :param values: JSON-serializable values
+    :return: Hex digest
+    """
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str)).hexdigest()
+
+
+def journal_path(journal_dir, branch):
+    """
+    Path of a branch's journal
+    :param journal_dir: Directory journals are kept in
+    :param branch: Name of the branch
+    :return: Path of the journal
+    """
+    return os.path.join(os.path.expanduser(journal_dir), '{}.journal'.format(branch))
+
+
+class Journal:
+    """
+    Records the work of a run as it completes, optionally carrying on from the journal of an earlier run
+    """
+
+    def __init__(self, path, resume=False, logger=None):
+        """
+        :param path: Path of the journal
+        :param resume: Keep the entries of the journal already at path, for find() to look up. Otherwise
+                       the journal is started afresh.
+        """
+        self.path = path
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._entries = self._read() if resume else []
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # rewritten rather than appended to, so a line cut short by the last run dying is dropped
+        self._fh = open(path, 'w')
+        self._write({'op': 'journal', 'version': JOURNAL_VERSION})
+        for entry in self._entries:
+            self._write(entry)
+
+    def _read(self):
+        """
+        Read the entries of the journal at path
+        :return: List of entries, empty if there's no journal or it can't be resumed from
+        """
+        try:
+            with open(self.path) as fh:
+                lines = fh.read().split('\n')
+        except IOError:
+            self.logger.warning("No journal to resume from at {}, starting afresh".format(self.path))
+            return []
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get('version') != JOURNAL_VERSION:
+            self.logger.warning("Journal {} can't be resumed from, starting afresh".format(self.path))
+            return []
+
+        entries = []
+        for line in lines[1:]:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # the run died while writing this line
+                break
+        return entries
+
+    def _write(self, entry):
+        self._fh.write(json.dumps(entry, sort_keys=True, default=str) + '\n')
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def find(self, op, **fields):
+        """
+        Find the latest entry recording an operation
+        :param op: Operation recorded
+        :param fields: Fields the entry must have, with these values
+        :return: Entry, or None if there's none
+        """
+        with self._lock:
+            for entry in reversed(self._entries):
+                if entry.get('op') == op and all(entry.get(key) == value for key, value in fields.items()):
+                    return entry
+        return None
+
+    def record(self, op, **fields):
+        """
+        Record an operation as completed
+        :param op: Operation completed
+        :param fields: Details of the operation
+        :return:
+        """
+        entry = dict(fields, op=op)
+        with self._lock:
+            self._write(entry)
+            self._entries.append(json.loads(json.dumps(entry, default=str)))
+
+    def close(self, completed=False):
+        """
+        Close the journal
+        :param completed: The run completed, so there's nothing to resume and the journal is removed
+        :return:
+        """
+        self._fh.close()
+        if completed:
+            os.remove(self.path)
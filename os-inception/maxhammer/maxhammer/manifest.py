@@ -0,0 +1,208 @@
+"""
+Merkle manifests of delivered trees.
+
+A manifest records every directory and file of a tree by relative path, as its kind, mode and hash. A file's
+hash is of its content; a directory's is of its mode and its entries, so the root hash covers the whole tree
+and two trees with the same root hash are the same. Manifests are kept beside the destination they describe,
+as .<name>.mh-manifest, with the root hash on the first line so it can be read back on its own.
+"""
+import hashlib
+import json
+import os
+import pipes
+import stat
+from maxhammer import fileutil
+
+# Bumped whenever hashes are worked out differently, so older manifests never match
+MANIFEST_VERSION = 1
+
+
+def manifest_path(path):
+    """
+    Path of the manifest of a destination
+    :param path: Destination directory
+    :return: Path of the manifest beside it
+    """
+    parent, name = os.path.split(path.rstrip('/'))
+    return os.path.join(parent, '.{}.mh-manifest'.format(name))
+
+
+def build(path):
+    """
+    Build the manifest of a local tree, following symlinks as delivery does. File contents are hashed in
+    parallel, and only if they changed since they were last hashed.
+    :param path: Directory to build the manifest of
+    :return: Dict of the tree's root hash and its entries, relative path to [kind, mode, hash], the kind
+             being 'd' for a directory and 'f' for a file
+    """
+    listings = {}
+    files = []
+
+    def scan(reldir):
+        listing = listings[reldir] = []
+        for name in sorted(os.listdir(os.path.join(path, reldir))):
+            relpath = os.path.join(reldir, name)
+            st = os.stat(os.path.join(path, relpath))
+            is_dir = stat.S_ISDIR(st.st_mode)
+            listing.append((name, relpath, is_dir, stat.S_IMODE(st.st_mode)))
+            if is_dir:
+                scan(relpath)
+            else:
+                files.append(relpath)
+
+    scan('')
+    digests = fileutil.DIGESTS.digests([os.path.join(path, relpath) for relpath in files])
+    entries = {}
+
+    def directory_hash(reldir, mode):
+        lines = ['{:o}\n'.format(mode)]
+        for name, relpath, is_dir, mode in listings[reldir]:
+            if is_dir:
+                entry = ['d', mode, directory_hash(relpath, mode)]
+            else:
+                entry = ['f', mode, digests[os.path.join(path, relpath)]]
+            entries[relpath] = entry
+            lines.append('{} {:o} {} {}\n'.format(entry[0], mode, entry[2], name))
+        return hashlib.sha1(''.join(lines)).hexdigest()
+
+    root = directory_hash('', stat.S_IMODE(os.stat(path).st_mode))
+    return {'root': '{} {}'.format(MANIFEST_VERSION, root), 'entries': entries}
+
+
+def _children(entries):
+    children = {}
+    for relpath in entries:
+        children.setdefault(os.path.dirname(relpath), []).append(relpath)
+    return children
+
+
+def diff(built, previous):
+    """
+    Work out what differs between a built tree and the tree a previous manifest describes, descending only
+    into directories whose hashes differ
+    :param built: Manifest of the built tree
+    :param previous: Manifest of the destination
+    :return: Dict of the paths to send, directories and files that are new or changed, and the paths to delete,
+             those gone from the built tree or replaced by an entry of another kind
+    """
+    built_entries, previous_entries = built['entries'], previous['entries']
+    built_children, previous_children = _children(built_entries), _children(previous_entries)
+    changes = {'changed': [], 'deleted': []}
+
+    def descend(reldir):
+        for relpath in sorted(built_children.get(reldir, [])):
+            entry = built_entries[relpath]
+            old = previous_entries.get(relpath)
+            if old == entry:
+                continue
+            if old is not None and old[0] != entry[0]:
+                changes['deleted'].append(relpath)
+                old = None
+            if entry[0] == 'f' or old is None or old[1] != entry[1]:
+                changes['changed'].append(relpath)
+            if entry[0] == 'd':
+                descend(relpath)
+        for relpath in sorted(previous_children.get(reldir, [])):
+            if relpath not in built_entries:
+                changes['deleted'].append(relpath)
+
+    if built['root'] != previous['root']:
+        descend('')
+    return changes
+
+
+def _dumps(manifest):
+    return '{}\n{}\n'.format(manifest['root'], json.dumps(manifest['entries'], sort_keys=True))
+
+
+def _loads(data):
+    root, _, entries = data.partition('\n')
+    return {'root': root, 'entries': json.loads(entries)}
+
+
+def read_root(path):
+    """
+    Read the root hash of a local destination's manifest
+    :param path: Destination directory
+    :return: Root hash, or None if the destination or its manifest is missing
+    """
+    if not os.path.isdir(path):
+        return None
+    try:
+        with open(manifest_path(path)) as fh:
+            return fh.readline().strip() or None
+    except IOError:
+        return None
+
+
+def load(path):
+    """
+    Load a local destination's manifest
+    :return: Manifest, or None if there isn't one
+    """
+    try:
+        with open(manifest_path(path)) as fh:
+            return _loads(fh.read())
+    except (IOError, ValueError):
+        return None
+
+
+def remove(path):
+    """
+    Remove a local destination's manifest, before changing the destination
+    """
+    if os.path.lexists(manifest_path(path)):
+        os.remove(manifest_path(path))
+
+
+def save(path, manifest):
+    """
+    Save the manifest of what was delivered to a local destination
+    """
+    temp_path = manifest_path(path) + '.tmp'
+    with open(temp_path, 'w') as fh:
+        fh.write(_dumps(manifest))
+    os.rename(temp_path, manifest_path(path))
+
+
+def read_remote_root(connections, dest_cfg, path):
+    """
+    Read the root hash of a remote destination's manifest with a single remote command
+    :param connections: connection.ConnectionPool to run the command over
+    :param dest_cfg: distribution.Destination to read from
+    :param path: Remote destination directory
+    :return: Root hash, or None if the destination or its manifest is missing
+    """
+    command = '[ -d {} ] && head -n 1 {} 2>/dev/null || true'.format(pipes.quote(path),
+                                                                     pipes.quote(manifest_path(path)))
+    rc, stdout, stderr = connections.exec_command(dest_cfg, command)
+    if rc:
+        raise Exception("Unable to read the manifest of {}:{}: {}".format(dest_cfg.host(), path, stderr.strip()))
+    return stdout.strip() or None
+
+
+def take_remote(connections, dest_cfg, path):
+    """
+    Read a remote destination's manifest and remove it in the same command, before changing the destination,
+    so an interrupted delivery is never taken for a complete one
+    :return: Manifest, or None if there isn't one
+    """
+    command = 'cat {0} 2>/dev/null && rm -f {0} || true'.format(pipes.quote(manifest_path(path)))
+    rc, stdout, stderr = connections.exec_command(dest_cfg, command)
+    if rc:
+        raise Exception("Unable to read the manifest of {}:{}: {}".format(dest_cfg.host(), path, stderr.strip()))
+    try:
+        return _loads(stdout) if stdout else None
+    except ValueError:
+        return None
+
+
+def save_remote(connections, dest_cfg, path, manifest):
+    """
+    Save the manifest of what was delivered to a remote destination
+    """
+    target = pipes.quote(manifest_path(path))
+    command = 'cat > {0}.tmp && mv -f {0}.tmp {0}'.format(target)
+    rc, stdout, stderr = connections.exec_command(dest_cfg, command, stdin=_dumps(manifest))
+    if rc:
+        raise Exception("Unable to save the manifest of {}:{}: {}".format(dest_cfg.host(), path, stderr.strip()))
@@ -0,0 +1,168 @@
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+
+
+def _format_scope(scope):
+    return ' '.join('{}={}'.format(k, v) for k, v in scope)
+
+
+def _format_amount(name, amount):
+    if name.startswith('bytes'):
+        for unit in ['B', 'KiB', 'MiB']:
+            if amount < 1024:
+                return '{:.1f} {}'.format(amount, unit) if unit != 'B' else '{} B'.format(amount)
+            amount /= 1024.0
+        return '{:.1f} GiB'.format(amount)
+    return str(amount)
+
+
+class Metrics:
+    """
+    Thread-safe timers and counters for a run. Each measurement is named and scoped, for instance by
+    phase, module or destination, and measurements with the same name and scope are aggregated.
+    """
+
+    def __init__(self):
+        self._timers = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _key(self, name, scope):
+        return (name, tuple(sorted((k, v) for k, v in scope.items() if v is not None)))
+
+    def add_time(self, name, seconds, **scope):
+        """
+        Record time spent
+        :param name: What the time was spent on
+        :param seconds: Time spent
+        :param scope: Keyword arguments scoping the measurement, e.g. module='overcloud'
+        :return:
+        """
+        key = self._key(name, scope)
+        with self._lock:
+            timer = self._timers.setdefault(key, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **scope):
+        """
+        Time a block of code, whether or not it succeeds
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - started, **scope)
+
+    def count(self, name, amount=1, **scope):
+        """
+        Add to a counter
+        :param name: What is being counted
+        :param amount: Amount to add
+        :param scope: Keyword arguments scoping the measurement
+        :return:
+        """
+        key = self._key(name, scope)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def report(self):
+        """
+        All measurements so far
+        :return: Dict of timer and counter lists
+        """
+        with self._lock:
+            timers = [{'name': name, 'scope': dict(scope), 'calls': calls, 'seconds': round(seconds, 6)}
+                      for (name, scope), (calls, seconds) in sorted(self._timers.items())]
+            counters = [{'name': name, 'scope': dict(scope), 'value': value}
+                        for (name, scope), value in sorted(self._counters.items())]
+        return {'timers': timers, 'counters': counters}
+
+    def summary(self):
+        """
+        Human-readable summary of the measurements so far
+        :return: List of lines
+        """
+        with self._lock:
+            timers = sorted(self._timers.items(), key=lambda item: -item[1][1])
+            counters = sorted(self._counters.items())
+
+        lines = ['Timings:']
+        for (name, scope), (calls, seconds) in timers:
+            lines.append('  {:>9.3f}s {:>6}x  {} {}'.format(seconds, calls, name, _format_scope(scope)).rstrip())
+        lines.append('Counters:')
+        for (name, scope), value in counters:
+            lines.append('  {:>12}  {} {}'.format(_format_amount(name, value), name, _format_scope(scope)).rstrip())
+        return lines
+
+    def save(self, path, **extra):
+        """
+        Save the measurements as a JSON report
+        :param path: File to save to
+        :param extra: Further sections to add to the report
+        :return:
+        """
+        report = self.report()
+        report.update(extra)
+        with open(path, 'w') as stream:
+            json.dump(report, stream, indent=2, sort_keys=True)
+
+    def reset(self):
+        with self._lock:
+            self._timers = {}
+            self._counters = {}
+
+
+class Profiler:
+    """
+    cProfile profiling of a whole run, including the threads it starts
+    """
+
+    def __init__(self):
+        self._main = cProfile.Profile()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _profile_thread(self, frame, event, arg):
+        # called on a new thread's first profiling event, hands over to a profiler of its own
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self._lock:
+            self._threads.append(profile)
+        profile.enable()
+
+    def start(self):
+        threading.setprofile(self._profile_thread)
+        self._main.enable()
+
+    def stop(self, path):
+        """
+        Stop profiling and write the combined statistics
+        :param path: File to write pstats-format statistics to
+        :return:
+        """
+        self._main.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(self._main)
+        with self._lock:
+            for profile in self._threads:
+                stats.add(profile)
+        stats.dump_stats(path)
+
+
+# Measurements of the current run
+RUN = Metrics()
+
+
+def timer(name, **scope):
+    return RUN.timer(name, **scope)
+
+
+def count(name, amount=1, **scope):
+    RUN.count(name, amount, **scope)
@@ -0,0 +1,185 @@
+import json
+import os
+import pipes
+import stat
+from maxhammer import fileutil
+
+# Remote command listing mode, size and sha1 of every file beneath the current directory
+REMOTE_SNAPSHOT = ("find . -type f -printf '%m %s %P\\n'; echo --; "
+                   "find . -type f -exec sha1sum {} +")
+
+
+def local_snapshot(path):
+    """
+    Snapshot the files in a local tree
+    :param path: Directory to snapshot
+    :return: Dict of relative path to (size, mode, sha1), empty if the directory doesn't exist
+    """
+    stats = {}
+    for root, dirs, files in os.walk(path, followlinks=True):
+        for f in files:
+            filepath = os.path.join(root, f)
+            stats[filepath] = os.stat(filepath)
+    digests = fileutil.DIGESTS.digests(stats.keys())
+    return dict((os.path.relpath(filepath, path), (st.st_size, stat.S_IMODE(st.st_mode), digests[filepath]))
+                for filepath, st in stats.items())
+
+
+def remote_snapshot(connections, dest_cfg, path):
+    """
+    Snapshot the files in a remote tree with a single remote command
+    :param connections: connection.ConnectionPool to run the command over
+    :param dest_cfg: distribution.Destination to snapshot
+    :param path: Remote directory to snapshot
+    :return: Dict of relative path to (size, mode, sha1), empty if the directory doesn't exist
+    """
+    command = 'cd {} 2>/dev/null || exit 0; {}'.format(pipes.quote(path), REMOTE_SNAPSHOT)
+    rc, stdout, stderr = connections.exec_command(dest_cfg, command)
+    if rc:
+        raise Exception("Unable to list remote destination {}:{}: {}".format(dest_cfg.host(), path, stderr.strip()))
+
+    listing, _, digests = stdout.partition('--\n')
+    attrs = {}
+    for line in listing.splitlines():
+        mode, size, relpath = line.split(' ', 2)
+        attrs[relpath] = (int(size), int(mode, 8))
+
+    snapshot = {}
+    for line in digests.splitlines():
+        digest, relpath = line.split('  ', 1)
+        relpath = os.path.normpath(relpath)
+        if relpath in attrs:
+            snapshot[relpath] = attrs[relpath] + (digest,)
+    return snapshot
+
+
+def diff_snapshots(built, current, deletes=True):
+    """
+    Work out what delivering a built tree over a current one would change
+    :param built: Snapshot of the newly built tree
+    :param current: Snapshot of the destination
+    :param deletes: Whether delivery removes files missing from the built tree
+    :return: Dict of added, updated and deleted paths and the bytes that would be written
+    """
+    added = sorted(p for p in built if p not in current)
+    updated = sorted(p for p in built if p in current and built[p] != current[p])
+    deleted = sorted(p for p in current if p not in built) if deletes else []
+    return {'add': added,
+            'update': updated,
+            'delete': deleted,
+            'bytes': sum(built[p][0] for p in added + updated)}
+
+
+def _format_bytes(count):
+    for unit in ['B', 'KiB', 'MiB']:
+        if count < 1024:
+            return '{:.1f} {}'.format(count, unit) if unit != 'B' else '{} B'.format(count)
+        count /= 1024.0
+    return '{:.1f} GiB'.format(count)
+
+
+class Plan:
+    """
+    The changes a maxhammer run would make: Foreman hostgroups and per-destination file transfers
+    """
+
+    def __init__(self, branch=None, build_root=None):
+        """
+        :param branch: Branch the plan was computed for
+        :param build_root: Directory holding the rendered trees the transfers would deliver
+        :return:
+        """
+        self.branch = branch
+        self.build_root = build_root
+        self.hostgroups = None
+        self.transfers = []
+
+    def add_transfer(self, module, source, destination, path, method, build_dir, diff):
+        """
+        Record a transfer of a rendered module source to a destination
+        :param destination: 'local', or the clouddata alias of a remote destination
+        :param method: How the tree is delivered: 'local', 'rsync' or 'tar'
+        :param build_dir: Rendered tree to deliver
+        :param diff: Changes at the destination, as returned by diff_snapshots
+        :return:
+        """
+        self.transfers.append({'module': module,
+                               'source': source,
+                               'destination': destination,
+                               'path': path,
+                               'method': method,
+                               'build_dir': build_dir,
+                               'changes': diff})
+
+    def has_changes(self, transfer):
+        changes = transfer['changes']
+        return bool(changes['add'] or changes['update'] or changes['delete'])
+
+    def summary(self):
+        """
+        Human-readable summary of the plan
+        :return: List of lines
+        """
+        lines = ['Change plan{}:'.format(' for branch ' + self.branch if self.branch else '')]
+
+        if self.hostgroups is not None:
+            hg = self.hostgroups
+            lines.append('  Foreman: {} hostgroups to create, {} to recreate, {} to delete, {} hosts to migrate'.format(
+                len(hg['create']), len(hg['recreate']), len(hg['delete']), hg['hosts_to_migrate']))
+            for title in hg['create']:
+                lines.append('    + {}'.format(title))
+            for title in hg['delete']:
+                lines.append('    - {}'.format(title))
+            for title in sorted(hg['puppetclass_changes']):
+                change = hg['puppetclass_changes'][title]
+                lines.append('    ~ {}: puppetclasses +{} -{}'.format(title, len(change['add']), len(change['remove'])))
+            for name in hg.get('unresolved', []):
+                lines.append('    ! unknown to Foreman: {}'.format(name))
+
+        files = 0
+        total_bytes = 0
+        changed = 0
+        for transfer in self.transfers:
+            changes = transfer['changes']
+            if not self.has_changes(transfer):
+                lines.append('  {module} ({source}) -> {destination}:{path}: no changes'.format(**transfer))
+                continue
+            changed += 1
+            files += len(changes['add']) + len(changes['update']) + len(changes['delete'])
+            total_bytes += changes['bytes']
+            lines.append('  {} ({}) -> {}:{}: +{} ~{} -{} ({})'.format(
+                transfer['module'], transfer['source'], transfer['destination'], transfer['path'],
+                len(changes['add']), len(changes['update']), len(changes['delete']), _format_bytes(changes['bytes'])))
+
+        lines.append('  Total: {} of {} transfers with changes, {} files, {}'.format(
+            changed, len(self.transfers), files, _format_bytes(total_bytes)))
+        return lines
+
+    def save(self, path):
+        """
+        Save the plan as JSON
+        :param path: File to save to
+        :return:
+        """
+        with open(path, 'w') as stream:
+            json.dump({'branch': self.branch,
+                       'build_root': self.build_root,
+                       'hostgroups': self.hostgroups,
+                       'transfers': self.transfers}, stream, indent=2, default=str)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a plan saved by save()
+        :param path: File to load from
+        :return: Plan
+        """
+        try:
+            with open(path, 'r') as stream:
+                data = json.load(stream)
+        except (IOError, ValueError) as error:
+            raise Exception("Plan file could not be read ({}): {}".format(path, str(error)))
+        plan = cls(branch=data.get('branch'), build_root=data.get('build_root'))
+        plan.hostgroups = data.get('hostgroups')
+        plan.transfers = data.get('transfers', [])
+        return plan
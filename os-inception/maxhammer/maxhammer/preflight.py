@@ -0,0 +1,165 @@
+import errno
+import os
+import pipes
+import socket
+import tempfile
+import threading
+import paramiko
+
+# Remote shell function that probes a destination path for writability and reports its free space
+REMOTE_PROBE = ('probe() { if mkdir -p "$1" 2>/dev/null && t=$(mktemp "$1/.mh-probe.XXXXXX" 2>/dev/null); then '
+                'rm -f "$t"; echo "ok $(df -Pk "$1" | awk \'NR==2 {print $4}\')"; '
+                'else echo unwritable; fi; }; ')
+
+
+def run_concurrently(checks):
+    """
+    Run a set of checks at the same time, one thread per check
+    :param checks: List of callables, each returning a list of failure messages
+    :return: List of all failure messages
+    """
+    failures = []
+    lock = threading.Lock()
+
+    def run(check):
+        try:
+            result = check()
+        except Exception as error:
+            result = [str(error)]
+        with lock:
+            failures.extend(result)
+
+    threads = [threading.Thread(target=run, args=(check,)) for check in checks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failures
+
+
+class Preflight:
+    """
+    Pre-flight checks of distribution destinations: connectivity, authentication, writability and free space
+    """
+
+    def __init__(self, connections, logger):
+        """
+        :param connections: connection.ConnectionPool that remote checks connect through. Connections
+                            stay open in the pool for the distribution that follows.
+        :return:
+        """
+        self.connections = connections
+        self.logger = logger
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def tree_size(self, paths):
+        """
+        Total size of the files under a set of paths, an upper bound on what delivering them needs
+        :param paths: List of source paths
+        :return: Size in bytes
+        """
+        total = 0
+        for path in paths:
+            with self._lock:
+                size = self._sizes.get(path)
+            if size is None:
+                size = 0
+                for root, dirs, files in os.walk(path):
+                    for f in files:
+                        try:
+                            size += os.lstat(os.path.join(root, f)).st_size
+                        except OSError:
+                            pass
+                with self._lock:
+                    self._sizes[path] = size
+            total += size
+        return total
+
+    def check_local(self, module, local_path, sources):
+        """
+        Check a local destination can be created and written to, and has room for the module's sources
+        :return: List of failure messages
+        """
+        if os.path.exists(local_path):
+            # it does, try to create a temporary file
+            try:
+                testfile = tempfile.TemporaryFile(dir=local_path)
+                testfile.close()
+            except OSError as err:
+                if err.errno == errno.EACCES:  # 13
+                    return ["Pre-check of module {} failed: local destination {} is not writable.".format(
+                        module, local_path)]
+                return ["Pre-check of module {} failed: unable to verify local destination {}, reason: {}".format(
+                    module, local_path, str(err))]
+        else:
+            # it doesn't, try to create it
+            try:
+                os.makedirs(local_path, mode=0755)
+            except OSError as err:
+                return ["Pre-check of module {} failed: unable to create local destination {}, reason: {}".format(
+                    module, local_path, str(err))]
+
+        required = self.tree_size(sources)
+        st = os.statvfs(local_path)
+        available = st.f_bavail * st.f_frsize
+        if available < required:
+            return ["Pre-check of module {} failed: local destination {} has {} bytes free, {} needed.".format(
+                module, local_path, available, required)]
+        return []
+
+    def check_remote(self, alias, dest_cfg, destinations):
+        """
+        Check a remote destination accepts our connection and credentials, and that each of its
+        destination paths is writable with room for the modules delivered there. All paths are
+        probed with a single remote command.
+        :param alias: clouddata alias of the destination
+        :param dest_cfg: distribution.Destination
+        :param destinations: List of (module, remote path, module source paths) delivered to this destination
+        :return: List of failure messages
+        """
+        try:
+            self.connections.get(dest_cfg)
+        except paramiko.AuthenticationException as e:
+            return ["Pre-check failed: Authentication to remote destination '{}@{}:{}' ({}) was refused: {}".format(
+                dest_cfg.user(), dest_cfg.host(), dest_cfg.port(), alias, str(e))]
+        except (paramiko.BadHostKeyException, paramiko.SSHException, socket.error) as e:
+            return ["Pre-check failed: Unable to successfully establish a connection to remote destination "
+                    "'{}@{}:{}' ({}), reason: {}".format(dest_cfg.user(), dest_cfg.host(), dest_cfg.port(), alias, str(e))]
+
+        paths = []
+        required = {}
+        for module, remote_path, sources in destinations:
+            if remote_path not in required:
+                paths.append(remote_path)
+                required[remote_path] = 0
+            required[remote_path] += self.tree_size(sources)
+
+        command = REMOTE_PROBE + '; '.join('probe {}'.format(pipes.quote(p)) for p in paths)
+        try:
+            rc, stdout, stderr = self.connections.exec_command(dest_cfg, command)
+        except Exception as e:
+            return ["Pre-check failed: Unable to probe remote destination {} ({}): {}".format(
+                dest_cfg.host(), alias, str(e))]
+        results = stdout.splitlines()
+        if rc or len(results) != len(paths):
+            return ["Pre-check failed: Unable to probe remote destination {} ({}): {}".format(
+                dest_cfg.host(), alias, stderr.strip())]
+
+        failures = []
+        for remote_path, result in zip(paths, results):
+            fields = result.split()
+            if fields[0] != 'ok':
+                failures.append("Pre-check failed: remote destination {}:{} ({}) is not writable.".format(
+                    dest_cfg.host(), remote_path, alias))
+                continue
+            try:
+                available = int(fields[1]) * 1024
+            except (IndexError, ValueError):
+                self.logger.warning("Unable to determine free space of remote destination {}:{}".format(
+                    dest_cfg.host(), remote_path))
+                continue
+            if available < required[remote_path]:
+                failures.append("Pre-check failed: remote destination {}:{} ({}) has {} bytes free, {} needed.".format(
+                    dest_cfg.host(), remote_path, alias, available, required[remote_path]))
+        return failures
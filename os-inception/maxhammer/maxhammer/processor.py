@@ -1,84 +1,323 @@
 import codecs
+import hashlib
+import json
 import os
+import posixpath
+import re
 import stat
 import logging
 import shutil
+import threading
 from jinja2 import Template, Environment, FileSystemLoader
+from jinja2.bccache import BytecodeCache, Bucket
 from maxhammer import fileutil
 
 GENERIC = 1
 ANSIBLE = 2
 
+# Bytes read from the start of a file to tell binary files, which hold NUL bytes, from text
+BINARY_SNIFF_SIZE = 8192
+
+
+class TemplateCache(BytecodeCache):
+    """
+    In-memory cache of compiled templates, keyed by template name, delimiters and source rather than by
+    file, so identical templates are compiled once however many environments, branches or threads use them
+    """
+
+    def __init__(self):
+        self._codes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def get_bucket(self, environment, name, filename, source):
+        key = hashlib.sha1(json.dumps([name, environment.block_start_string, environment.variable_start_string,
+                                       environment.comment_start_string, source])).hexdigest()
+        bucket = Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket):
+        with self._lock:
+            code = self._codes.get(bucket.key)
+            if code is not None:
+                self.hits += 1
+        bucket.code = code
+
+    def dump_bytecode(self, bucket):
+        with self._lock:
+            self._codes[bucket.key] = bucket.code
+
+
+class DirectoryEnvironment(Environment):
+    """
+    Jinja environment whose templates pull in other templates relative to the directory being rendered,
+    rather than to the root of its loader, so a single loader can serve a whole tree
+    """
+
+    # directory of the templates being rendered, relative to the loader root
+    directory = ''
+
+    def join_path(self, template, parent):
+        return posixpath.join(self.directory, template)
+
 
 class Processor:
     """
     Pre-processes files via Jinja2 prior to distribution
     """
 
-    def __init__(self, config_path=None, logger=None):
+    def __init__(self, config_path=None, logger=None, store=None, template_cache=None, umask=None):
         """
         :param config_path: Path to the overcloud config(s). A list of paths is acceptable.
+        :param store: Optional store.ArtifactStore to render into and reuse earlier renders from
+        :param template_cache: Optional TemplateCache to share compiled templates through
+        :param umask: umask to give copies stored in the store, defaulting to the process umask read at startup
         :return:
         """
+        self.umask = fileutil.UMASK if umask is None else umask
         self.config_path = config_path
         self.logger = logger or logging.getLogger(__name__)
+        self.store = store
+        self.template_cache = template_cache
+        # environments are kept between runs, along with the templates they've compiled
+        self._environments = {}
 
 
-    def _get_ansible_environment(self):
+    def _get_ansible_environment(self, environment_class=Environment):
         """
         Returns a Jinja processing environment suitable for Ansible-based configs
         :return:
         """
-        env = Environment(block_start_string='[%',block_end_string='%]',
+        env = environment_class(block_start_string='[%',block_end_string='%]',
             variable_start_string='[{',variable_end_string='}]',
-            loader=FileSystemLoader(self.config_path))
+            loader=FileSystemLoader(self.config_path),bytecode_cache=self.template_cache)
         return env
 
 
-    def _get_generic_engine(self):
+    def _get_generic_engine(self, environment_class=Environment):
         """
         Returns a default Jinja processing environment suitable for most configs.
         :return:
         """
-        env = Environment(loader=FileSystemLoader(self.config_path))
+        env = environment_class(loader=FileSystemLoader(self.config_path),bytecode_cache=self.template_cache)
         return env
 
 
-    def run(self, clouddata, output_path, process_method=GENERIC):
+    def _get_environment(self, process_method, environment_class=Environment):
+        """
+        Returns the Jinja processing environment for a process method, reusing it between runs
+        :return:
+        """
+        key = (process_method, environment_class)
+        if key not in self._environments:
+            if process_method == GENERIC:
+                self._environments[key] = self._get_generic_engine(environment_class)
+            elif process_method == ANSIBLE:
+                self._environments[key] = self._get_ansible_environment(environment_class)
+            else:
+                raise Exception("Invalid process method provided.")
+        return self._environments[key]
+
+
+    def _is_static(self, env, file):
+        """
+        Check whether a file can be copied as it is rather than rendered, being binary or text without any
+        of the environment's template syntax
+        """
+        delimiters = [d.encode('utf-8') for d in (env.block_start_string, env.variable_start_string,
+                                                  env.comment_start_string, env.line_statement_prefix,
+                                                  env.line_comment_prefix) if d]
+        with open(os.path.join(self.config_path, file), 'rb') as fh:
+            content = fh.read(BINARY_SNIFF_SIZE)
+            if '\0' in content:
+                return True
+            content += fh.read()
+        return not any(d in content for d in delimiters)
+
+
+    def _references_templates(self, env, file):
+        """
+        Check whether a template pulls in other templates
+        """
+        source = env.loader.get_source(env, file)[0]
+        references = r'{}-?\s*(include|extends|import|from)\b'.format(re.escape(env.block_start_string))
+        return re.search(references, source) is not None
+
+
+    def _render_key(self, env, file, clouddata_digest, process_method, mode):
+        """
+        Build the artifact store key for rendering a template, if its output depends only on its own
+        source and clouddata
+        :return: Render key, or None if the template pulls in other templates
+        """
+        if self._references_templates(env, file):
+            return None
+        source = env.loader.get_source(env, file)[0]
+        return self.store.render_key(process_method, clouddata_digest, source, '{:o}'.format(mode))
+
+
+    def _select_files(self, env, files_to_process, output_path, changed):
+        """
+        Narrow a run down to the files affected by a set of changes, removing the output of any that
+        no longer exist. Templates can pull in any other file, so if any do, everything is affected,
+        as it is when an ignore file changes.
+        :param changed: Changed paths, relative to the config path
+        :return: The affected entries of files_to_process
+        """
+        for path in changed:
+            if not os.path.lexists(os.path.join(self.config_path, path)):
+                destpath = os.path.join(output_path, path)
+                if os.path.isdir(destpath) and not os.path.islink(destpath):
+                    shutil.rmtree(destpath)
+                elif os.path.lexists(destpath):
+                    os.remove(destpath)
+
+        if any(os.path.basename(path) == '.mhignore' for path in changed):
+            return files_to_process
+        if any(self._references_templates(env, f) for f, should_be_excluded in files_to_process
+               if not should_be_excluded and not self._is_static(env, f)):
+            return files_to_process
+
+        affected = lambda f: any(f == path or f.startswith(path + os.sep) for path in changed)
+        return [(f, should_be_excluded) for f, should_be_excluded in files_to_process if affected(f)]
+
+
+    def _make_output_dir(self, outputdir, kind=''):
+        """
+        Create an output directory, if it doesn't already exist
+        :param kind: Kind of config being output, for the error
+        """
+        try:
+            self.logger.debug("Creating dir: {}".format(outputdir))
+            os.makedirs(outputdir)
+        except OSError:
+            if not os.path.isdir(outputdir):
+                raise Exception("Unable to create output cached {}directory {}".format(kind, outputdir))
+
+
+    def render_tree(self, clouddata, output_path, process_method=GENERIC, include_list=None, exclude_list=None,
+                    kind=None):
+        """
+        Render every file under the config path, ignoring any ignore files, as the ansible and overcloud
+        frontends do. Templates pull in other templates relative to their own directory.
+        :param clouddata: De-serialized YAML of clouddata
+        :param output_path: Output path for the rendered tree
+        :param process_method Indicates pre-processing method to apply
+        :param include_list: If given, only files and directories within these paths are rendered
+        :param exclude_list: Files and directories within these paths are skipped
+        :param kind: Kind of config being rendered, for messages
+        :return: Dict of the number of templates rendered
+        """
+        counts = {'rendered': 0}
+        kind = '{} '.format(kind) if kind else ''
+        env = self._get_environment(process_method, DirectoryEnvironment)
+        filtered = include_list or exclude_list
+        wanted = fileutil.compile_path_filter(include_list, exclude_list)
+
+        for rootdir, subdirList, fileList in os.walk(self.config_path):
+            if filtered:
+                subdirList[:] = [d for d in subdirList if wanted(rootdir, d)]
+                fileList = [f for f in fileList if wanted(rootdir, f)]
+
+            reldir = os.path.normpath(os.path.relpath(rootdir, self.config_path))
+            reldir = '' if reldir == os.curdir else reldir
+            outputdir = os.path.join(output_path, reldir)
+            env.directory = reldir.replace(os.sep, '/')
+            created = False
+
+            for fname in fileList:
+                self.logger.debug("Jinjafying {}config file {}".format(kind, fname))
+                srcfile = os.path.join(rootdir, fname)
+                template = env.get_template(posixpath.join(env.directory, fname))
+                try:
+                    outputcontent = template.render(cloud=clouddata)
+                except Exception as error:
+                    self.logger.error("Applying clouddata template to file {} failed: {}".format(
+                        fname, str(error)))
+                    raise Exception("An error occurred processing {}config area {}".format(kind, srcfile))
+                counts['rendered'] += 1
+
+                if not created:
+                    self._make_output_dir(outputdir, kind)
+                    created = True
+
+                destfile = os.path.join(outputdir, fname)
+                with codecs.open(destfile, 'w', 'utf-8') as destination:
+                    # first make the destination user-writable just in case it isn't
+                    os.chmod(destfile,os.stat(srcfile).st_mode | stat.S_IWUSR)
+                    destination.write(outputcontent)
+                    os.chmod(destfile,os.stat(srcfile).st_mode)
+                    self.logger.info("Cached {}config for {} in {}".format(kind, fname, outputdir))
+
+        return counts
+
+
+    def run(self, clouddata, output_path, process_method=GENERIC, changed=None):
         """
         Generate a personalized overcloud config environment based upon a clouddata config
         :param clouddata: De-serialized YAML of clouddata
         :param output_path: Output path for customized overcloud config
         :param process_method Indicates pre-processing method to apply
-        :return:
+        :param changed: Paths changed since an earlier run into the same output path, relative to the
+                        config path. Only the files they affect are processed again.
+        :return: Dict of the number of templates rendered, stored renders reused, files copied and static
+                 files copied without rendering
         """
+        counts = {'rendered': 0, 'reused': 0, 'copied': 0, 'static': 0}
+        env = self._get_environment(process_method)
 
-        if process_method == GENERIC:
-            env = self._get_generic_engine()
-        elif process_method == ANSIBLE:
-            env = self._get_ansible_environment()
-        else:
-            raise Exception("Invalid process method provided.")
+        if self.store:
+            clouddata_digest = hashlib.sha1(json.dumps(clouddata, sort_keys=True, default=str)).hexdigest()
 
         files_to_process = fileutil.get_files_with_exclusion_status(self.config_path)
+        if changed is not None:
+            files_to_process = self._select_files(env, files_to_process, output_path, changed)
+
+        created = set()
         for file,should_be_excluded in files_to_process:
             srcfile = os.path.join(self.config_path, file)
             destfile = os.path.join(output_path, file)
 
             # first try and create the output dir
-            try:
-                outputdir = os.path.join(output_path,os.path.dirname(file))
-                self.logger.debug("Creating dir: {}".format(outputdir))
-                os.makedirs(outputdir)
-            except OSError:
-                if not os.path.isdir(outputdir):
-                    raise Exception("Unable to create output cached directory {}".format(outputdir))
+            outputdir = os.path.join(output_path,os.path.dirname(file))
+            if outputdir not in created:
+                self._make_output_dir(outputdir)
+                created.add(outputdir)
 
             # if the file doesn't need processing, just copy it
             if should_be_excluded:
-                shutil.copyfile(srcfile,destfile)
+                if self.store:
+                    self.store.link(self.store.put_file(srcfile, 0666 & ~self.umask), destfile)
+                else:
+                    shutil.copyfile(srcfile,destfile)
+                counts['copied'] += 1
+                continue
+
+            # nothing to render, so copy it byte for byte with its mode, as a render would have
+            if self._is_static(env, file):
+                mode = stat.S_IMODE(os.stat(srcfile).st_mode)
+                if self.store:
+                    self.store.link(self.store.put_file(srcfile, mode), destfile)
+                else:
+                    if os.path.lexists(destfile):
+                        os.remove(destfile)
+                    shutil.copyfile(srcfile, destfile)
+                    os.chmod(destfile, mode)
+                self.logger.debug("Copied static config file {}".format(file))
+                counts['static'] += 1
                 continue
 
+            if self.store:
+                mode = stat.S_IMODE(os.stat(srcfile).st_mode)
+                key = self._render_key(env, file, clouddata_digest, process_method, mode)
+                objname = self.store.lookup_render(key) if key else None
+                if objname is not None:
+                    self.logger.debug("Reusing stored render of config file {}".format(file))
+                    self.store.link(objname, destfile)
+                    counts['reused'] += 1
+                    continue
+
             self.logger.debug("Jinjafying config file {}".format(file))
             template = env.get_template(file)
             try:
@@ -87,7 +326,19 @@ class Processor:
                 self.logger.error("Applying clouddata template to file {} failed: {}".format(
                     file, str(error)))
                 raise Exception("An error occurred processing config area {}".format(self.config_path))
+            counts['rendered'] += 1
+
+            if self.store:
+                objname = self.store.put_content(outputcontent.encode('utf-8'), mode)
+                if key:
+                    self.store.record_render(key, objname)
+                self.store.link(objname, destfile)
+                self.logger.info("Cached config for {} in {}".format(file, outputdir))
+                continue
 
+            if os.path.lexists(destfile):
+                # replacing an earlier run's output, which may not be writable
+                os.remove(destfile)
             with codecs.open(destfile, 'w', 'utf-8') as destination:
                 # first make the destination user-writable just in case it isn't
                 os.chmod(destfile,os.stat(srcfile).st_mode | stat.S_IWUSR)
@@ -95,3 +346,4 @@ class Processor:
                 os.chmod(destfile,os.stat(srcfile).st_mode)
                 self.logger.info("Cached config for {} in {}".format(file, outputdir))
 
+        return counts
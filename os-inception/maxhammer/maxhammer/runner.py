@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 
 import argparse
+import copy
 import os
+import Queue
+import shutil
+import signal
 import sys
-import yaml
+import tempfile
+import threading
+import time
 import logging
 import traceback
-from maxhammer import foreman, distribution
+from maxhammer import metrics
 from colorlog import ColoredFormatter
+# Everything else is imported by the phases that use it, so --help, argument errors and runs that skip
+# phases don't pay for foremanapi, requests, jinja2 and paramiko
 
 # Argument defaults
 DEFAULT_PUPPETENV_PATH = '/etc/puppet/cloud_environments/'
@@ -22,10 +30,21 @@ DEFAULT_TEMPLATE_PATH = '/home/stack/overcloud'
 DEFAULT_OVERCLOUD_ANSIBLE_PATH = '/home/stack/overcloud-ansible'
 DEFAULT_PUPPETENV_PREFIX = 'icloud_'
 DEFAULT_MANIFEST_FILE = 'maxhammer.yaml'
+DEFAULT_BRANCH_PARALLELISM = 4
 
 
 class Runner():
 
+    # connections and caches shared by the branches of a batch run
+    connections = None
+    lookups = None
+    template_cache = None
+    request_metrics = None
+    # adaptive limits on the requests made to each Foreman server, shared by every branch building on it
+    foreman_limits = None
+    # journal of the branch's run, recording completed work for --resume
+    journal = None
+
 
     def _load_yaml(self, filename):
         """
@@ -33,9 +52,8 @@ class Runner():
         :param filename:
         :return:
         """
-        with open(filename, 'r') as stream:
-            result = yaml.load(stream)
-            return result
+        from maxhammer import yamlfile
+        return yamlfile.load(filename)
 
 
     def _setup_logging(self, verbosity):
@@ -76,12 +94,223 @@ class Runner():
         :return:
         """
         # Build the cloud config
-        fc = foreman.Foreman(clouddata_config, hostgroup_config_path, logger=self.logger)
-        custom_cloud_config = fc.process_config()
+        fc = self._foreman(clouddata_config, hostgroup_config_path)
+        with metrics.timer('hostgroup_config'):
+            custom_cloud_config = fc.process_config()
 
         # Create the hostgroups from that config, add the puppetclasses and the associated smart variable overrides
-        fc.cloud_create(custom_cloud_config)
+        with metrics.timer('hostgroup_create'):
+            fc.cloud_create(custom_cloud_config)
+
+
+    def _foreman(self, clouddata_config, hostgroup_config_path):
+        """
+        Set up hostgroup building, through any caches shared with other branches
+        :param clouddata_config: deserialized clouddata configuration
+        :param hostgroup_config_path: path to hostgroup configuration yaml file
+        :return: foreman.Foreman
+        """
+        from maxhammer import foreman
+        limits = self.foreman_limits.get(clouddata_config['buildserver']) if self.foreman_limits else None
+        return foreman.Foreman(clouddata_config, hostgroup_config_path, logger=self.logger,
+                               lookups=self.lookups, template_cache=self.template_cache,
+                               request_metrics=self.request_metrics, journal=self.journal, limits=limits)
+
+    def _hostgroup_config_path(self, args):
+        """
+        Locate and validate the branch's hostgroup configuration
+        :param args: parsed arguments
+        :return: path to the hostgroup configuration
+        """
+        hostgroup_config_path = os.path.join(args.puppetenvpath, DEFAULT_PUPPETENV_PREFIX + args.branch, 'hostgroups')
+
+        # validate our config path exists
+        if not os.path.exists(hostgroup_config_path):
+            self.logger.error("Unable to find hostgroup config path (expected: %s)" % hostgroup_config_path)
+            sys.exit(1)
+        return hostgroup_config_path
+
+    def _manifest_file(self, args):
+        """
+        Locate and validate the branch's distribution manifest
+        :param args: parsed arguments
+        :return: path to the manifest
+        """
+        if args.manifest:
+            manifest_file = args.manifest
+        else:
+            manifest_file = os.path.join(args.puppetenvpath, DEFAULT_PUPPETENV_PREFIX + args.branch, DEFAULT_MANIFEST_FILE)
+
+        if not os.path.exists(manifest_file):
+            self.logger.error("Distribution manifest not found: {}".format(manifest_file))
+            sys.exit(1)
+        return manifest_file
+
+    def _distribution(self, args, clouddata_config, connections=None):
+        """
+        Set up distribution of the branch's manifest
+        :param args: parsed arguments
+        :param clouddata_config: deserialized clouddata configuration
+        :param connections: connection.ConnectionPool to share, otherwise the distribution keeps its own
+        :return: distribution.Distribution
+        """
+        from maxhammer import distribution
+        manifest_file = self._manifest_file(args)
+        self.logger.info("Distributing configurations using manifest: {}".format(manifest_file))
+        source_base = args.puppetenvpath + '/' + DEFAULT_PUPPETENV_PREFIX + args.branch
+        return distribution.Distribution(manifest_file, clouddata_config=clouddata_config, source_base=source_base,
+                                         send_to_local=args.localdist, send_to_remote=args.remotedist, logger=self.logger,
+                                         connections=connections or self.connections, template_cache=self.template_cache,
+                                         journal=self.journal)
+
+    def _plan(self, args, clouddata_config):
+        """
+        Render everything and print the changes a run would make, optionally saving them for --apply-plan
+        :param args: parsed arguments
+        :param clouddata_config: deserialized clouddata configuration
+        :return:
+        """
+        from maxhammer import plan
+        if args.plan_file:
+            build_root = os.path.abspath(args.plan_file) + '.d'
+            if os.path.exists(build_root):
+                shutil.rmtree(build_root)
+            os.makedirs(build_root)
+        else:
+            build_root = tempfile.mkdtemp('maxhammer-plan')
+        change_plan = plan.Plan(branch=args.branch, build_root=build_root)
+
+        if args.buildhostgroup:
+            fc = self._foreman(clouddata_config, self._hostgroup_config_path(args))
+            change_plan.hostgroups = fc.plan(fc.process_config())
+
+        if not args.nomanifest:
+            dist = self._distribution(args, clouddata_config)
+            try:
+                dist.plan(change_plan)
+            finally:
+                dist.close()
+
+        sys.stdout.write('\n'.join(change_plan.summary()) + '\n')
 
+        if args.plan_file:
+            change_plan.save(args.plan_file)
+            self.logger.info("Saved plan to {} (rendered trees in {})".format(args.plan_file, build_root))
+        else:
+            shutil.rmtree(build_root)
+
+    def _apply_plan(self, args, clouddata_config):
+        """
+        Carry out exactly the operations recorded in a saved plan, without re-rendering anything
+        :param args: parsed arguments
+        :param clouddata_config: deserialized clouddata configuration
+        :return:
+        """
+        from maxhammer import plan
+        change_plan = plan.Plan.load(args.apply_plan)
+        if change_plan.branch != args.branch:
+            self.logger.error("Plan {} was made for branch {}, not {}".format(args.apply_plan, change_plan.branch, args.branch))
+            sys.exit(1)
+
+        if args.buildhostgroup and change_plan.hostgroups is not None:
+            self.logger.info("Building hostgroups in Foreman from plan.")
+            fc = self._foreman(clouddata_config, self._hostgroup_config_path(args))
+            fc.apply_plan(change_plan.hostgroups)
+
+        if not args.nomanifest and change_plan.transfers:
+            dist = self._distribution(args, clouddata_config)
+            try:
+                if dist.precheck():
+                    dist.apply_plan(change_plan)
+            finally:
+                dist.close()
+
+    def _watch(self, args, clouddata_path, clouddata_config):
+        """
+        Build and distribute everything, then keep watching the branch and rebuilding whatever its changes
+        affect. Clouddata, compiled templates, Foreman lookups and remote connections are kept between rebuilds.
+        :param args: parsed arguments
+        :param clouddata_path: path to the clouddata file
+        :param clouddata_config: deserialized clouddata configuration
+        :return:
+        """
+        from maxhammer import connection, watch
+        branch_path = os.path.abspath(os.path.join(args.puppetenvpath, DEFAULT_PUPPETENV_PREFIX + args.branch))
+        clouddata_path = os.path.abspath(clouddata_path)
+        watched = [branch_path]
+
+        fc = None
+        if args.buildhostgroup:
+            hostgroup_config_path = os.path.abspath(self._hostgroup_config_path(args))
+            fc = self._foreman(clouddata_config, hostgroup_config_path)
+
+        dist = None
+        connections = connection.ConnectionPool(logger=self.logger)
+        if not args.nomanifest:
+            manifest_file = os.path.abspath(self._manifest_file(args))
+            watched.append(manifest_file)
+            dist = self._distribution(args, clouddata_config, connections=connections)
+            if not dist.precheck():
+                self.logger.error("Distribution pre-check failed, not distributing until the manifest changes.")
+                dist = None
+
+        watcher = watch.Watcher(watched, debounce=getattr(args, 'debounce', watch.DEFAULT_DEBOUNCE), logger=self.logger)
+        # clean up the same way whether interrupted or terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.logger.info("Watching {} for changes.".format(branch_path))
+        changed = None
+        try:
+            while True:
+                hostgroups_changed = changed is None
+                manifest_changed = False
+                if changed is not None:
+                    self.logger.info("Rebuilding after changes to {} path(s).".format(len(changed)))
+                    if clouddata_path in changed:
+                        try:
+                            clouddata_config = self._load_yaml(clouddata_path)
+                        except Exception as error:
+                            self.logger.error("Clouddata could not be read (%s): %s" % (clouddata_path, str(error)))
+                            changed = watcher.wait()
+                            continue
+                        hostgroups_changed = True
+                        if fc is not None:
+                            if clouddata_config.get('buildserver') != fc.clouddata.get('buildserver'):
+                                fc = self._foreman(clouddata_config, fc.hostgroup_config_path)
+                            fc.clouddata = clouddata_config
+                    if fc is not None and any(path.startswith(fc.hostgroup_config_path + os.sep) for path in changed):
+                        hostgroups_changed = True
+                    manifest_changed = not args.nomanifest and manifest_file in changed
+
+                try:
+                    if fc is not None and hostgroups_changed:
+                        self.logger.info("Building hostgroups in Foreman.")
+                        fc.cloud_create(fc.process_config(reload_foreman=changed is None))
+
+                    if manifest_changed:
+                        if dist is not None:
+                            dist.release()
+                        dist = self._distribution(args, clouddata_config, connections=connections)
+                        if not dist.precheck():
+                            self.logger.error("Distribution pre-check failed, not distributing until the manifest changes.")
+                            dist = None
+                    if dist is not None:
+                        if changed is not None and clouddata_path in changed:
+                            dist.clouddata_config = clouddata_config
+                        full = changed is None or manifest_changed or clouddata_path in changed
+                        dist.refresh(None if full else changed)
+                except Exception as error:
+                    str_error = traceback.format_exc()
+                    self.logger.error(str(error))
+                    self.logger.debug(str_error)
+
+                changed = watcher.wait()
+        except KeyboardInterrupt:
+            self.logger.info("Stopped watching.")
+        finally:
+            watcher.close()
+            if dist is not None:
+                dist.release()
+            connections.close()
 
     def run(self):
         """
@@ -92,6 +321,9 @@ class Runner():
                                                      'generate the required Cloud Hostgroups & overcloud configuration')
 
         parser.add_argument('--branch', help='Name of the branch to process')
+        parser.add_argument('--branches', help='Comma-separated names of several branches to process')
+        parser.add_argument('--all-branches', dest='all_branches', action='store_true', help='Process every branch with clouddata')
+        parser.add_argument('--parallel', type=int, default=DEFAULT_BRANCH_PARALLELISM, help='With --branches or --all-branches, how many branches to process at a time')
         parser.add_argument('--puppetenvpath', default=DEFAULT_PUPPETENV_PATH, help='Path to the puppet environments')
 
         # Connection details for the undercloud host
@@ -107,6 +339,34 @@ class Runner():
         parser.add_argument('--no-dist', dest='nomanifest', action='store_true', help='Do not perform any distribution')
         parser.add_argument('--no-remote-dist', dest='remotedist', default=True, action='store_false', help='Do not perform distribution to a remote host')
         parser.add_argument('--no-local-dist', dest='localdist', default=True, action='store_false', help='Do not perform distribution to a local destination')
+        parser.add_argument('--serial-phases', dest='serial_phases', action='store_true', help='Build hostgroups before distributing, rather than alongside')
+
+        # Planning
+        parser.add_argument('--plan', action='store_true', help='Print the changes a run would make, without making them')
+        parser.add_argument('--plan-file', dest='plan_file', help='With --plan, save the plan (and its rendered trees) for --apply-plan')
+        parser.add_argument('--apply-plan', dest='apply_plan', help='Apply a plan saved with --plan --plan-file, without re-rendering')
+
+        # Watching
+        parser.add_argument('--watch', action='store_true', help='Keep running, rebuilding and redistributing whatever changes in the branch affect')
+        parser.add_argument('--debounce', type=float, default=argparse.SUPPRESS, help='With --watch, seconds to let changes settle before rebuilding')
+
+        # Resuming
+        parser.add_argument('--resume', action='store_true', help='Carry on from where the last journaled run of the branch failed, skipping the work its journal shows was completed and is still in place. The run is journaled in turn.')
+        parser.add_argument('--journal-dir', dest='journal_dir', default=argparse.SUPPRESS, help='Journal the run in this directory, so it can be carried on from with --resume if it fails')
+
+        # Instrumentation
+        parser.add_argument('--report', help='Write timings and counters for the run to this JSON file')
+        parser.add_argument('--profile', help='Profile the whole run with cProfile, writing pstats output to this file')
+        parser.add_argument('--api-log', dest='api_log', help='Append every Foreman API request to this file, as JSON lines')
+        parser.add_argument('--foreman-read-ceiling', dest='foreman_read_ceiling', type=int, default=argparse.SUPPRESS, help='Most Foreman reads to make at a time. Fewer are made while Foreman shows signs of overload.')
+        parser.add_argument('--foreman-write-ceiling', dest='foreman_write_ceiling', type=int, default=argparse.SUPPRESS, help='Most Foreman writes to make at a time. Fewer are made while Foreman shows signs of overload.')
+
+        # Caching
+        parser.add_argument('--yaml-cache', dest='yaml_cache', default=argparse.SUPPRESS, help='File to cache parsed clouddata and manifests in between runs')
+        parser.add_argument('--no-yaml-cache', dest='yaml_cache', action='store_const', const=None, help='Do not keep parsed YAML between runs')
+        parser.add_argument('--digest-cache', dest='digest_cache', default=argparse.SUPPRESS, help='File to cache digests of delivered and built files in between runs')
+        parser.add_argument('--no-digest-cache', dest='digest_cache', action='store_const', const=None, help='Do not keep file digests between runs')
+        parser.add_argument('--hash-workers', dest='hash_workers', type=int, default=argparse.SUPPRESS, help='Number of files to hash at once')
 
         # Additional behaviour args
         parser.add_argument("-v","--verbose",action="count",dest="verbosity",help="Verbose mode. Can be used multiple times to increase output. Use -vvv for debugging output.")
@@ -115,7 +375,8 @@ class Runner():
         args = parser.parse_args()
 
         # Verify branch as mandatory argument
-        if args.branch is None:
+        batch = args.branches or args.all_branches
+        if (args.branch is None) == (not batch):
             parser.print_help()
             sys.exit(1)
 
@@ -125,6 +386,168 @@ class Runner():
             verbosity = 0
         self.logger = self._setup_logging(verbosity)
 
+        # defaults of options left out (suppressed above) come from the modules, imported only now. fileutil
+        # reads the umask as it's imported, so it must be before any threads are started.
+        from maxhammer import fileutil, yamlfile
+        from foremanapi import limiter, metrics as foremanmetrics
+        metrics.RUN.reset()
+        yamlfile.CACHE = yamlfile.ParsedCache(getattr(args, 'yaml_cache', yamlfile.DEFAULT_CACHE_PATH), logger=self.logger)
+        fileutil.DIGESTS = fileutil.DigestCache(getattr(args, 'digest_cache', fileutil.DEFAULT_DIGEST_CACHE_PATH),
+                                                logger=self.logger,
+                                                workers=getattr(args, 'hash_workers', fileutil.DEFAULT_HASH_WORKERS))
+        self.foreman_requests = foremanmetrics.InMemoryMetrics()
+        self.request_metrics = [self.foreman_requests]
+        if args.api_log:
+            self.request_metrics.append(foremanmetrics.JsonLinesExporter(args.api_log))
+        self.foreman_limits = limiter.SharedLimits(
+            read_ceiling=getattr(args, 'foreman_read_ceiling', limiter.DEFAULT_READ_CEILING),
+            write_ceiling=getattr(args, 'foreman_write_ceiling', limiter.DEFAULT_WRITE_CEILING))
+        profiler = None
+        if args.profile:
+            profiler = metrics.Profiler()
+            profiler.start()
+        try:
+            with metrics.timer('run'):
+                succeeded = self._run_batch(args, self._branches(args)) if batch else not self._run_branch(args)
+        finally:
+            yamlfile.CACHE.save()
+            fileutil.DIGESTS.save()
+            if profiler:
+                profiler.stop(args.profile)
+                self.logger.info("Wrote profile to {}".format(args.profile))
+            self._report(args)
+        if not succeeded:
+            sys.exit(1)
+
+    def _branches(self, args):
+        """
+        Work out the branches of a batch run
+        :param args: parsed arguments
+        :return: List of branch names
+        """
+        if args.watch or args.plan_file or args.apply_plan:
+            self.logger.error("--watch, --plan-file and --apply-plan need a single --branch")
+            sys.exit(1)
+        if args.all_branches:
+            branches = self._find_branches(args.puppetenvpath)
+        else:
+            branches = [b.strip() for b in args.branches.split(',') if b.strip()]
+        if not branches:
+            self.logger.error("No branches to process")
+            sys.exit(1)
+        return branches
+
+    def _report(self, args):
+        """
+        Report the run's timings and counters: summarized in the log, and in full to --report
+        :param args: parsed arguments
+        :return:
+        """
+        for line in metrics.RUN.summary():
+            self.logger.info(line)
+        for line in ['Foreman requests:'] + self.foreman_requests.summary():
+            self.logger.info(line)
+        for server, server_limits in sorted(self.foreman_limits.stats().items()):
+            for stats in server_limits:
+                self.logger.info("Foreman {} {}: limit {} of {}, at most {} at once, cut {} times, overloads {}".format(
+                    server, stats['name'], stats['limit'], stats['ceiling'], stats['peak'], stats['decreases'],
+                    stats['overloads']))
+        if args.report:
+            metrics.RUN.save(args.report, foreman_requests=self.foreman_requests.stats(),
+                             foreman_limits=self.foreman_limits.stats())
+            self.logger.info("Wrote run report to {}".format(args.report))
+
+    def _find_branches(self, puppetenvpath):
+        """
+        Find every branch in the puppet environments that has clouddata
+        :param puppetenvpath: Path to the puppet environments
+        :return: List of branch names
+        """
+        branches = []
+        for entry in sorted(os.listdir(puppetenvpath)):
+            if not entry.startswith(DEFAULT_PUPPETENV_PREFIX):
+                continue
+            branch = entry[len(DEFAULT_PUPPETENV_PREFIX):]
+            if os.path.exists(os.path.join(puppetenvpath, entry, 'clouddata', 'clouddata', branch + '.yaml')):
+                branches.append(branch)
+        return branches
+
+    def _run_batch(self, args, branches):
+        """
+        Process several branches in one go, a bounded number at a time. Remote connections, Foreman
+        reference data and compiled templates are shared between them.
+        :param args: parsed arguments
+        :param branches: List of branch names
+        :return: True if every branch succeeded, False otherwise
+        """
+        from maxhammer import connection, foreman, processor
+        self.connections = connection.ConnectionPool(logger=self.logger)
+        self.lookups = foreman.LookupCache()
+        self.template_cache = processor.TemplateCache()
+
+        pending = Queue.Queue()
+        for branch in branches:
+            pending.put(branch)
+        results = {}
+
+        def process():
+            while True:
+                try:
+                    branch = pending.get_nowait()
+                except Queue.Empty:
+                    return
+
+                branch_runner = Runner()
+                branch_runner.logger = self.logger.getChild(branch)
+                branch_runner.connections = self.connections
+                branch_runner.lookups = self.lookups
+                branch_runner.template_cache = self.template_cache
+                branch_runner.request_metrics = self.request_metrics
+                branch_runner.foreman_limits = self.foreman_limits
+                branch_args = copy.copy(args)
+                branch_args.branch = branch
+
+                started = time.time()
+                error = None
+                try:
+                    failed = branch_runner._run_branch(branch_args)
+                    if failed:
+                        error = "{} failed".format(' and '.join(failed))
+                except SystemExit:
+                    error = "aborted"
+                except Exception as e:
+                    error = str(e)
+                    branch_runner.logger.error(error)
+                    branch_runner.logger.debug(traceback.format_exc())
+                results[branch] = (error, time.time() - started)
+
+        self.logger.info("Processing {} branches, {} at a time.".format(len(branches), args.parallel))
+        workers = [threading.Thread(target=process) for i in range(max(1, min(args.parallel, len(branches))))]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            self.connections.close()
+
+        lines = ['Branch results:']
+        for branch in branches:
+            error, elapsed = results[branch]
+            lines.append('  {}: {} ({:.1f}s){}'.format(branch, 'FAILED' if error else 'ok', elapsed,
+                                                       ': ' + error if error else ''))
+        failed = len([branch for branch in branches if results[branch][0]])
+        lines.append('  {} of {} branches succeeded, {} template compilations saved'.format(
+            len(branches) - failed, len(branches), self.template_cache.hits))
+        sys.stdout.write('\n'.join(lines) + '\n')
+        return not failed
+
+    def _run_branch(self, args):
+        """
+        Process a single branch
+        :param args: parsed arguments
+        :return: List of the names of the phases that failed
+        """
         # validate clouddata arguments
         clouddata_path = os.path.join(args.puppetenvpath, DEFAULT_PUPPETENV_PREFIX + args.branch, 'clouddata','clouddata',args.branch+'.yaml')
         if not os.path.exists(clouddata_path):
@@ -133,7 +556,8 @@ class Runner():
 
         # Load and validate clouddata config
         try:
-            clouddata_config = self._load_yaml(clouddata_path)
+            with metrics.timer('load_clouddata', branch=args.branch):
+                clouddata_config = self._load_yaml(clouddata_path)
         except Exception as error:
             self.logger.fatal("Clouddata could not be read (%s): %s" % (clouddata_path,str(error)))
             sys.exit(1)
@@ -143,17 +567,36 @@ class Runner():
             self.logger.fatal("Parameter 'buildserver' missing in clouddata")
             sys.exit(1)
 
-        # Are we setting up the hostgroup on Foreman?
-        if args.buildhostgroup:
-            self.logger.info("Building hostgroups in Foreman.")
-            hostgroup_config_path = os.path.join(args.puppetenvpath, DEFAULT_PUPPETENV_PREFIX + args.branch, 'hostgroups')
+        if args.resume and (args.watch or args.plan or args.apply_plan):
+            self.logger.error("--resume can't be combined with --watch, --plan or --apply-plan")
+            sys.exit(1)
+
+        if args.watch:
+            if args.plan or args.apply_plan:
+                self.logger.error("--watch can't be combined with --plan or --apply-plan")
+                sys.exit(1)
+            self._watch(args, clouddata_path, clouddata_config)
+            return []
 
-            # validate our config path exists
-            if not os.path.exists(hostgroup_config_path):
-                self.logger.error("Unable to find hostgroup config path (expected: %s)" % hostgroup_config_path)
+        if args.plan or args.apply_plan:
+            try:
+                if args.plan:
+                    self._plan(args, clouddata_config)
+                else:
+                    self._apply_plan(args, clouddata_config)
+            except Exception as error:
+                str_error = traceback.format_exc()
+                self.logger.error(str(error))
+                self.logger.debug(str_error)
                 sys.exit(1)
+            return []
 
-            self._build_hostgroup(clouddata_config, hostgroup_config_path)
+        # Hostgroups and distribution only share clouddata, so unless told otherwise they run side by side
+        phases = []
+        if args.buildhostgroup:
+            self.logger.info("Building hostgroups in Foreman.")
+            hostgroup_config_path = self._hostgroup_config_path(args)
+            phases.append(('hostgroup', lambda: self._build_hostgroup(clouddata_config, hostgroup_config_path)))
         else:
             self.logger.info("Not building hostgroups in Foreman.")
 
@@ -161,24 +604,85 @@ class Runner():
         if args.nomanifest:
             self.logger.info("Not performing distribution.")
         else:
-            if args.manifest:
-                manifest_file = args.manifest
-            else:
-                manifest_file = os.path.join(args.puppetenvpath, DEFAULT_PUPPETENV_PREFIX + args.branch, DEFAULT_MANIFEST_FILE)
+            self._manifest_file(args)
+            phases.append(('distribution', lambda: self._distribute(args, clouddata_config)))
 
-            if not os.path.exists(manifest_file):
-                self.logger.error("Distribution manifest not found: {}".format(manifest_file))
-                sys.exit(1)
-            self.logger.info("Distributing configurations using manifest: {}".format(manifest_file))
+        return self._run_journaled(args, phases)
 
-            source_base = args.puppetenvpath + '/' + DEFAULT_PUPPETENV_PREFIX + args.branch
+    def _run_journaled(self, args, phases):
+        """
+        Run a branch's phases, journaling the work they complete if --resume or --journal-dir asks for it.
+        The journal is kept if any phase fails, so a run with --resume can carry on from there. A journal
+        that can't be written is warned about, and the run goes ahead without it.
+        :param args: parsed arguments
+        :param phases: List of (name, function) pairs
+        :return: List of the names of the phases that failed
+        """
+        if not phases:
+            return []
+        if not args.resume and not hasattr(args, 'journal_dir'):
+            return self._run_phases(phases, serial=args.serial_phases, branch=args.branch)
 
+        from maxhammer import journal
+        journal_path = journal.journal_path(getattr(args, 'journal_dir', journal.DEFAULT_JOURNAL_DIR), args.branch)
+        try:
+            self.journal = journal.Journal(journal_path, resume=args.resume, logger=self.logger)
+        except (IOError, OSError) as error:
+            self.logger.warning("Running without a journal, as {} can't be written: {}".format(journal_path, str(error)))
+            return self._run_phases(phases, serial=args.serial_phases, branch=args.branch)
+        failed = None
+        try:
+            failed = self._run_phases(phases, serial=args.serial_phases, branch=args.branch)
+        finally:
+            self.journal.close(completed=failed == [])
+        if failed:
+            self.logger.info("Run again with --resume to carry on from where this run failed (journal: {})".format(journal_path))
+        return failed
+
+    def _distribute(self, args, clouddata_config):
+        """
+        Pre-check and distribute the branch's manifest
+        :param args: parsed arguments
+        :param clouddata_config: deserialized clouddata configuration
+        :return:
+        """
+        dist = self._distribution(args, clouddata_config)
+        try:
+            if not dist.precheck():
+                raise Exception("Distribution pre-check failed.")
+            dist.distribute()
+        finally:
+            dist.close()
+
+    def _run_phases(self, phases, serial=False, branch=None):
+        """
+        Run a branch's phases, concurrently unless told otherwise. A phase failing doesn't stop the others.
+        :param phases: List of (name, function) pairs. Functions raise an exception on failure.
+        :param serial: Run the phases one after another, in order
+        :param branch: Branch the phases belong to, to time them by
+        :return: List of the names of the phases that failed
+        """
+        failed = []
+        lock = threading.Lock()
+
+        def run(name, function):
             try:
-                dist = distribution.Distribution(manifest_file, clouddata_config=clouddata_config, source_base=source_base,
-                                             send_to_local=args.localdist, send_to_remote=args.remotedist, logger=self.logger)
-                if dist.precheck():
-                    dist.distribute()
+                with metrics.timer('phase', phase=name, branch=branch):
+                    function()
             except Exception as error:
                 str_error = traceback.format_exc()
-                self.logger.error(str(error))
+                self.logger.error("The {} phase failed: {}".format(name, str(error)))
                 self.logger.debug(str_error)
+                with lock:
+                    failed.append(name)
+
+        if serial or len(phases) < 2:
+            for name, function in phases:
+                run(name, function)
+        else:
+            threads = [threading.Thread(target=run, args=phase) for phase in phases]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return [name for name, function in phases if name in failed]
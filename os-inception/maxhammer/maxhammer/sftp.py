@@ -1,8 +1,26 @@
 import paramiko
 import os
 import logging
+import pipes
+import sys
+import tarfile
+import threading
+import Queue
 from maxhammer import fileutil
-from stat import S_ISDIR, S_IWUSR
+from stat import S_ISDIR, S_IMODE, S_IWUSR
+
+# Number of SFTP channels opened on the transport for parallel transfers
+DEFAULT_CHANNELS = 4
+# Size of each read/write issued against a file during a transfer
+TRANSFER_CHUNK_SIZE = 32768
+# Maximum number of directory listings held waiting for a remote walk's consumer
+WALK_QUEUE_SIZE = 64
+# Run remotely by whichever python is there to atomically exchange two paths with renameat2(RENAME_EXCHANGE),
+# as fileutil._exchange_paths does locally. Fails where the remote kernel or libc lack renameat2.
+REMOTE_EXCHANGE = ('import ctypes, ctypes.util, os, sys; '
+                   'libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True); '
+                   'paths = [getattr(os, "fsencode", lambda p: p)(p) for p in sys.argv[1:3]]; '
+                   'sys.exit(libc.renameat2(-100, paths[0], -100, paths[1], 2) != 0)')
 
 class Server(object):
     """
@@ -37,42 +55,283 @@ class Server(object):
             else:
                 raise Exception('Must supply either key_file or password')
         self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+        self._owns_transport = True
+
+
+    @classmethod
+    def from_transport(cls, transport):
+        """
+        Wrap an already-authenticated transport, such as one held in a connection.ConnectionPool.
+        Closing the resulting Server leaves the transport open.
+        :param transport: Authenticated paramiko Transport
+        :return: Server
+        """
+        server = cls.__new__(cls)
+        server.transport = transport
+        server.sftp = paramiko.SFTPClient.from_transport(transport)
+        server._owns_transport = False
+        return server
 
 
-    def upload_filtered(self, localpath, remotepath, include_list=[], exclude_list=[]):
+    def open_channels(self, count=DEFAULT_CHANNELS):
+        """
+        Open additional SFTP channels on the existing transport
+        :param count: Total number of channels wanted, including the primary channel
+        :return: List of SFTP clients, the first being the primary channel
+        """
+        channels = [self.sftp]
+        for i in range(1, max(count, 1)):
+            channels.append(paramiko.SFTPClient.from_transport(self.transport))
+        return channels
+
+
+    def _run_on_channels(self, channels, tasks, handler):
+        """
+        Spread tasks across SFTP channels, one worker thread per channel
+        :param channels: List of SFTP clients to use
+        :param tasks: Iterable of tasks, each passed to the handler alongside a channel
+        :param handler: Callable of the form handler(sftp, task)
+        :return:
+        """
+        queue = Queue.Queue()
+        for task in tasks:
+            queue.put(task)
 
-        # Create the base remote path first
+        errors = []
+
+        def worker(sftp):
+            while not errors:
+                try:
+                    task = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    handler(sftp, task)
+                except Exception as error:
+                    errors.append(error)
+
+        threads = [threading.Thread(target=worker, args=(sftp,)) for sftp in channels]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+
+    def _remote_listing(self, remotepath, sftp_channels=None):
+        """
+        List the attributes of everything beneath a remote path
+        :param remotepath: Remote directory to list
+        :param sftp_channels: SFTP channels to list with, defaults to the primary channel
+        :return: Dict of path (relative to remotepath) to SFTPAttributes, empty if remotepath is absent
+        """
+        listing = {}
+        for path, dirs, files in self._walk_attr(sftp_channels or [self.sftp], remotepath):
+            reldir = os.path.relpath(path, remotepath)
+            if reldir == '.':
+                reldir = ''
+            for entry in dirs + files:
+                listing[os.path.join(reldir, entry.filename)] = entry
+        return listing
+
+
+    def _walk_local(self, localpath, include_list=[], exclude_list=[]):
+        """
+        Walk a local tree, applying the supplied include/exclude filters
+        :param localpath: Local directory to walk
+        :return: Tuple of (directories, files), both relative to localpath
+        """
+        dirs_found = []
+        files_found = []
+        wanted = fileutil.compile_path_filter(include_list, exclude_list)
+        for root, dirs, files in os.walk(localpath):
+            if include_list or exclude_list:
+                dirs[:] = [d for d in dirs if wanted(root, d)]
+                files[:] = [f for f in files if wanted(root, f)]
+
+            reldir = os.path.relpath(root, localpath)
+            if reldir == '.':
+                reldir = ''
+            dirs_found.extend(os.path.join(reldir, d) for d in dirs)
+            files_found.extend(os.path.join(reldir, f) for f in files)
+        return dirs_found, files_found
+
+
+    def upload_parallel(self, localpath, remotepath, dirs=None, files=None, channels=DEFAULT_CHANNELS,
+                        preserve_permission=True):
+        """
+        Upload a tree over several SFTP channels at once, with pipelined writes.
+
+        The remote side is listed once up front, so existing files and directories need no
+        per-file stat, and each file gets a single setstat once its content is written.
+        :param localpath: Local directory to upload from
+        :param remotepath: Remote directory to upload into
+        :param dirs: Directories (relative to localpath) to create, defaults to the full tree
+        :param files: Files (relative to localpath) to upload, defaults to the full tree
+        :param channels: Number of SFTP channels to spread the files across
+        :param preserve_permission: Apply the local file mode to the remote file
+        :return: Dict of the number of files and bytes uploaded
+        """
+        if dirs is None or files is None:
+            walked_dirs, walked_files = self._walk_local(localpath)
+            dirs = walked_dirs if dirs is None else dirs
+            files = walked_files if files is None else files
+
+        sftp_channels = self.open_channels(channels)
         try:
-            self.sftp.mkdir(remotepath)
-        except:
-            pass
+            return self._upload_parallel(sftp_channels, localpath, remotepath, dirs, files, preserve_permission)
+        finally:
+            for sftp in sftp_channels[1:]:
+                sftp.close()
 
-        # Switch to the directory we wnat to copy across
-        os.chdir(localpath)
-        for root, dirs, files in os.walk('.'):
-        #for root, dirs, files in os.walk(localpath):
-            if exclude_list:
-                #dirs[:] = [d for d in dirs if not os.path.join(root, d) in exclude_list]
-                dirs[:] = [d for d in dirs if not fileutil.check_include(root, d, exclude_list)]
-                files[:] = [f for f in files if not fileutil.check_include(root, f, exclude_list)]
 
-            if include_list:
-                dirs[:] = [d for d in dirs if fileutil.check_include(root, d, include_list)]
-                files[:] = [f for f in files if fileutil.check_include(root, f, include_list)]
+    def _upload_parallel(self, sftp_channels, localpath, remotepath, dirs, files, preserve_permission):
+        remote_entries = self._remote_listing(remotepath, sftp_channels)
 
+        # Create any missing directories, parents first
+        for reldir in [''] + sorted(set(dirs), key=lambda d: d.count(os.sep)):
+            if reldir and reldir in remote_entries:
+                continue
+            if not reldir and remote_entries:
+                continue
+            remote_create_path = os.path.join(remotepath, reldir)
+            logging.getLogger().debug("Creating remote dir {}".format(remote_create_path))
             try:
-                remote_create_path = os.path.join(remotepath, root)
-                logging.getLogger().debug("Creating remote dir {}".format(remote_create_path))
                 self.sftp.mkdir(remote_create_path)
-            except:
+            except IOError:
                 pass
 
-            for file in files:
-                source_file_path = os.path.join(root, file)
-                remote_file_path = os.path.join(remote_create_path, file)
-                logged_source_file_path = os.path.join(localpath, source_file_path)
-                logging.getLogger().debug("Uploading file FROM: {} TO: {}".format(source_file_path, remote_file_path))
-                self.upload(source_file_path, remote_file_path)
+        # Largest files first, so the channels finish at roughly the same time
+        tasks = []
+        for relfile in files:
+            st = os.stat(os.path.join(localpath, relfile))
+            tasks.append((relfile, st.st_size, S_IMODE(st.st_mode)))
+        tasks.sort(key=lambda task: task[1], reverse=True)
+
+        lock = threading.Lock()
+        totals = {'files': 0, 'bytes': 0}
+
+        def send(sftp, task):
+            relfile, size, mode = task
+            source_file_path = os.path.join(localpath, relfile)
+            remote_file_path = os.path.join(remotepath, relfile)
+            logging.getLogger().debug("Uploading file FROM: {} TO: {}".format(source_file_path, remote_file_path))
+
+            # If the remote file already exists without user-write, make it writable first
+            existing = remote_entries.get(relfile)
+            try:
+                if existing is not None and not existing.st_mode & S_IWUSR:
+                    sftp.chmod(remote_file_path, mode | S_IWUSR)
+
+                with open(source_file_path, 'rb') as source:
+                    with sftp.open(remote_file_path, 'wb') as destination:
+                        destination.set_pipelined(True)
+                        while True:
+                            data = source.read(TRANSFER_CHUNK_SIZE)
+                            if not data:
+                                break
+                            destination.write(data)
+                        if preserve_permission:
+                            destination.chmod(mode)
+            except Exception as error:
+                raise Exception("Error uploading {} to remote location {}: {}".format(
+                    source_file_path, remote_file_path, str(error)))
+
+            with lock:
+                totals['files'] += 1
+                totals['bytes'] += size
+
+        self._run_on_channels(sftp_channels, tasks, send)
+        return totals
+
+
+    def upload_filtered(self, localpath, remotepath, include_list=[], exclude_list=[], channels=DEFAULT_CHANNELS):
+        dirs, files = self._walk_local(localpath, include_list, exclude_list)
+        return self.upload_parallel(localpath, remotepath, dirs=dirs, files=files, channels=channels)
+
+
+    def upload_tar(self, localpath, remotepath, dirs=None, files=None, compression='gz', update=False, deletes=()):
+        """
+        Stream a compressed tar of a tree over a single SSH exec channel.
+
+        The remote side extracts into a sibling staging directory, preserving file modes, and only
+        swaps it into place at remotepath once extraction has fully succeeded. The swap is an atomic exchange
+        where the remote has a python and renameat2 to make it with. Otherwise the current tree is moved
+        aside before the staging directory is moved into place, leaving a moment with nothing at remotepath.
+        :param localpath: Local directory to upload from
+        :param remotepath: Remote directory to replace with the uploaded tree
+        :param dirs: Directories (relative to localpath) to include, defaults to the full tree
+        :param files: Files (relative to localpath) to include, defaults to the full tree
+        :param compression: tarfile compression to stream with ('gz', 'bz2' or '' for none)
+        :param update: Seed the staging directory with hardlinks of the current tree, so only the dirs and
+                       files that changed need sending
+        :param deletes: With update, paths (relative to remotepath) to remove from the current tree
+        :return: Dict of the number of files and bytes uploaded
+        """
+        if dirs is None or files is None:
+            walked_dirs, walked_files = self._walk_local(localpath)
+            dirs = walked_dirs if dirs is None else dirs
+            files = walked_files if files is None else files
+
+        remotepath = remotepath.rstrip('/')
+        parent, name = os.path.split(remotepath)
+        staging = os.path.join(parent, '.{}.mh-staging'.format(name))
+        previous = os.path.join(parent, '.{}.mh-previous'.format(name))
+        tar_flags = {'gz': 'z', 'bz2': 'j', '': ''}[compression]
+
+        quoted = {'staging': pipes.quote(staging), 'previous': pipes.quote(previous),
+                  'dest': pipes.quote(remotepath), 'flags': tar_flags, 'unlink': '',
+                  'exchange': pipes.quote(REMOTE_EXCHANGE)}
+        seed = ''
+        if update:
+            # --unlink-first has extracted files replace their links rather than write through them
+            seed = 'if [ -d {dest} ]; then cp -al {dest}/. {staging}/; fi; '.format(**quoted)
+            if deletes:
+                seed += 'rm -rf {}; '.format(' '.join(pipes.quote(os.path.join(staging, p)) for p in deletes))
+            quoted['unlink'] = '--unlink-first '
+        command = ('set -e; '
+                   'rm -rf {staging} {previous}; '
+                   'mkdir -p {staging}; ').format(**quoted) + seed + \
+                  ('tar -x{flags}pf - {unlink}-C {staging}; '
+                   'if [ -e {dest} ] && {{ python3 -c {exchange} {staging} {dest} || '
+                   'python -c {exchange} {staging} {dest}; }} 2>/dev/null; then '
+                   # the staging directory now holds the tree it replaced
+                   'rm -rf {staging}; '
+                   'else '
+                   'if [ -e {dest} ]; then mv {dest} {previous}; fi; '
+                   'mv {staging} {dest}; '
+                   'rm -rf {previous}; '
+                   'fi').format(**quoted)
+
+        logging.getLogger().debug("Streaming tar of {} to remote location {}".format(localpath, remotepath))
+        totals = {'files': 0, 'bytes': 0}
+        channel = self.transport.open_session()
+        try:
+            channel.exec_command(command)
+            stream = channel.makefile('wb')
+            tar = tarfile.open(fileobj=stream, mode='w|' + compression)
+            for reldir in sorted(dirs):
+                tar.add(os.path.join(localpath, reldir), arcname=reldir, recursive=False)
+            for relfile in files:
+                source_file_path = os.path.join(localpath, relfile)
+                tar.add(source_file_path, arcname=relfile, recursive=False)
+                totals['files'] += 1
+                totals['bytes'] += os.lstat(source_file_path).st_size
+            tar.close()
+            stream.close()
+            channel.shutdown_write()
+
+            rc = channel.recv_exit_status()
+            if rc:
+                error = channel.makefile_stderr('rb').read()
+                raise Exception("Error extracting tar stream into remote location {}, return code {}: {}".format(
+                    remotepath, rc, error.strip()))
+        finally:
+            channel.close()
+
+        return totals
 
 
     def get_perms(self, localfile):
@@ -96,50 +355,178 @@ class Server(object):
             raise Exception("Error uploading {} to remote location {}: {}".format(localfile,remotefile,str(error)))
 
 
-    def upload_all(self, localpath, remotepath):
-        # Recursively upload a full directory
-        os.chdir(os.path.split(localpath)[0])
+    def upload_all(self, localpath, remotepath, channels=DEFAULT_CHANNELS):
+        # Recursively upload a full directory, including the directory itself
+        localpath = localpath.rstrip(os.sep)
         parent = os.path.split(localpath)[1]
-        for walker in os.walk(parent):
-            try:
-                self.sftp.mkdir(os.path.join(remotepath, walker[0]))
-            except:
-                pass
-            for file in walker[2]:
-                self.upload(os.path.join(walker[0], file), os.path.join(remotepath, walker[0], file))
+        try:
+            self.sftp.mkdir(remotepath)
+        except IOError:
+            pass
+        return self.upload_parallel(localpath, os.path.join(remotepath, parent), channels=channels)
 
     def download(self, remote, local):
         self.sftp.get(remote, local)
 
-    def sftp_walk(self, remotepath):
+    def _walk_attr(self, sftp_channels, remotepath):
+        """
+        Walk a remote tree, listing directories concurrently across the supplied channels.
+
+        Listings are handed back through a bounded queue, and a directory is always yielded before
+        any of its subdirectories.
+        :param sftp_channels: SFTP channels to list with, one worker thread per channel
+        :param remotepath: Remote directory to walk
+        :return: Generator of (path, directory attributes, file attributes)
+        """
+        pending = Queue.Queue()
+        results = Queue.Queue(WALK_QUEUE_SIZE)
+        state = {'outstanding': 1, 'stopped': False}
+        lock = threading.Lock()
+
+        def deliver(item):
+            while not state['stopped']:
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def worker(sftp):
+            while not state['stopped']:
+                try:
+                    path = pending.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                if path is None:
+                    return
+                error = failure = None
+                try:
+                    entries = sftp.listdir_attr(path)
+                except IOError as err:
+                    entries = []
+                    error = err
+                except Exception:
+                    # the channel itself failed: the walk can't complete, so the consumer re-raises it
+                    entries = []
+                    failure = sys.exc_info()
+                dirs = [f for f in entries if S_ISDIR(f.st_mode)]
+                files = [f for f in entries if not S_ISDIR(f.st_mode)]
+
+                # hand over this listing before queueing its children, so parents come out first
+                deliver((path, dirs, files, error, failure))
+                with lock:
+                    state['outstanding'] += len(dirs) - 1
+                    finished = state['outstanding'] == 0
+                for d in dirs:
+                    pending.put(os.path.join(path, d.filename))
+                if finished:
+                    deliver(None)
+
+        pending.put(remotepath)
+        threads = [threading.Thread(target=worker, args=(sftp,)) for sftp in sftp_channels]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                item = results.get()
+                if item is None:
+                    return
+                path, dirs, files, error, failure = item
+                if failure is not None:
+                    raise failure[0], failure[1], failure[2]
+                if error is not None:
+                    # a missing top-level path is an empty tree, anything deeper is worth a mention
+                    if path != remotepath:
+                        logging.getLogger().debug("Unable to list remote dir {}: {}".format(path, str(error)))
+                    continue
+                yield path, dirs, files
+        finally:
+            state['stopped'] = True
+            for thread in threads:
+                pending.put(None)
+            for thread in threads:
+                thread.join()
+
+    def walk_attr(self, remotepath, channels=DEFAULT_CHANNELS):
+        """
+        Walk a remote tree with concurrent directory listings
+        :param remotepath: Remote directory to walk
+        :param channels: Number of SFTP channels to list with
+        :return: Generator of (path, directory attributes, file attributes), each attribute carrying its filename
+        """
+        sftp_channels = self.open_channels(channels)
+        try:
+            for item in self._walk_attr(sftp_channels, remotepath):
+                yield item
+        finally:
+            for sftp in sftp_channels[1:]:
+                sftp.close()
+
+    def sftp_walk(self, remotepath, channels=DEFAULT_CHANNELS):
         # Kind of a stripped down version of os.walk, implemented for sftp.
-        path = remotepath
-        files = []
-        folders = []
-        for f in self.sftp.listdir_attr(remotepath):
-            if S_ISDIR(f.st_mode):
-                folders.append(f.filename)
-        print (path, folders, files)
-        yield path, folders, files
-        for folder in folders:
-            new_path = os.path.join(remotepath, folder)
-            for x in self.sftp_walk(new_path):
-                yield x
-
-    def download_all(self, remotepath, localpath):
-        self.sftp.chdir(os.path.split(remotepath)[0])
-        parent = os.path.split(remotepath)[1]
+        for path, dirs, files in self.walk_attr(remotepath, channels=channels):
+            yield path, [d.filename for d in dirs], [f.filename for f in files]
+
+    def download_all(self, remotepath, localpath, channels=DEFAULT_CHANNELS):
+        """
+        Recursively download a full remote directory into localpath, fetching files over several
+        channels with read-ahead. The remote directory itself is created within localpath.
+        :param remotepath: Remote directory to download
+        :param localpath: Local directory to download into
+        :param channels: Number of SFTP channels to fetch with
+        :return: Dict of the number of files and bytes downloaded
+        """
+        remotepath = remotepath.rstrip('/')
+        remote_parent, parent = os.path.split(remotepath)
         try:
             os.mkdir(localpath)
-        except:
+        except OSError:
             pass
-        for walker in self.sftp_walk(parent):
-            try:
-                os.mkdir(os.path.join(localpath,walker[0]))
-            except:
-                pass
-            for file in walker[2]:
-                self.download(os.path.join(walker[0], file), os.path.join(localpath, walker[0], file))
+
+        sftp_channels = self.open_channels(channels)
+        try:
+            tasks = []
+            for path, dirs, files in self._walk_attr(sftp_channels, remotepath):
+                local_dir = os.path.join(localpath, os.path.relpath(path, remote_parent))
+                try:
+                    os.mkdir(local_dir)
+                except OSError:
+                    pass
+                for f in files:
+                    tasks.append((os.path.join(path, f.filename), os.path.join(local_dir, f.filename), f))
+            tasks.sort(key=lambda task: task[2].st_size, reverse=True)
+
+            lock = threading.Lock()
+            totals = {'files': 0, 'bytes': 0}
+
+            def fetch(sftp, task):
+                remote_file_path, local_file_path, attr = task
+                logging.getLogger().debug("Downloading file FROM: {} TO: {}".format(remote_file_path, local_file_path))
+                try:
+                    with sftp.open(remote_file_path, 'rb') as source:
+                        source.prefetch(attr.st_size)
+                        with open(local_file_path, 'wb') as destination:
+                            while True:
+                                data = source.read(TRANSFER_CHUNK_SIZE)
+                                if not data:
+                                    break
+                                destination.write(data)
+                    os.chmod(local_file_path, S_IMODE(attr.st_mode))
+                except Exception as error:
+                    raise Exception("Error downloading {} to local location {}: {}".format(
+                        remote_file_path, local_file_path, str(error)))
+                with lock:
+                    totals['files'] += 1
+                    totals['bytes'] += attr.st_size
+
+            self._run_on_channels(sftp_channels, tasks, fetch)
+        finally:
+            for sftp in sftp_channels[1:]:
+                sftp.close()
+
+        return totals
 
     def close(self):
         """
@@ -147,7 +534,8 @@ class Server(object):
         """
         if self.transport.is_active():
             self.sftp.close()
-            self.transport.close()
+            if self._owns_transport:
+                self.transport.close()
 
     # with statement support
     def __enter__(self):
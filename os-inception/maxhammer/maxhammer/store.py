@@ -0,0 +1,228 @@
+import cPickle
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from maxhammer import fileutil
+
+# Size of each read when hashing a file into the store
+HASH_CHUNK_SIZE = 1048576
+
+
+class ArtifactStore:
+    """
+    Content-addressed local store of rendered and copied build outputs.
+
+    Objects are keyed by content hash and file mode, and build trees are materialized as hardlinks
+    to them, so identical files across modules, sources and branches are only stored once. Render
+    results are indexed by a key describing the template and its inputs, so identical templates
+    rendered against identical clouddata are only rendered once.
+    """
+
+    def __init__(self, path, max_size=None, logger=None):
+        """
+        :param path: Directory holding the store, created if it doesn't exist
+        :param max_size: Size cap in bytes, beyond which least-recently-used objects are evicted
+        :return:
+        """
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_size = max_size
+        self.logger = logger or logging.getLogger(__name__)
+        self._objects_dir = os.path.join(self.path, 'objects')
+        self._tmp_dir = os.path.join(self.path, 'tmp')
+        self._index_file = os.path.join(self.path, 'index')
+        self._lock = threading.Lock()
+
+        for d in (self._objects_dir, self._tmp_dir):
+            if not os.path.isdir(d):
+                os.makedirs(d, 0755)
+        self._index = self._load_index()
+
+    def _load_index(self):
+        """
+        Load the render index and object usage times
+        :return:
+        """
+        try:
+            with open(self._index_file, 'rb') as stream:
+                return cPickle.load(stream)
+        except Exception:
+            return {'renders': {}, 'used': {}}
+
+    def _save_index(self):
+        """
+        Persist the render index and object usage times
+        :return:
+        """
+        fd, tmpfile = tempfile.mkstemp(dir=self._tmp_dir)
+        with os.fdopen(fd, 'wb') as stream:
+            cPickle.dump(self._index, stream, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, self._index_file)
+
+    def _object_path(self, objname):
+        return os.path.join(self._objects_dir, objname[:2], objname)
+
+    def _touch(self, objname):
+        with self._lock:
+            self._index['used'][objname] = time.time()
+
+    def _insert(self, tmpfile, digest, mode):
+        """
+        Move a fully-written temporary file into the store under its content address
+        :return: Object name
+        """
+        objname = '{}-{:o}'.format(digest, mode)
+        objpath = self._object_path(objname)
+        if os.path.exists(objpath):
+            os.remove(tmpfile)
+        else:
+            objdir = os.path.dirname(objpath)
+            if not os.path.isdir(objdir):
+                try:
+                    os.mkdir(objdir, 0755)
+                except OSError:
+                    pass
+            os.chmod(tmpfile, mode)
+            os.rename(tmpfile, objpath)
+        self._touch(objname)
+        return objname
+
+    def mkdtemp(self, suffix=''):
+        """
+        Create a temporary build directory on the same filesystem as the store, so it can hold hardlinks
+        :param suffix: Suffix of the directory name
+        :return: Path to the new directory
+        """
+        return tempfile.mkdtemp(suffix, dir=self._tmp_dir)
+
+    def put_file(self, srcfile, mode):
+        """
+        Add a file's content to the store
+        :param srcfile: Path of the file to store
+        :param mode: Permission bits the stored object should carry
+        :return: Object name
+        """
+        st = os.stat(srcfile)
+        # content already stored under a digest cached for the file needn't be read at all
+        known = fileutil.DIGESTS.lookup(srcfile, st)
+        if known is not None:
+            objname = '{}-{:o}'.format(known, stat.S_IMODE(mode))
+            if os.path.exists(self._object_path(objname)):
+                self._touch(objname)
+                return objname
+
+        digest = hashlib.sha1()
+        fd, tmpfile = tempfile.mkstemp(dir=self._tmp_dir)
+        with open(srcfile, 'rb') as source, os.fdopen(fd, 'wb') as destination:
+            while True:
+                data = source.read(HASH_CHUNK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                destination.write(data)
+        fileutil.DIGESTS.record(srcfile, digest.hexdigest(), st)
+        return self._insert(tmpfile, digest.hexdigest(), stat.S_IMODE(mode))
+
+    def put_content(self, data, mode):
+        """
+        Add a string of bytes to the store
+        :param data: Bytes to store
+        :param mode: Permission bits the stored object should carry
+        :return: Object name
+        """
+        fd, tmpfile = tempfile.mkstemp(dir=self._tmp_dir)
+        with os.fdopen(fd, 'wb') as destination:
+            destination.write(data)
+        return self._insert(tmpfile, hashlib.sha1(data).hexdigest(), stat.S_IMODE(mode))
+
+    def link(self, objname, destfile):
+        """
+        Materialize a stored object at destfile, as a hardlink where possible
+        :param objname: Object name
+        :param destfile: Path to materialize the object at
+        :return:
+        """
+        objpath = self._object_path(objname)
+        if os.path.lexists(destfile):
+            os.remove(destfile)
+        try:
+            os.link(objpath, destfile)
+        except OSError:
+            shutil.copy2(objpath, destfile)
+        self._touch(objname)
+
+    def render_key(self, *parts):
+        """
+        Build a render index key from the inputs that determine a render's output
+        :param parts: Strings or JSON-serializable values describing the render
+        :return: Render key
+        """
+        digest = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, basestring):
+                part = json.dumps(part, sort_keys=True, default=str)
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            digest.update(hashlib.sha1(part).digest())
+        return digest.hexdigest()
+
+    def lookup_render(self, key):
+        """
+        Find the object holding a previous render's output
+        :param key: Render key
+        :return: Object name, or None if the render isn't stored
+        """
+        objname = self._index['renders'].get(key)
+        if objname is None or not os.path.exists(self._object_path(objname)):
+            return None
+        return objname
+
+    def record_render(self, key, objname):
+        """
+        Record the object holding a render's output
+        :param key: Render key
+        :param objname: Object name
+        :return:
+        """
+        with self._lock:
+            self._index['renders'][key] = objname
+
+    def evict(self):
+        """
+        Evict least-recently-used objects until the store is within its size cap, then persist the
+        store's index. Objects currently linked into a build tree are never evicted.
+        :return: Number of bytes evicted
+        """
+        with self._lock:
+            objects = []
+            total = 0
+            for root, dirs, files in os.walk(self._objects_dir):
+                for f in files:
+                    st = os.stat(os.path.join(root, f))
+                    objects.append((self._index['used'].get(f, st.st_mtime), f, st))
+                    total += st.st_size
+
+            evicted = 0
+            removed = set()
+            if self.max_size is not None and total > self.max_size:
+                objects.sort()
+                for used, objname, st in objects:
+                    if total - evicted <= self.max_size:
+                        break
+                    if st.st_nlink > 1:
+                        continue
+                    os.remove(self._object_path(objname))
+                    self._index['used'].pop(objname, None)
+                    removed.add(objname)
+                    evicted += st.st_size
+
+                self._index['renders'] = dict((k, v) for k, v in self._index['renders'].items() if v not in removed)
+                self.logger.debug("Evicted {} bytes from artifact store {}".format(evicted, self.path))
+
+            self._save_index()
+            return evicted
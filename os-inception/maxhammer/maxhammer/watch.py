@@ -0,0 +1,227 @@
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify event flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+# Seconds to wait for a burst of changes (an editor save, a git checkout) to settle before reporting it
+DEFAULT_DEBOUNCE = 0.5
+# Seconds between scans when inotify isn't available
+DEFAULT_POLL_INTERVAL = 2
+
+# Names never worth a rebuild: version control internals and editor scratch files
+IGNORE_PATTERNS = ['.git', '*.swp', '*.swx', '*~', '.#*', '4913']
+
+
+def _ignored(path):
+    return any(fnmatch.fnmatch(part, pattern) for part in path.split(os.sep) for pattern in IGNORE_PATTERNS)
+
+
+class Watcher:
+    """
+    Watches directory trees and individual files for changes, via inotify where available and by
+    polling otherwise
+    """
+
+    def __init__(self, paths, debounce=DEFAULT_DEBOUNCE, poll_interval=DEFAULT_POLL_INTERVAL, logger=None):
+        """
+        :param paths: Directories (watched recursively) and files to watch
+        :param debounce: Seconds without further changes before a set of changes is reported
+        :param poll_interval: Seconds between scans when polling
+        :return:
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.trees = [os.path.abspath(p) for p in paths if os.path.isdir(p)]
+        self.files = set(os.path.abspath(p) for p in paths if not os.path.isdir(p))
+        self._watches = {}
+        self._fd = None
+
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            self._fd = fd
+        except (OSError, AttributeError, TypeError) as error:
+            self.logger.warning("inotify is unavailable ({}), polling for changes every {}s".format(
+                str(error), poll_interval))
+            self._snapshot = self._scan()
+            return
+
+        for tree in self.trees:
+            self._add_tree(tree)
+        # files are watched through their directory, so they're still seen when editors replace them
+        for path in set(os.path.dirname(f) for f in self.files):
+            self._add_watch(path)
+
+    def _add_watch(self, path):
+        encoded = path.encode(sys.getfilesystemencoding()) if isinstance(path, unicode) else path
+        wd = self._libc.inotify_add_watch(self._fd, encoded, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, os.strerror(err), path)
+        self._watches[wd] = path
+
+    def _add_tree(self, path):
+        """
+        Watch a directory and everything beneath it
+        :return: Files found beneath the directory
+        """
+        found = []
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not _ignored(d)]
+            self._add_watch(root)
+            found.extend(os.path.join(root, f) for f in files)
+        return found
+
+    def _watched(self, path):
+        if path in self.files:
+            return True
+        return any(path == tree or path.startswith(tree + os.sep) for tree in self.trees)
+
+    def _read_events(self):
+        """
+        Read and decode pending inotify events
+        :return: Set of changed paths
+        """
+        changed = set()
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return changed
+            raise
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so anything could have changed
+                self.logger.warning("Missed some change notifications, treating everything as changed")
+                changed.update(self.trees)
+                changed.update(self.files)
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if _ignored(os.path.relpath(path, directory)) or not self._watched(path):
+                continue
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # new directories need watches of their own, and anything already in them counts as changed
+                changed.update(self._add_tree(path))
+        return changed
+
+    def _scan(self):
+        """
+        Stat every watched file
+        :return: Dict of path to (mtime, size, mode)
+        """
+        snapshot = {}
+        for path in self.files:
+            try:
+                st = os.stat(path)
+                snapshot[path] = (st.st_mtime, st.st_size, st.st_mode)
+            except OSError:
+                pass
+        for tree in self.trees:
+            for root, dirs, files in os.walk(tree):
+                dirs[:] = [d for d in dirs if not _ignored(d)]
+                for f in files:
+                    if _ignored(f):
+                        continue
+                    path = os.path.join(root, f)
+                    try:
+                        st = os.stat(path)
+                        snapshot[path] = (st.st_mtime, st.st_size, st.st_mode)
+                    except OSError:
+                        pass
+        return snapshot
+
+    def _poll(self, timeout):
+        """
+        Wait for changes to show up between scans
+        :return: Set of changed paths
+        """
+        time.sleep(timeout)
+        snapshot = self._scan()
+        changed = set(p for p in snapshot if self._snapshot.get(p) != snapshot[p])
+        changed.update(p for p in self._snapshot if p not in snapshot)
+        self._snapshot = snapshot
+        return changed
+
+    def _collect(self, timeout):
+        if self._fd is None:
+            return self._poll(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        return self._read_events() if readable else set()
+
+    def wait(self, timeout=None):
+        """
+        Block until something changes, then until changes have stopped for the debounce period
+        :param timeout: Seconds to wait for a first change, or None to wait indefinitely
+        :return: Sorted list of changed paths, empty if the timeout passed without changes
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        changed = set()
+        while not changed:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+            changed = self._collect(remaining)
+
+        while True:
+            more = self._collect(self.debounce)
+            if not more:
+                break
+            changed.update(more)
+        return sorted(changed)
+
+    def close(self):
+        """
+        Stop watching
+        :return:
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._watches = {}
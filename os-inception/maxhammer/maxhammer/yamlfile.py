@@ -0,0 +1,114 @@
+import cPickle
+import logging
+import os
+import tempfile
+import threading
+import yaml
+from maxhammer import metrics
+
+# Loader used for all YAML parsing, the libyaml-based one when PyYAML was built with it
+Loader = getattr(yaml, 'CLoader', yaml.Loader)
+
+# Default location of the persistent cache of parsed YAML files
+DEFAULT_CACHE_PATH = '~/.cache/maxhammer/parsed-yaml'
+
+# Cache format, bumped whenever the layout changes. The PyYAML version is part of it too, as a
+# different parser may produce different documents from the same file.
+CACHE_FORMAT = (2, yaml.__version__)
+
+
+def parse(stream):
+    """
+    Parse a YAML document
+    :param stream: String or open file
+    :return: The parsed document
+    """
+    return yaml.load(stream, Loader=Loader)
+
+
+class ParsedCache:
+    """
+    Cache of parsed YAML files, keyed by path and checked against the file's device, inode, size,
+    modification time and inode change time, the same as fileutil.DigestCache. A file rewritten with the same
+    size and modification time, as a checkout or restore can, still has a new change time.
+
+    Documents are held pickled, so every load hands out a fresh copy the caller is free to modify,
+    and unpickling is far quicker than parsing. With a path, the cache is kept on disk between runs.
+    """
+
+    def __init__(self, path=None, logger=None):
+        """
+        :param path: File to persist the cache to, or None to cache in memory only
+        :return:
+        """
+        self.path = os.path.abspath(os.path.expanduser(path)) if path else None
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._entries = self._read()
+        self._dirty = False
+
+    def _read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'rb') as stream:
+                cached = cPickle.load(stream)
+            if cached.get('format') == CACHE_FORMAT:
+                return cached['entries']
+        except Exception as error:
+            self.logger.warning("Ignoring unreadable YAML cache {}: {}".format(self.path, str(error)))
+        return {}
+
+    def load(self, filename):
+        """
+        Load a YAML file, parsing it only if it changed since it was last cached
+        :param filename: File to load
+        :return: The parsed document
+        """
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        stamp = (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+        with self._lock:
+            entry = self._entries.get(filename)
+        if entry is not None and entry[0] == stamp:
+            metrics.count('yaml_cached')
+            return cPickle.loads(entry[1])
+
+        with open(filename, 'r') as stream:
+            document = parse(stream)
+        metrics.count('yaml_parsed')
+        with self._lock:
+            self._entries[filename] = (stamp, cPickle.dumps(document, cPickle.HIGHEST_PROTOCOL))
+            self._dirty = True
+        return document
+
+    def save(self):
+        """
+        Persist the cache, dropping files that no longer exist
+        :return:
+        """
+        if self.path is None or not self._dirty:
+            return
+        with self._lock:
+            entries = dict((k, v) for k, v in self._entries.items() if os.path.exists(k))
+            self._dirty = False
+
+        cache_dir = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0700)
+            # written aside and renamed into place, so concurrent runs never see a partial cache
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.parsed-yaml')
+            with os.fdopen(fd, 'wb') as stream:
+                cPickle.dump({'format': CACHE_FORMAT, 'entries': entries}, stream, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except Exception as error:
+            self.logger.warning("Could not save YAML cache {}: {}".format(self.path, str(error)))
+
+
+# Cache used by load(), in memory only unless replaced with a persistent one
+CACHE = ParsedCache()
+
+
+def load(filename):
+    return CACHE.load(filename)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark of remote tree distribution through the manifest-driven Distribution.distribute path.
+
+Distributes a generated tree to a local paramiko server with the tar transfer method and, when the system
+has sshd and rsync, to a loopback sshd with both transfer methods. Each is timed for a cold run into an
+empty destination and for a re-run with nothing changed. Run from the tests directory:
+
+    PYTHONPATH=..:../../foremanapi python -m benchmarks.bench_distribution --files 500 --latency 0.005 --output dist.json
+"""
+import argparse
+import distutils.spawn
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import paramiko
+import yaml
+from maxhammer import distribution, metrics
+from benchmarks.bench_sftp import make_tree
+from sshstub import SSHStub, LoopbackSSHD
+
+MODULE = 'payload'
+
+
+def _distribute(base, transfer_method, clouddata, remote_path):
+    """
+    Distribute the generated tree once through a manifest
+    :return: (seconds, bytes transferred)
+    """
+    manifest = {'maxhammer': {'process_paths': {MODULE: {
+        'process_method': 'none',
+        'sources': [MODULE],
+        'transfer_method': transfer_method,
+        'remote_hosts': [{'host': 'bench', 'destination': remote_path}]}}}}
+    manifest_path = os.path.join(base, 'maxhammer.yaml')
+    with open(manifest_path, 'w') as fh:
+        yaml.safe_dump(manifest, fh)
+
+    metrics.RUN.reset()
+    start = time.time()
+    dist = distribution.Distribution(manifest_path, clouddata_config=clouddata, source_base=base,
+                                     send_to_local=False)
+    try:
+        if not dist.precheck():
+            raise Exception("Distribution pre-check failed")
+        dist.distribute()
+    finally:
+        dist.close()
+    elapsed = time.time() - start
+    sent = sum(c['value'] for c in metrics.RUN.report()['counters'] if c['name'] == 'bytes_transferred')
+    return elapsed, sent
+
+
+def _cases(base, label, transfer_methods, clouddata, files, total_bytes):
+    results = []
+    for transfer_method in transfer_methods:
+        remote_path = os.path.join(base, 'remote', label, transfer_method)
+        for case in ('cold', 'unchanged'):
+            seconds, sent = _distribute(base, transfer_method, clouddata, remote_path)
+            results.append({'case': '{}-{}-{}'.format(label, transfer_method, case),
+                            'seconds': round(seconds, 4),
+                            'files_per_sec': round(files / seconds, 1),
+                            'mb_per_sec': round(total_bytes / seconds / 1048576.0, 2),
+                            'bytes_transferred': sent})
+    return results
+
+
+def run(files=300, size=4096, latency=0, bandwidth=None):
+    base = tempfile.mkdtemp()
+    results = []
+    try:
+        make_tree(os.path.join(base, MODULE), files, size)
+        total_bytes = files * size
+        key_file = os.path.join(base, 'client_key')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_file)
+
+        with SSHStub(latency=latency, bandwidth=bandwidth) as stub:
+            clouddata = {'name': 'bench', 'environment': 'bench', 'maxhammer': {'bench': {
+                'host': '127.0.0.1', 'port': stub.port, 'user': 'bench', 'dist_key': key_file}}}
+            results.extend(_cases(base, 'paramiko', ['tar'], clouddata, files, total_bytes))
+
+        if LoopbackSSHD.available() and distutils.spawn.find_executable('rsync'):
+            with LoopbackSSHD(latency=latency, bandwidth=bandwidth) as sshd:
+                clouddata = {'name': 'bench', 'environment': 'bench', 'maxhammer': {'bench': {
+                    'host': '127.0.0.1', 'port': sshd.port, 'user': sshd.user, 'dist_key': sshd.client_key}}}
+                path = os.environ['PATH']
+                os.environ['PATH'] = sshd.bin_dir + os.pathsep + path
+                try:
+                    results.extend(_cases(base, 'sshd', ['rsync', 'tar'], clouddata, files, total_bytes))
+                finally:
+                    os.environ['PATH'] = path
+        else:
+            logging.getLogger(__name__).warning("sshd or rsync not found, skipping the loopback sshd cases")
+    finally:
+        shutil.rmtree(base)
+    return {'benchmark': 'distribution',
+            'parameters': {'files': files, 'file_size': size, 'latency': latency, 'bandwidth': bandwidth},
+            'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark remote distribution throughput')
+    parser.add_argument('--files', type=int, default=300, help='Number of files in the generated tree')
+    parser.add_argument('--size', type=int, default=4096, help='Size of each generated file in bytes')
+    parser.add_argument('--latency', type=float, default=0, help='One-way latency in seconds added to connections')
+    parser.add_argument('--bandwidth', type=int, help='Bandwidth cap in bytes per second on connections')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # servers going away at the end of a case reset their connections
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    report = run(files=args.files, size=args.size, latency=args.latency, bandwidth=args.bandwidth)
+    for result in report['results']:
+        print("{case:28} {seconds:8}s {files_per_sec:10} files/s {mb_per_sec:8} MB/s".format(**result))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Benchmark of hostgroup building, Foreman.process_config and cloud_create, against a stub Foreman.
+
+Generates a cloud of N hostgroups with M hosts, which already exists in the stub so it gets rebuilt, and
+counts the requests each stage makes. Run from the tests directory:
+
+    PYTHONPATH=..:../../foremanapi python -m benchmarks.bench_foreman --hostgroups 50 --hosts 100 --latency 0.01
+
+The run fails if it makes more requests than request_budget() allows, or takes longer than --max-seconds.
+Requests turned away as overloaded and retried aren't counted against the budget. To see the adaptive limits
+find how much the stub copes with, give it a --capacity or a --slowdown:
+
+    PYTHONPATH=..:../../foremanapi python -m benchmarks.bench_foreman --latency 0.01 --capacity 3 --write-ceiling 8
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import yaml
+from foremanapi import foreman as foremanapi
+from foremanapi import limiter
+from foremanapi import metrics as foremanmetrics
+from maxhammer import foreman
+from foremanstub import ForemanStub
+
+CLOUD_NAME = 'bench'
+BUILDSERVER = 'foreman.example.com'
+
+
+def make_cloud(stub, hostgroup_path, hostgroups=20, hosts=20, puppetclasses=10, parameters=3):
+    """
+    Generate a cloud: its reference data, its current hostgroups and hosts in the stub, and its hostgroup templates
+    :param stub: ForemanStub to populate
+    :param hostgroup_path: Directory to write the hostgroup templates to
+    :param hostgroups: Number of hostgroups, including Base
+    :param hosts: Number of hosts, spread over the hostgroups
+    :param puppetclasses: Number of puppetclasses, each with `parameters` smart class parameters
+    :return: Clouddata of the cloud
+    """
+    clouddata = {'name': CLOUD_NAME, 'buildserver': BUILDSERVER, 'environment': CLOUD_NAME,
+                 'domain': 'example.com', 'subnet': 'internal', 'realm': 'EXAMPLE.COM', 'architecture': 'x86_64',
+                 'operatingsystem': 'RHEL 7.2', 'media': 'RHEL mirror', 'ptable': 'Kickstart default'}
+    for table, key in (('environments', 'environment'), ('domains', 'domain'), ('subnets', 'subnet'),
+                       ('realms', 'realm'), ('architectures', 'architecture'),
+                       ('operatingsystems', 'operatingsystem'), ('media', 'media'), ('ptables', 'ptable'),
+                       ('smart_proxies', 'buildserver')):
+        table_id = stub.add(table, clouddata[key])
+        if table == 'environments':
+            environment_id = table_id
+    classes = ['profile::class{}'.format(k) for k in range(puppetclasses)]
+    class_ids = dict((name, stub.add_puppetclass(name, ['param{}'.format(p) for p in range(parameters)]))
+                     for name in classes)
+
+    # the cloud as a previous run left it
+    base_id = stub.add_hostgroup(CLOUD_NAME, puppetclass_ids=[class_ids[classes[0]]])
+    existing = [base_id] + [stub.add_hostgroup('role{}'.format(i), parent_id=base_id,
+                                               puppetclass_ids=[class_ids[classes[i % puppetclasses]]])
+                            for i in range(1, hostgroups)]
+    for h in range(hosts):
+        stub.add_host('node{}.example.com'.format(h), environment_id, existing[h % len(existing)])
+
+    templates = {'base.yaml': {'Base': {'puppetclasses': classes[:2],
+                                        'parameterconfig': {classes[0]: {'param0': '{{ cloud.name }}'}},
+                                        'hostgroup_parameters': {'cloud': '{{ cloud.name }}'}}}}
+    for i in range(1, hostgroups):
+        puppetclass = classes[i % puppetclasses]
+        templates['roles/role{}.yaml'.format(i)] = {'role{}'.format(i): {
+            'puppetclasses': [puppetclass],
+            'parameterconfig': {puppetclass: dict(('param{}'.format(p), i) for p in range(parameters))},
+            'hostgroup_parameters': {'role': 'role{}'.format(i)}}}
+    for name, content in templates.items():
+        path = os.path.join(hostgroup_path, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(yaml.safe_dump(content, default_flow_style=False))
+    return clouddata
+
+
+def request_budget(hostgroups, hosts, puppetclasses=10, parameters=3):
+    """
+    The most requests building a cloud generated by make_cloud should take
+    :return: Dict of the request budget of process_config and cloud_create
+    """
+    overridden = min(hostgroups, puppetclasses)
+    overrides = 1 + (hostgroups - 1) * parameters
+    # the hostgroups, and each of the ten reference tables
+    process_config = 1 + 10
+    # smart class parameters, the environment's hosts, then clearing hostgroups, deleting, creating,
+    # overriding, parameters and restoring hostgroups
+    cloud_create = overridden + 1 + hosts + hostgroups + hostgroups + overrides + hostgroups + hosts
+    return {'process_config': process_config, 'cloud_create': cloud_create}
+
+
+def run(hostgroups=20, hosts=20, puppetclasses=10, parameters=3, latency=0.0, write_latency=None, workers=None,
+        capacity=None, slowdown=0, read_ceiling=limiter.DEFAULT_READ_CEILING,
+        write_ceiling=limiter.DEFAULT_WRITE_CEILING):
+    base = tempfile.mkdtemp()
+    results = []
+    limits = limiter.ServerLimits(read_ceiling=read_ceiling, write_ceiling=write_ceiling)
+    try:
+        with ForemanStub(latency=latency, write_latency=write_latency, workers=workers, capacity=capacity,
+                         slowdown=slowdown) as stub:
+            hostgroup_path = os.path.join(base, 'hostgroups')
+            clouddata = make_cloud(stub, hostgroup_path, hostgroups, hosts, puppetclasses, parameters)
+            requests = foremanmetrics.InMemoryMetrics()
+            fc = foreman.Foreman(clouddata, hostgroup_path, limits=limits)
+            # the stub is plain HTTP on a random port
+            fc.foremanapi = foreman.MeasuredAPI(foremanapi.ForemanAPI(stub.server, 'hammer', 'hammer',
+                                                                      use_ssl=False, metrics=requests, retries=5,
+                                                                      retry_delay=0.01, limits=limits))
+
+            def measure(case, stage):
+                stub.reset_requests()
+                start = time.time()
+                value = stage()
+                overloaded = len([r for r in stub.requests if r[2] in limiter.OVERLOAD_STATUSES])
+                results.append({'case': case,
+                                'seconds': round(time.time() - start, 4),
+                                'requests': stub.count() - overloaded,
+                                'overloaded': overloaded,
+                                'errors': len([r for r in stub.requests
+                                               if r[2] >= 400 and r[2] not in limiter.OVERLOAD_STATUSES]),
+                                'peak_concurrency': stub.peak_concurrency})
+                return value
+
+            cloudconfig = measure('process_config', fc.process_config)
+            measure('cloud_create', lambda: fc.cloud_create(cloudconfig))
+
+            titles = sorted(h['title'] for h in stub.hostgroups.values())
+            restored = len([h for h in stub.hosts.values() if h['hostgroup_id'] is not None])
+            endpoints = requests.stats()
+    finally:
+        shutil.rmtree(base)
+
+    return {'benchmark': 'foreman',
+            'parameters': {'hostgroups': hostgroups, 'hosts': hosts, 'puppetclasses': puppetclasses,
+                           'parameters': parameters, 'latency': latency, 'write_latency': write_latency,
+                           'workers': workers, 'capacity': capacity, 'slowdown': slowdown,
+                           'read_ceiling': read_ceiling, 'write_ceiling': write_ceiling},
+            'results': results,
+            'budget': request_budget(hostgroups, hosts, puppetclasses, parameters),
+            'hostgroups_built': len(titles),
+            'hosts_restored': restored,
+            'endpoints': endpoints,
+            'limits': limits.stats()}
+
+
+def over_budget(report, max_seconds=None):
+    """
+    Stages of a report that went over their request budget, or the time budget
+    :return: List of descriptions
+    """
+    problems = []
+    for result in report['results']:
+        budget = report['budget'][result['case']]
+        if result['requests'] > budget:
+            problems.append('{}: {} requests, budget {}'.format(result['case'], result['requests'], budget))
+        if result['errors']:
+            problems.append('{}: {} failed requests'.format(result['case'], result['errors']))
+    total = sum(result['seconds'] for result in report['results'])
+    if max_seconds is not None and total > max_seconds:
+        problems.append('{:.2f}s in total, budget {}s'.format(total, max_seconds))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark building hostgroups against a stub Foreman')
+    parser.add_argument('--hostgroups', type=int, default=20, help='Number of hostgroups in the generated cloud')
+    parser.add_argument('--hosts', type=int, default=20, help='Number of hosts in the generated cloud')
+    parser.add_argument('--puppetclasses', type=int, default=10, help='Number of puppetclasses')
+    parser.add_argument('--parameters', type=int, default=3, help='Smart class parameters per puppetclass')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the stub takes to serve each request')
+    parser.add_argument('--write-latency', dest='write_latency', type=float, help='Seconds the stub takes to serve each write, if different')
+    parser.add_argument('--workers', type=int, help='Number of requests the stub serves at a time')
+    parser.add_argument('--capacity', type=int, help='Number of requests the stub serves at a time, turning away the rest with a 503')
+    parser.add_argument('--slowdown', type=float, default=0, help='Seconds each request in flight adds to the stub\'s latency')
+    parser.add_argument('--read-ceiling', dest='read_ceiling', type=int, default=limiter.DEFAULT_READ_CEILING,
+                        help='Most reads to make at a time')
+    parser.add_argument('--write-ceiling', dest='write_ceiling', type=int, default=limiter.DEFAULT_WRITE_CEILING,
+                        help='Most writes to make at a time')
+    parser.add_argument('--max-seconds', dest='max_seconds', type=float, help='Fail if the run takes longer')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = run(hostgroups=args.hostgroups, hosts=args.hosts, puppetclasses=args.puppetclasses,
+                 parameters=args.parameters, latency=args.latency, write_latency=args.write_latency,
+                 workers=args.workers, capacity=args.capacity, slowdown=args.slowdown,
+                 read_ceiling=args.read_ceiling, write_ceiling=args.write_ceiling)
+    for result in report['results']:
+        print("{case:16} {seconds:8}s {requests:6} requests, budget {budget:6}, {overloaded} overloaded, "
+              "{peak_concurrency} at once".format(budget=report['budget'][result['case']], **result))
+    for stats in report['limits']:
+        print("{name:16} limit {limit}/{ceiling}, {decreases} cuts, overloads {overloads}".format(**stats))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+    problems = over_budget(report, args.max_seconds)
+    for problem in problems:
+        print("OVER BUDGET {}".format(problem))
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
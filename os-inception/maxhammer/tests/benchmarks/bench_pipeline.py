@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Benchmark of the render/filter/stage pipeline against synthetic branches.
+
+Times exclusion filtering, filtered cloning, include checks, Processor.run with both process methods, the
+ansible and overcloud frontends and local distribution. Each case runs several times and the median is
+reported. Run from the tests directory:
+
+    PYTHONPATH=..:../../foremanapi python -m benchmarks.bench_pipeline --files 1000 --output pipeline.json
+
+Passing --baseline with an earlier --output compares against it, exiting non-zero if any case got slower
+by more than --tolerance.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from maxhammer import ansible as ansibleconfig, distribution, fileutil, overcloud as overcloudconfig, processor
+from benchmarks import synthetic
+
+# Cases are compared on their median, so a single slow repeat doesn't flag a regression
+DEFAULT_REPEATS = 5
+DEFAULT_TOLERANCE = 0.2
+
+
+def _measure(label, fn, files, repeats, setup=None):
+    """
+    Time a case
+    :param fn: Function to time
+    :param files: Number of files the case handles, for the throughput
+    :param setup: Function run untimed before every repeat
+    :return: Result dict
+    """
+    times = []
+    for i in range(repeats):
+        if setup:
+            setup()
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    times.sort()
+    median = times[len(times) // 2]
+    return {'case': label,
+            'seconds': round(median, 4),
+            'min_seconds': round(times[0], 4),
+            'files': files,
+            'files_per_sec': round(files / median, 1) if median else None}
+
+
+def _fresh(path):
+    def setup():
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+    return setup
+
+
+def run(files=500, depth=2, fanout=4, ignore_density=0.2, complexity=2, binary_fraction=0.05, binary_size=65536,
+        nodes=20, repeats=DEFAULT_REPEATS):
+    base = tempfile.mkdtemp()
+    results = []
+    try:
+        envpath = os.path.join(base, 'environments')
+        output = os.path.join(base, 'output')
+        scratch = os.path.join(base, 'scratch')
+        branch = synthetic.make_branch(envpath, 'bench', output, files=files, depth=depth, fanout=fanout,
+                                       ignore_density=ignore_density, complexity=complexity,
+                                       binary_fraction=binary_fraction, binary_size=binary_size, nodes=nodes)
+        clouddata = branch['clouddata']
+        overcloud = branch['modules']['overcloud']
+        ansible = branch['modules']['ansible']
+        total = files + 1
+
+        for job in ('processing', 'distribution'):
+            results.append(_measure('exclusion-status-' + job,
+                                    lambda: fileutil.get_files_with_exclusion_status(overcloud['path'], job=job),
+                                    total, repeats))
+
+        results.append(_measure('clone-with-filter',
+                                lambda: fileutil.clone_with_filter(overcloud['path'], scratch, job='distribution'),
+                                total, repeats, setup=_fresh(scratch)))
+
+        # include checks of every file against a list of a dozen directories and files, as preflight does
+        paths = [path for path, included in fileutil.get_files_with_exclusion_status(overcloud['path'])]
+        include_list = [os.path.join(overcloud['path'], 'd{}'.format(n)) for n in range(fanout)]
+        include_list += [os.path.join(overcloud['path'], path) for path in paths[:8]]
+        results.append(_measure('check-include',
+                                lambda: [fileutil.check_include(overcloud['path'], path, include_list)
+                                         for path in paths],
+                                len(paths), repeats))
+
+        for label, module, method in (('render-generic', overcloud, processor.GENERIC),
+                                      ('render-ansible', ansible, processor.ANSIBLE)):
+            results.append(_measure(label + '-cold',
+                                    lambda: processor.Processor(module['path']).run(clouddata, scratch,
+                                                                                    process_method=method),
+                                    total, repeats, setup=_fresh(scratch)))
+            proc = processor.Processor(module['path'])
+            proc.run(clouddata, scratch, process_method=method)
+            results.append(_measure(label + '-warm',
+                                    lambda: proc.run(clouddata, scratch, process_method=method),
+                                    total, repeats))
+
+        # the ansible and overcloud frontends render everything regardless of ignore files, so skip the binaries
+        results.append(_measure('render-tree-overcloud',
+                                lambda: overcloudconfig.Overcloud(overcloud['path']).process_overcloud_config_files(
+                                    clouddata, scratch, exclude_list=[os.path.join(overcloud['path'], '*.bin')]),
+                                total, repeats, setup=_fresh(scratch)))
+        results.append(_measure('render-tree-ansible',
+                                lambda: ansibleconfig.Ansible(ansible['path']).process_ansible_config_files(
+                                    clouddata, scratch, exclude_list=[os.path.join(ansible['path'], '*.bin')]),
+                                total, repeats, setup=_fresh(scratch)))
+
+        def distribute():
+            dist = distribution.Distribution(branch['manifest_path'], clouddata_config=clouddata,
+                                             source_base=branch['path'])
+            try:
+                dist.distribute()
+            finally:
+                dist.close()
+        results.append(_measure('distribute-local-initial', distribute, total * 2, repeats, setup=_fresh(output)))
+        results.append(_measure('distribute-local-unchanged', distribute, total * 2, repeats))
+    finally:
+        shutil.rmtree(base)
+
+    return {'benchmark': 'pipeline',
+            'parameters': {'files': files, 'depth': depth, 'fanout': fanout, 'ignore_density': ignore_density,
+                           'complexity': complexity, 'binary_fraction': binary_fraction,
+                           'binary_size': binary_size, 'nodes': nodes, 'repeats': repeats},
+            'results': results}
+
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare a report against a baseline report
+    :param tolerance: Fraction a case may slow down by before it counts as a regression
+    :return: List of (case, baseline seconds, seconds) for every regressed case
+    """
+    before = dict((result['case'], result['seconds']) for result in baseline['results'])
+    regressions = []
+    for result in report['results']:
+        if result['case'] in before and result['seconds'] > before[result['case']] * (1 + tolerance):
+            regressions.append((result['case'], before[result['case']], result['seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the render/filter/stage pipeline')
+    parser.add_argument('--files', type=int, default=500, help='Number of files in each generated module')
+    parser.add_argument('--depth', type=int, default=2, help='Depth of the generated directory trees')
+    parser.add_argument('--fanout', type=int, default=4, help='Subdirectories per generated directory')
+    parser.add_argument('--ignore-density', dest='ignore_density', type=float, default=0.2, help='Fraction of files listed in .mhignore files')
+    parser.add_argument('--complexity', type=int, default=2, help='Loop and conditional sections per template')
+    parser.add_argument('--binary-fraction', dest='binary_fraction', type=float, default=0.05, help='Fraction of files that are binary payloads')
+    parser.add_argument('--binary-size', dest='binary_size', type=int, default=65536, help='Size of each binary payload in bytes')
+    parser.add_argument('--nodes', type=int, default=20, help='Number of nodes in the clouddata')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='Times to run each case')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    parser.add_argument('--baseline', help='Compare against JSON results from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='With --baseline, fraction a case may slow down by')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = run(files=args.files, depth=args.depth, fanout=args.fanout, ignore_density=args.ignore_density,
+                 complexity=args.complexity, binary_fraction=args.binary_fraction, binary_size=args.binary_size,
+                 nodes=args.nodes, repeats=args.repeats)
+    for result in report['results']:
+        print("{case:28} {seconds:8}s {files_per_sec:10} files/s".format(**result))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(report, json.load(fh), args.tolerance)
+        for case, before, after in regressions:
+            print("REGRESSION {}: {}s -> {}s".format(case, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark of sftp.Server uploads against a local paramiko server.
+
+Compares the legacy one-file-at-a-time upload() loop with upload_parallel() at several channel counts.
+Run from the tests directory:
+
+    PYTHONPATH=.. python -m benchmarks.bench_sftp --files 500 --output sftp.json
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from maxhammer import sftp
+from sshstub import SSHStub
+
+
+def make_tree(base, files, size, fanout=20):
+    for i in range(files):
+        dirpath = os.path.join(base, 'd{}'.format(i % fanout))
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        with open(os.path.join(dirpath, 'f{}'.format(i)), 'wb') as fh:
+            fh.write(os.urandom(size))
+
+
+def _legacy_upload(server, localpath, remotepath):
+    try:
+        server.sftp.mkdir(remotepath)
+    except IOError:
+        pass
+    for root, dirs, files in os.walk(localpath):
+        reldir = os.path.relpath(root, localpath)
+        try:
+            server.sftp.mkdir(os.path.join(remotepath, reldir))
+        except IOError:
+            pass
+        for f in files:
+            server.upload(os.path.join(root, f), os.path.join(remotepath, reldir, f))
+
+
+def _measure(label, fn, files, total_bytes):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    return {'case': label,
+            'seconds': round(elapsed, 4),
+            'files_per_sec': round(files / elapsed, 1),
+            'mb_per_sec': round(total_bytes / elapsed / 1048576.0, 2)}
+
+
+def run(files=300, size=2048, channels=(1, 4, 8)):
+    local = tempfile.mkdtemp()
+    remote_root = tempfile.mkdtemp()
+    results = []
+    try:
+        make_tree(local, files, size)
+        total_bytes = files * size
+        with SSHStub(remote_root) as stub:
+            with sftp.Server('127.0.0.1', username='bench', password='bench', port=stub.port) as server:
+                results.append(_measure('legacy-serial', lambda: _legacy_upload(server, local, '/legacy'),
+                                        files, total_bytes))
+                for count in channels:
+                    dest = '/parallel-{}'.format(count)
+                    results.append(_measure('parallel-{}ch'.format(count),
+                                            lambda: server.upload_parallel(local, dest, channels=count),
+                                            files, total_bytes))
+    finally:
+        shutil.rmtree(local)
+        shutil.rmtree(remote_root)
+    return {'benchmark': 'sftp_upload', 'files': files, 'file_size': size, 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sftp.Server upload throughput')
+    parser.add_argument('--files', type=int, default=300, help='Number of files in the generated tree')
+    parser.add_argument('--size', type=int, default=2048, help='Size of each generated file in bytes')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    report = run(files=args.files, size=args.size)
+    for result in report['results']:
+        print("{case:16} {seconds:8}s {files_per_sec:10} files/s {mb_per_sec:8} MB/s".format(**result))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Benchmark of maxhammer's startup, as paid by every call from an ansible loop.
+
+Starts a fresh interpreter for each case: importing the package, --help, an argument error and a run of a
+branch with --no-hostgroup --no-dist, and reports the median wall time and which heavy modules each case
+imported. Run from the tests directory:
+
+    PYTHONPATH=..:../../foremanapi python -m benchmarks.bench_startup --repeats 5 --output startup.json
+
+The run fails if a case takes longer than --max-seconds, or imports any of HEAVY_MODULES.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+DEFAULT_REPEATS = 5
+# Seconds a case may take, interpreter startup included
+STARTUP_BUDGET = 0.2
+
+# Only the phases that need these should import them
+HEAVY_MODULES = ['paramiko', 'jinja2', 'requests', 'zenlog', 'foremanapi.foreman',
+                 'maxhammer.foreman', 'maxhammer.distribution', 'maxhammer.processor']
+
+# Runs maxhammer's console script entry point with the given arguments, then writes the modules it imported
+DRIVER = """
+import json, sys
+argv, output = sys.argv[1:-1], sys.argv[-1]
+try:
+    import maxhammer
+    if argv:
+        sys.argv = ['maxhammer'] + argv
+        maxhammer.main()
+except SystemExit:
+    pass
+finally:
+    with open(output, 'w') as fh:
+        json.dump(sorted(sys.modules), fh)
+"""
+
+BRANCH = 'bench'
+
+
+def make_branch(puppetenvpath):
+    """
+    Create a branch with just its clouddata
+    :param puppetenvpath: Path to the puppet environments
+    """
+    clouddata_dir = os.path.join(puppetenvpath, 'icloud_' + BRANCH, 'clouddata', 'clouddata')
+    os.makedirs(clouddata_dir)
+    with open(os.path.join(clouddata_dir, BRANCH + '.yaml'), 'w') as fh:
+        yaml.safe_dump({'name': BRANCH, 'environment': BRANCH, 'buildserver': 'foreman.example.com'}, fh)
+
+
+def _start(argv, output):
+    """
+    Start maxhammer in a fresh interpreter
+    :return: (seconds, names of the modules it imported)
+    """
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.call([sys.executable, '-c', DRIVER] + argv + [output], stdout=devnull, stderr=devnull)
+        elapsed = time.time() - start
+    with open(output) as fh:
+        return elapsed, json.load(fh)
+
+
+def run(repeats=DEFAULT_REPEATS):
+    base = tempfile.mkdtemp()
+    results = []
+    try:
+        puppetenvpath = os.path.join(base, 'environments')
+        make_branch(puppetenvpath)
+        cases = [('import', []),
+                 ('help', ['--help']),
+                 ('argument-error', ['--puppetenvpath', puppetenvpath]),
+                 ('no-phases', ['--branch', BRANCH, '--puppetenvpath', puppetenvpath, '--no-hostgroup', '--no-dist',
+                                '--no-yaml-cache', '--no-digest-cache'])]
+        output = os.path.join(base, 'modules.json')
+        for case, argv in cases:
+            times = []
+            for i in range(repeats):
+                seconds, modules = _start(argv, output)
+                times.append(seconds)
+            results.append({'case': case,
+                            'seconds': round(sorted(times)[len(times) // 2], 4),
+                            'heavy_modules': [name for name in HEAVY_MODULES if name in modules]})
+    finally:
+        shutil.rmtree(base)
+    return {'benchmark': 'startup',
+            'parameters': {'repeats': repeats},
+            'results': results}
+
+
+def over_budget(report, max_seconds=STARTUP_BUDGET):
+    """
+    Cases of a report that took longer than the startup budget, or imported heavy modules
+    :return: List of descriptions
+    """
+    problems = []
+    for result in report['results']:
+        if max_seconds is not None and result['seconds'] > max_seconds:
+            problems.append('{}: {:.3f}s, budget {}s'.format(result['case'], result['seconds'], max_seconds))
+        if result['heavy_modules']:
+            problems.append('{}: imported {}'.format(result['case'], ', '.join(result['heavy_modules'])))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark maxhammer startup')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='Times to start each case, reporting the median')
+    parser.add_argument('--max-seconds', dest='max_seconds', type=float, default=STARTUP_BUDGET, help='Fail if a case takes longer')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = run(repeats=args.repeats)
+    for result in report['results']:
+        print("{case:16} {seconds:8}s  {modules}".format(modules=', '.join(result['heavy_modules']) or '-', **result))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+    problems = over_budget(report, args.max_seconds)
+    for problem in problems:
+        print("OVER BUDGET {}".format(problem))
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
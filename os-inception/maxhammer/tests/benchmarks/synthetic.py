@@ -0,0 +1,156 @@
+"""
+Generator of synthetic icloud_<branch> trees for benchmarks.
+
+A generated branch has clouddata, a hostgroup template, an overcloud module of generic Jinja templates, an
+ansible module of [% %] / [{ }] templates and a maxhammer.yaml manifest distributing both to local directories.
+"""
+import os
+import random
+import yaml
+
+ENV_PREFIX = 'icloud_'
+
+GENERIC_SECTION = """
+# section {index}
+{{% for node in cloud.nodes %}}
+node_{index}_{{{{ loop.index }}}}: {{{{ node.name }}}} {{{{ node.ip }}}}
+{{% endfor %}}
+{{% if cloud.settings.debug %}}debug_{index}: true{{% else %}}debug_{index}: false{{% endif %}}
+workers_{index}: {{{{ cloud.settings.workers * {index} }}}}
+"""
+
+ANSIBLE_SECTION = """
+# section {index}
+[% for node in cloud.nodes %]
+node_{index}_[{{ loop.index }}]: [{{ node.name }}] [{{ node.ip }}]
+[% endfor %]
+[% if cloud.settings.debug %]debug_{index}: true[% else %]debug_{index}: false[% endif %]
+workers_{index}: [{{ cloud.settings.workers * {index} }}]
+"""
+
+FILLER = 'static_{}: "padding text that passes through the template engine untouched"\n'
+
+
+def _directories(depth, fanout):
+    """
+    Relative directories of a tree `depth` levels deep with `fanout` subdirectories per directory
+    """
+    dirs = ['']
+    level = ['']
+    for i in range(depth):
+        level = [os.path.join(parent, 'd{}'.format(n)) for parent in level for n in range(fanout)]
+        dirs.extend(level)
+    return dirs
+
+
+def _write(path, content, mode='w'):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, mode) as fh:
+        fh.write(content)
+
+
+def make_module(path, section, files, depth, fanout, ignore_density, complexity, binary_fraction, binary_size, rng):
+    """
+    Generate a module of templates, static files and binary payloads
+    :param path: Directory to generate the module in
+    :param section: Template section to repeat in every template
+    :param files: Number of files
+    :param depth: Depth of the directory tree
+    :param fanout: Subdirectories per directory
+    :param ignore_density: Fraction of text files listed in an .mhignore, half of them excluded from
+                           processing and half from distribution
+    :param complexity: Number of template sections per template
+    :param binary_fraction: Fraction of files that are binary payloads, which are always excluded from processing
+    :param binary_size: Size of each binary payload in bytes
+    :param rng: random.Random to generate with
+    :return: Dict of the number of files of each kind
+    """
+    dirs = _directories(depth, fanout)
+    ignores = {}
+    counts = {'templates': 0, 'unprocessed': 0, 'undistributed': 0, 'binaries': 0}
+    body = ''.join(section.format(index=i + 1) for i in range(complexity))
+    body += ''.join(FILLER.format(i) for i in range(complexity * 4))
+
+    for i in range(files):
+        reldir = dirs[i % len(dirs)]
+        ignore = ignores.setdefault(reldir, {'processing': [], 'distribution': []})
+        if rng.random() < binary_fraction:
+            name = 'payload{}.bin'.format(i)
+            _write(os.path.join(path, reldir, name), os.urandom(binary_size), 'wb')
+            ignore['processing'].append(name)
+            counts['binaries'] += 1
+            continue
+
+        name = 'config{}.yaml'.format(i)
+        _write(os.path.join(path, reldir, name), body)
+        if rng.random() < ignore_density:
+            if rng.random() < 0.5:
+                ignore['processing'].append(name)
+                counts['unprocessed'] += 1
+            else:
+                ignore['distribution'].append(name)
+                counts['undistributed'] += 1
+                counts['templates'] += 1
+        else:
+            counts['templates'] += 1
+
+    for reldir, ignore in ignores.items():
+        if not ignore['processing'] and not ignore['distribution']:
+            continue
+        lines = []
+        for job in ('processing', 'distribution'):
+            if ignore[job]:
+                lines.append('[{}]'.format(job))
+                lines.append('filterlist =')
+                lines.extend('    {}'.format(name) for name in ignore[job])
+        _write(os.path.join(path, reldir, '.mhignore'), '\n'.join(lines) + '\n')
+    return counts
+
+
+def make_branch(envpath, branch, output, files=500, depth=2, fanout=4, ignore_density=0.2, complexity=2,
+                binary_fraction=0.05, binary_size=65536, nodes=20, seed=0):
+    """
+    Generate a synthetic branch
+    :param envpath: Puppet environments directory to generate the branch in
+    :param branch: Branch name
+    :param output: Directory the manifest distributes to, one subdirectory per module
+    :param files: Number of files in each of the overcloud and ansible modules
+    :param nodes: Number of nodes in the clouddata, which the templates loop over
+    :param seed: Seed for the random choices, so the same parameters generate the same tree
+    :return: Dict describing the branch: its paths and the number of files of each kind per module
+    """
+    rng = random.Random(seed)
+    base = os.path.join(envpath, ENV_PREFIX + branch)
+    clouddata = {'name': branch,
+                 'environment': branch,
+                 'buildserver': 'foreman.example.com',
+                 'maxhammer': {},
+                 'settings': {'debug': False, 'workers': 4},
+                 'nodes': [{'name': 'node{}'.format(n), 'ip': '10.0.{}.{}'.format(n // 250, n % 250 + 1)}
+                           for n in range(nodes)]}
+    clouddata_path = os.path.join(base, 'clouddata', 'clouddata', branch + '.yaml')
+    _write(clouddata_path, yaml.safe_dump(clouddata, default_flow_style=False))
+    _write(os.path.join(base, 'hostgroups', 'base.yaml'),
+           'Base:\n  environment: {{ cloud.environment }}\n  puppetclasses: [base]\n')
+
+    modules = {}
+    for module, method, section in (('overcloud', 'overcloud', GENERIC_SECTION),
+                                    ('ansible', 'ansible', ANSIBLE_SECTION)):
+        counts = make_module(os.path.join(base, module), section, files, depth, fanout, ignore_density, complexity,
+                             binary_fraction, binary_size, rng)
+        modules[module] = dict(counts, path=os.path.join(base, module), process_method=method)
+
+    manifest = {'maxhammer': {'process_paths': dict(
+        (module, {'process_method': info['process_method'],
+                  'sources': [module],
+                  'local_destination': os.path.join(output, module)})
+        for module, info in modules.items())}}
+    manifest_path = os.path.join(base, 'maxhammer.yaml')
+    _write(manifest_path, yaml.safe_dump(manifest, default_flow_style=False))
+
+    return {'path': base,
+            'clouddata': clouddata,
+            'clouddata_path': clouddata_path,
+            'manifest_path': manifest_path,
+            'modules': modules}
@@ -0,0 +1,374 @@
+"""
+A self-contained stub of the Foreman API, for exercising foremanapi and maxhammer's hostgroup building locally.
+
+It keeps its objects in memory and serves the endpoints foremanapi.ForemanAPI uses. Any credentials are
+accepted. Latency, errors, rate limiting and overload can be injected, and every request is recorded.
+"""
+import BaseHTTPServer
+import json
+import random
+import SocketServer
+import threading
+import time
+from foremanapi.metrics import endpoint_template
+
+# Reference tables served as lists of {'id', 'name'}, and the field foremanapi looks them up by
+TABLES = {'environments': 'name',
+          'domains': 'name',
+          'subnets': 'name',
+          'realms': 'name',
+          'architectures': 'name',
+          'operatingsystems': 'description',
+          'media': 'name',
+          'ptables': 'name',
+          'smart_proxies': 'name'}
+
+API_PREFIX = '/api/v2/'
+
+
+class NotFound(Exception):
+    pass
+
+
+class StubHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # set on a subclass by ForemanStub
+    stub = None
+
+    def _handle(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        status, payload, headers = self.stub.handle(self.command, self.path, body)
+        content = json.dumps(payload)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class ForemanStub(object):
+    """
+    Runs a stub Foreman API on a random localhost port in background threads
+    """
+
+    def __init__(self, latency=0, write_latency=None, error_rate=0, rate_limit=None, workers=None, seed=0,
+                 capacity=None, slowdown=0):
+        """
+        :param latency: Seconds each request takes to serve
+        :param write_latency: Seconds each POST, PUT or DELETE takes to serve, if different
+        :param error_rate: Fraction of requests, chosen at random, that fail with a 500
+        :param rate_limit: Requests per second served, beyond which requests get a 429
+        :param workers: Number of requests served at a time, like the application server's worker pool
+        :param seed: Seed for choosing the requests that fail
+        :param capacity: Number of requests served at a time, beyond which requests are turned away with a 503
+        :param slowdown: Seconds each request in flight adds to the latency of the others, like a server
+                         slowing under load
+        """
+        self.latency = latency
+        self.write_latency = latency if write_latency is None else write_latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.capacity = capacity
+        self.slowdown = slowdown
+        self.requests = []
+        self.tables = dict((table, {}) for table in TABLES)
+        self.puppetclasses = {}
+        self.smart_class_parameters = {}
+        self.hostgroups = {}
+        self.hosts = {}
+        self._next_id = 1
+        self._injected = []
+        self._rng = random.Random(seed)
+        self._tokens = rate_limit
+        self._refilled = time.time()
+        self._lock = threading.Lock()
+        self._workers = threading.Semaphore(workers) if workers else None
+        self._active = 0
+        self.peak_concurrency = 0
+
+        class BoundStubHandler(StubHandler):
+            stub = self
+        self._server = StubHTTPServer(('127.0.0.1', 0), BoundStubHandler)
+        self.port = self._server.server_address[1]
+        self.server = '127.0.0.1:{}'.format(self.port)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._thread.join()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # Populating
+
+    def _id(self):
+        with self._lock:
+            new_id = self._next_id
+            self._next_id += 1
+        return new_id
+
+    def add(self, table, name):
+        """
+        Add an entry to a reference table
+        :param table: One of TABLES
+        :return: id of the entry
+        """
+        entry = {'id': self._id(), 'name': name}
+        if TABLES[table] != 'name':
+            entry[TABLES[table]] = name
+        if table == 'smart_proxies':
+            entry['features'] = [{'id': 1, 'name': 'Puppet'}, {'id': 2, 'name': 'Puppet CA'}]
+        self.tables[table][entry['id']] = entry
+        return entry['id']
+
+    def add_puppetclass(self, name, parameters=()):
+        """
+        Add a puppetclass and its smart class parameters
+        :return: id of the puppetclass
+        """
+        puppetclass = {'id': self._id(), 'name': name, 'module': name.split('::')[0], 'parameters': []}
+        for parameter in parameters:
+            smart_class_parameter = {'id': self._id(), 'parameter': parameter, 'puppetclass_id': puppetclass['id'],
+                                     'override_values': []}
+            self.smart_class_parameters[smart_class_parameter['id']] = smart_class_parameter
+            puppetclass['parameters'].append(smart_class_parameter['id'])
+        self.puppetclasses[puppetclass['id']] = puppetclass
+        return puppetclass['id']
+
+    def add_hostgroup(self, name, parent_id=None, puppetclass_ids=()):
+        """
+        Add a hostgroup
+        :return: id of the hostgroup
+        """
+        hostgroup = {'id': self._id(), 'name': name, 'parent_id': parent_id,
+                     'title': self.hostgroups[parent_id]['title'] + '/' + name if parent_id else name,
+                     'puppetclass_ids': list(puppetclass_ids), 'parameters': {}}
+        self.hostgroups[hostgroup['id']] = hostgroup
+        return hostgroup['id']
+
+    def add_host(self, name, environment_id, hostgroup_id=None):
+        """
+        Add a host
+        :return: id of the host
+        """
+        host = {'id': self._id(), 'name': name, 'environment_id': environment_id, 'hostgroup_id': hostgroup_id}
+        self.hosts[host['id']] = host
+        return host['id']
+
+    # Injecting failures and inspecting requests
+
+    def inject(self, status, count=1, method=None, endpoint=None):
+        """
+        Fail the next matching requests
+        :param status: HTTP status to fail with
+        :param count: Number of requests to fail
+        :param method: Only fail requests with this HTTP method
+        :param endpoint: Only fail requests to this endpoint template, e.g. 'hostgroups/:id'
+        :return:
+        """
+        with self._lock:
+            self._injected.append([status, count, method, endpoint])
+
+    def count(self, method=None, endpoint=None, status=None):
+        """
+        Number of requests served, optionally only those matching
+        """
+        with self._lock:
+            return len([r for r in self.requests
+                        if (method is None or r[0] == method) and (endpoint is None or r[1] == endpoint)
+                        and (status is None or r[2] == status)])
+
+    def reset_requests(self):
+        with self._lock:
+            self.requests = []
+            self.peak_concurrency = 0
+
+    # Serving
+
+    def handle(self, method, path, body):
+        """
+        Serve a request
+        :return: (status, JSON payload, list of extra headers)
+        """
+        if self._workers:
+            self._workers.acquire()
+        try:
+            with self._lock:
+                self._active += 1
+                self.peak_concurrency = max(self.peak_concurrency, self._active)
+            status, payload, headers = self._serve(method, path, body)
+        finally:
+            with self._lock:
+                self._active -= 1
+            if self._workers:
+                self._workers.release()
+        return status, payload, headers
+
+    def _failure(self, method, endpoint):
+        with self._lock:
+            if self.rate_limit:
+                now = time.time()
+                self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+                self._refilled = now
+                if self._tokens < 1:
+                    return 429, {'error': {'message': 'Too many requests'}}, [('Retry-After', '1')]
+                self._tokens -= 1
+            for injected in self._injected:
+                status, count, only_method, only_endpoint = injected
+                if count > 0 and only_method in (None, method) and only_endpoint in (None, endpoint):
+                    injected[1] -= 1
+                    return status, {'error': {'message': 'Injected failure'}}, []
+            if self.error_rate and self._rng.random() < self.error_rate:
+                return 500, {'error': {'message': 'Injected failure'}}, []
+        return None
+
+    def _serve(self, method, path, body):
+        if not path.startswith(API_PREFIX):
+            return 404, {'error': {'message': 'Not found'}}, []
+        path, query = (path[len(API_PREFIX):].split('?', 1) + [''])[:2]
+        segments = [segment for segment in path.split('/') if segment]
+        endpoint = endpoint_template('/'.join(segments))
+        parameters = dict(pair.split('=', 1) for pair in query.split('&') if '=' in pair)
+
+        with self._lock:
+            active = self._active
+        if self.capacity and active > self.capacity:
+            failure = (503, {'error': {'message': 'Service unavailable'}}, [])
+        else:
+            time.sleep((self.latency if method == 'GET' else self.write_latency) + self.slowdown * (active - 1))
+            failure = self._failure(method, endpoint)
+        if failure is None:
+            try:
+                with self._lock:
+                    failure = (200, getattr(self, '_' + method.lower())(segments, parameters, body), [])
+            except NotFound:
+                failure = (404, {'error': {'message': 'Resource not found'}}, [])
+            except (KeyError, TypeError, ValueError) as error:
+                failure = (422, {'error': {'message': 'Unprocessable entity: {}'.format(error)}}, [])
+        with self._lock:
+            self.requests.append((method, endpoint, failure[0]))
+        return failure
+
+    def _get_object(self, objects, object_id):
+        try:
+            return objects[int(object_id)]
+        except (KeyError, ValueError):
+            raise NotFound()
+
+    def _grouped_puppetclasses(self, ids):
+        grouped = {}
+        for puppetclass_id in ids:
+            puppetclass = self.puppetclasses[puppetclass_id]
+            grouped.setdefault(puppetclass['module'], []).append({'id': puppetclass['id'],
+                                                                   'name': puppetclass['name']})
+        return grouped
+
+    def _host(self, host):
+        hostgroup = self.hostgroups.get(host['hostgroup_id'])
+        result = dict(host)
+        if hostgroup:
+            result['hostgroup_name'] = hostgroup['title']
+        return result
+
+    def _get(self, segments, parameters, body):
+        if len(segments) == 1 and segments[0] in TABLES:
+            return {'results': sorted(self.tables[segments[0]].values(), key=lambda e: e['id'])}
+        if segments == ['puppetclasses']:
+            return {'results': self._grouped_puppetclasses(sorted(self.puppetclasses))}
+        if len(segments) == 2 and segments[0] == 'puppetclasses':
+            puppetclass = self._get_object(self.puppetclasses, segments[1])
+            return {'id': puppetclass['id'], 'name': puppetclass['name'],
+                    'smart_class_parameters': [{'id': p, 'parameter': self.smart_class_parameters[p]['parameter']}
+                                               for p in puppetclass['parameters']]}
+        if segments == ['hostgroups']:
+            return {'results': [{'id': h['id'], 'name': h['name'], 'title': h['title']}
+                                for h in sorted(self.hostgroups.values(), key=lambda h: h['id'])]}
+        if len(segments) == 3 and segments[0] == 'hostgroups' and segments[2] == 'puppetclasses':
+            hostgroup = self._get_object(self.hostgroups, segments[1])
+            return {'results': self._grouped_puppetclasses(hostgroup['puppetclass_ids'])}
+        if len(segments) == 3 and segments[0] == 'environments' and segments[2] == 'hosts':
+            environment = self._get_object(self.tables['environments'], segments[1])
+            return {'results': [self._host(h) for h in self.hosts.values()
+                                if h['environment_id'] == environment['id']]}
+        if segments == ['hosts']:
+            hostgroup_id = int(parameters['hostgroup_id']) if 'hostgroup_id' in parameters else None
+            return {'results': [self._host(h) for h in self.hosts.values()
+                                if hostgroup_id is None or h['hostgroup_id'] == hostgroup_id]}
+        if len(segments) == 3 and segments[0] == 'smart_class_parameters' and segments[2] == 'override_values':
+            return {'results': self._get_object(self.smart_class_parameters, segments[1])['override_values']}
+        raise NotFound()
+
+    def _post(self, segments, parameters, body):
+        if segments == ['hostgroups']:
+            fields = body['hostgroup']
+            parent_id = fields.get('parent_id')
+            if parent_id is not None:
+                self._get_object(self.hostgroups, parent_id)
+            title = self.hostgroups[parent_id]['title'] + '/' + fields['name'] if parent_id else fields['name']
+            if any(h['title'] == title for h in self.hostgroups.values()):
+                raise ValueError('Name has already been taken')
+            for puppetclass_id in fields.get('puppetclass_ids') or []:
+                self._get_object(self.puppetclasses, puppetclass_id)
+            hostgroup = {'id': self._next_id, 'name': fields['name'], 'parent_id': parent_id, 'title': title,
+                         'puppetclass_ids': list(fields.get('puppetclass_ids') or []), 'parameters': {}}
+            self._next_id += 1
+            self.hostgroups[hostgroup['id']] = hostgroup
+            return {'id': hostgroup['id'], 'name': hostgroup['name'], 'title': title}
+        if len(segments) == 3 and segments[0] == 'hostgroups' and segments[2] == 'parameters':
+            hostgroup = self._get_object(self.hostgroups, segments[1])
+            hostgroup['parameters'][body['parameter']['name']] = body['parameter']['value']
+            return dict(body['parameter'], id=len(hostgroup['parameters']))
+        if len(segments) == 3 and segments[0] == 'smart_class_parameters' and segments[2] == 'override_values':
+            smart_class_parameter = self._get_object(self.smart_class_parameters, segments[1])
+            override = dict(body['override_value'], id=len(smart_class_parameter['override_values']) + 1)
+            smart_class_parameter['override_values'].append(override)
+            return override
+        raise NotFound()
+
+    def _put(self, segments, parameters, body):
+        if len(segments) == 2 and segments[0] == 'hosts':
+            host = self._get_object(self.hosts, segments[1])
+            fields = body['host']
+            if 'hostgroup_name' in fields:
+                matches = [h['id'] for h in self.hostgroups.values() if h['title'] == fields['hostgroup_name']]
+                if not matches:
+                    raise ValueError('Hostgroup not found')
+                host['hostgroup_id'] = matches[0]
+            else:
+                host['hostgroup_id'] = fields.get('hostgroup_id')
+            return self._host(host)
+        raise NotFound()
+
+    def _delete(self, segments, parameters, body):
+        if len(segments) == 2 and segments[0] == 'hostgroups':
+            hostgroup = self._get_object(self.hostgroups, segments[1])
+            del self.hostgroups[hostgroup['id']]
+            for host in self.hosts.values():
+                if host['hostgroup_id'] == hostgroup['id']:
+                    host['hostgroup_id'] = None
+            return {'id': hostgroup['id'], 'name': hostgroup['name']}
+        raise NotFound()
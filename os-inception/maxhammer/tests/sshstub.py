@@ -0,0 +1,481 @@
+"""
+A self-contained paramiko SSH/SFTP server for exercising maxhammer's transfer code locally.
+
+Every SFTP path is served relative to a local root directory, exec requests are run through the
+local shell, and any username/password is accepted.
+
+For rsync, which needs a real sshd at the far end, LoopbackSSHD runs the system's sshd on a random
+localhost port as the current user. Either can be put behind a ShapingProxy adding latency and a
+bandwidth cap to the connection.
+"""
+import Queue
+import distutils.spawn
+import getpass
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import paramiko
+from paramiko.sftp import SFTP_OK
+
+
+class StubServer(paramiko.ServerInterface):
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._exec, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _exec(self, channel, command):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def pump_stdin():
+            # keep draining the channel even once the command stops reading its input
+            alive = True
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                if alive:
+                    try:
+                        process.stdin.write(data)
+                    except IOError:
+                        alive = False
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+
+        stdin_thread = threading.Thread(target=pump_stdin)
+        stdin_thread.daemon = True
+        stdin_thread.start()
+        stderr = []
+        stderr_thread = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+        stderr_thread.daemon = True
+        stderr_thread.start()
+        stdout = process.stdout.read()
+        stderr_thread.join()
+        stderr = stderr[0]
+        process.wait()
+        if stdout:
+            channel.sendall(stdout)
+        if stderr:
+            channel.sendall_stderr(stderr)
+        channel.send_exit_status(process.returncode)
+        channel.close()
+
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+
+    # set by SSHStub before the server is started
+    ROOT = None
+
+    def _realpath(self, path):
+        return self.ROOT + self.canonicalize(path)
+
+    def list_folder(self, path):
+        path = self._realpath(path)
+        try:
+            out = []
+            for fname in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, fname)))
+                attr.filename = fname
+                out.append(attr)
+            return out
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._realpath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._realpath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._realpath(path)
+        try:
+            binary_flag = getattr(os, 'O_BINARY', 0)
+            flags |= binary_flag
+            mode = getattr(attr, 'st_mode', None)
+            if mode is not None:
+                fd = os.open(path, flags, mode)
+            else:
+                fd = os.open(path, flags, 0666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if (flags & os.O_CREAT) and (attr is not None):
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            paramiko.SFTPServer.set_file_attr(path, attr)
+        if flags & os.O_WRONLY:
+            fstr = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fstr = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fstr = 'rb'
+        try:
+            f = os.fdopen(fd, fstr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        fobj = StubSFTPHandle(flags)
+        fobj.filename = path
+        fobj.readfile = f
+        fobj.writefile = f
+        return fobj
+
+    def remove(self, path):
+        try:
+            os.remove(self._realpath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._realpath(oldpath), self._realpath(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def mkdir(self, path, attr):
+        path = self._realpath(path)
+        try:
+            os.mkdir(path)
+            if attr is not None:
+                paramiko.SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._realpath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self._realpath(path), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class ShapingProxy(object):
+    """
+    Forwards connections from a random localhost port to another port, delaying data in each direction
+    by a fixed latency and pacing it to a bandwidth cap
+    """
+
+    CHUNK_SIZE = 16384
+
+    def __init__(self, target_port, latency=0, bandwidth=None):
+        """
+        :param target_port: Localhost port to forward to
+        :param latency: One-way delay in seconds
+        :param bandwidth: Cap in bytes per second in each direction, per connection
+        """
+        self.target_port = target_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(16)
+        self.port = self._sock.getsockname()[1]
+        self._running = False
+        self._connections = []
+
+    def _pipe(self, source, destination):
+        # data is stamped as it arrives and released a latency later, so the delay doesn't throttle the pipe
+        pending = Queue.Queue()
+
+        def read():
+            while True:
+                try:
+                    data = source.recv(self.CHUNK_SIZE)
+                except socket.error:
+                    data = ''
+                pending.put((time.time(), data))
+                if not data:
+                    return
+
+        def write():
+            sent_until = time.time()
+            while True:
+                arrived, data = pending.get()
+                delay = arrived + self.latency - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                if not data:
+                    break
+                if self.bandwidth:
+                    sent_until = max(sent_until, time.time()) + len(data) / float(self.bandwidth)
+                    delay = sent_until - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                try:
+                    destination.sendall(data)
+                except socket.error:
+                    break
+            try:
+                destination.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+
+        for target in (read, write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, addr = self._sock.accept()
+            except socket.error:
+                return
+            upstream = socket.create_connection(('127.0.0.1', self.target_port))
+            self._connections.extend([conn, upstream])
+            self._pipe(conn, upstream)
+            self._pipe(upstream, conn)
+
+    def start(self):
+        self._running = True
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        for sock in [self._sock] + self._connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+
+def _shaped(port, latency, bandwidth):
+    """
+    A started ShapingProxy to a port, or None if no shaping is wanted
+    """
+    if not latency and not bandwidth:
+        return None
+    return ShapingProxy(port, latency=latency, bandwidth=bandwidth).start()
+
+
+class SSHStub(object):
+    """
+    Runs a StubServer on a random localhost port in a background thread
+    """
+
+    def __init__(self, root='/', latency=0, bandwidth=None):
+        """
+        :param root: Local directory that remote SFTP paths are served from
+        :param latency: One-way delay in seconds added to the connection
+        :param bandwidth: Cap in bytes per second on the connection, in each direction
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._proxy = None
+        self.root = os.path.realpath(root).rstrip('/')
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.transports = []
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(16)
+        self.port = self._sock.getsockname()[1]
+        self._running = False
+        self._thread = None
+
+    def _make_sftp_server(self):
+        root = self.root
+
+        class RootedSFTPServer(StubSFTPServer):
+            ROOT = root
+        return RootedSFTPServer
+
+    def _accept(self):
+        sftp_server = self._make_sftp_server()
+        while self._running:
+            try:
+                conn, addr = self._sock.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, sftp_server)
+            transport.start_server(server=StubServer())
+            self.transports.append(transport)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+        self._proxy = _shaped(self.port, self.latency, self.bandwidth)
+        if self._proxy:
+            self.port = self._proxy.port
+        return self
+
+    def stop(self):
+        if self._proxy:
+            self._proxy.stop()
+        self._running = False
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+        for transport in self.transports:
+            transport.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, tb):
+        self.stop()
+
+
+class LoopbackSSHD(object):
+    """
+    Runs the system's sshd on a random localhost port as the current user, with a generated host key and a
+    generated client key as the only authorized one. Paths aren't rooted: the server sees the local filesystem.
+
+    ssh clients need no configuration beyond the client key: bin_dir holds an ssh wrapper accepting the
+    generated host key, for putting first on the PATH of whatever runs ssh or rsync.
+    """
+
+    def __init__(self, latency=0, bandwidth=None):
+        """
+        :param latency: One-way delay in seconds added to the connection
+        :param bandwidth: Cap in bytes per second on the connection, in each direction
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.user = getpass.getuser()
+        self.port = None
+        self._proxy = None
+        self._process = None
+        self._dir = None
+
+    @staticmethod
+    def available():
+        """
+        Whether sshd, ssh and ssh-keygen can all be found
+        """
+        return all(LoopbackSSHD._find(name) for name in ('sshd', 'ssh', 'ssh-keygen'))
+
+    @staticmethod
+    def _find(name):
+        return distutils.spawn.find_executable(name, os.environ.get('PATH', '') + ':/usr/sbin:/usr/local/sbin')
+
+    def _keygen(self, path):
+        subprocess.check_call([self._find('ssh-keygen'), '-q', '-t', 'rsa', '-b', '2048', '-N', '', '-f', path])
+
+    def start(self):
+        self._dir = tempfile.mkdtemp()
+        host_key = os.path.join(self._dir, 'host_key')
+        self.client_key = os.path.join(self._dir, 'client_key')
+        self._keygen(host_key)
+        self._keygen(self.client_key)
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        config = os.path.join(self._dir, 'sshd_config')
+        with open(config, 'w') as fh:
+            fh.write('\n'.join(['Port {}'.format(port),
+                                 'ListenAddress 127.0.0.1',
+                                 'HostKey {}'.format(host_key),
+                                 'AuthorizedKeysFile {}.pub'.format(self.client_key),
+                                 'PidFile {}'.format(os.path.join(self._dir, 'sshd.pid')),
+                                 'PasswordAuthentication no',
+                                 'StrictModes no',
+                                 'UsePAM no',
+                                 'Subsystem sftp internal-sftp']) + '\n')
+        self._process = subprocess.Popen([self._find('sshd'), '-D', '-e', '-f', config],
+                                         stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 0.5).close()
+                break
+            except socket.error:
+                if self._process.poll() is not None or time.time() > deadline:
+                    self.stop()
+                    raise Exception("sshd did not start on port {}".format(port))
+                time.sleep(0.05)
+
+        self.bin_dir = os.path.join(self._dir, 'bin')
+        os.mkdir(self.bin_dir)
+        wrapper = os.path.join(self.bin_dir, 'ssh')
+        with open(wrapper, 'w') as fh:
+            fh.write('#!/bin/sh\nexec {} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null '
+                     '-o LogLevel=ERROR "$@"\n'.format(self._find('ssh')))
+        os.chmod(wrapper, 0755)
+
+        self.port = port
+        self._proxy = _shaped(port, self.latency, self.bandwidth)
+        if self._proxy:
+            self.port = self._proxy.port
+        return self
+
+    def stop(self):
+        if self._proxy:
+            self._proxy.stop()
+        if self._process and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait()
+        if self._dir:
+            shutil.rmtree(self._dir)
+            self._dir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, tb):
+        self.stop()
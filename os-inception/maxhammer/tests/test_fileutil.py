@@ -1,6 +1,10 @@
 import unittest
+import hashlib
 import os
-from maxhammer import fileutil
+import stat
+import shutil
+import tempfile
+from maxhammer import fileutil, metrics
 
 
 class TestFileUtil(unittest.TestCase):
@@ -72,6 +76,164 @@ class TestFileUtil(unittest.TestCase):
         # check that dots don't get treated as a wildcard
         self.assertFalse(fileutil.check_include(rootdir, 'dir1/agit', [rootdir + '/dir1/.git']))
 
+    def test_compiled_filter_matches_check_include(self):
+        rootdir = os.path.abspath('fileutil')
+        include_list = [rootdir + '/dir1', rootdir + '/dir2/f*le*1']
+        exclude_list = [rootdir + '/dir1/dir1-1']
+        wanted = fileutil.compile_path_filter(include_list, exclude_list)
+
+        for root, dirs, files in os.walk(rootdir):
+            for name in dirs + files:
+                expected = not fileutil.check_include(root, name, exclude_list) and \
+                    fileutil.check_include(root, name, include_list)
+                self.assertEqual(wanted(root, name), expected, os.path.join(root, name))
+        self.assertTrue(fileutil.compile_path_filter()(rootdir, 'dir1'))
+
+
+class TestStagedSync(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.build = os.path.join(self.base, 'build')
+        os.makedirs(os.path.join(self.build, 'sub'))
+        self._write(os.path.join(self.build, 'same'), 'unchanged')
+        self._write(os.path.join(self.build, 'sub', 'changing'), 'version 1')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def _write(self, path, content):
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def _read(self, path):
+        with open(path) as fh:
+            return fh.read()
+
+    def test_sync_into_new_destination(self):
+        dest = os.path.join(self.base, 'out', 'dest')
+        totals = fileutil.staged_sync(self.build, dest)
+        self.assertEqual(totals['copied'], 2)
+        self.assertEqual(self._read(os.path.join(dest, 'sub', 'changing')), 'version 1')
+
+    def test_resync_links_unchanged_files(self):
+        dest = os.path.join(self.base, 'dest')
+        fileutil.staged_sync(self.build, dest)
+        inode = os.stat(os.path.join(dest, 'same')).st_ino
+        self._write(os.path.join(dest, 'stale'), 'gone after the swap')
+        self._write(os.path.join(self.build, 'sub', 'changing'), 'version 2')
+
+        totals = fileutil.staged_sync(self.build, dest)
+        self.assertEqual((totals['linked'], totals['copied']), (1, 1))
+        self.assertEqual(os.stat(os.path.join(dest, 'same')).st_ino, inode)
+        self.assertEqual(self._read(os.path.join(dest, 'sub', 'changing')), 'version 2')
+        self.assertFalse(os.path.exists(os.path.join(dest, 'stale')))
+        self.assertEqual(sorted(os.listdir(self.base)), ['build', 'dest'])
+
+    def test_directory_modes_are_kept_whatever_the_umask(self):
+        os.chmod(self.build, 0775)
+        os.chmod(os.path.join(self.build, 'sub'), 0555)
+        os.symlink('v0', os.path.join(self.base, 'linked'))
+        umask = os.umask(0077)
+        try:
+            for dest in ('dest', 'linked'):
+                fileutil.staged_sync(self.build, os.path.join(self.base, dest))
+                # twice, the second time through the staging of an existing tree
+                fileutil.staged_sync(self.build, os.path.join(self.base, dest))
+                self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.base, dest)).st_mode), 0775)
+                self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.base, dest, 'sub')).st_mode), 0555)
+        finally:
+            os.umask(umask)
+            os.chmod(os.path.join(self.build, 'sub'), 0755)
+            for root, dirs, files in os.walk(self.base):
+                for d in dirs:
+                    os.chmod(os.path.join(root, d), 0755)
+
+    def test_symlink_destination_is_flipped(self):
+        fileutil.staged_sync(self.build, os.path.join(self.base, 'v0'))
+        dest = os.path.join(self.base, 'dest')
+        os.symlink('v0', dest)
+        self._write(os.path.join(self.build, 'sub', 'changing'), 'version 2')
+
+        fileutil.staged_sync(self.build, dest)
+        self.assertTrue(os.path.islink(dest))
+        first = os.readlink(dest)
+        self.assertTrue(first.startswith('.dest.mh-'))
+        self.assertEqual(self._read(os.path.join(dest, 'sub', 'changing')), 'version 2')
+        # the link's original target wasn't created by maxhammer, so it's left alone
+        self.assertTrue(os.path.isdir(os.path.join(self.base, 'v0')))
+
+        fileutil.staged_sync(self.build, dest)
+        self.assertNotEqual(os.readlink(dest), first)
+        self.assertFalse(os.path.exists(os.path.join(self.base, first)))
+
+
+class TestDigestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.base, 'digests')
+        self.files = {}
+        for i in range(8):
+            # big enough for some to be hashed through a memory map
+            content = os.urandom(fileutil.MMAP_THRESHOLD + 1 if i % 4 == 0 else 100 * i)
+            path = os.path.join(self.base, 'file{}'.format(i))
+            with open(path, 'wb') as fh:
+                fh.write(content)
+            self.files[path] = hashlib.sha1(content).hexdigest()
+        metrics.RUN.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def _counter(self, name):
+        return sum(c['value'] for c in metrics.RUN.report()['counters'] if c['name'] == name)
+
+    def test_digests_are_hashed_in_parallel_once(self):
+        cache = fileutil.DigestCache(self.cache_path)
+        self.assertEqual(cache.digests(self.files.keys()), self.files)
+        self.assertEqual(self._counter('files_hashed'), len(self.files))
+        cache.save()
+
+        # a later run reads back only the changed file, and the one linked to as that changes its inode's
+        # change time. Hardlinks share digests.
+        path = sorted(self.files)[1]
+        with open(path, 'ab') as fh:
+            fh.write('more')
+        with open(path, 'rb') as fh:
+            self.files[path] = hashlib.sha1(fh.read()).hexdigest()
+        os.link(sorted(self.files)[2], os.path.join(self.base, 'link'))
+
+        cache = fileutil.DigestCache(self.cache_path)
+        self.assertEqual(cache.digests(self.files.keys()), self.files)
+        self.assertEqual(cache.digest(os.path.join(self.base, 'link')), self.files[sorted(self.files)[2]])
+        self.assertEqual(self._counter('files_hashed'), len(self.files) + 2)
+        self.assertEqual(self._counter('digests_cached'), len(self.files) - 1)
+
+    def test_recycled_inodes_and_build_directories(self):
+        cache = fileutil.DigestCache(self.cache_path)
+        path = sorted(self.files)[1]
+        cache.digest(path)
+
+        # a copy keeping the size and modification time of a removed file, even if it takes over its inode,
+        # was created since
+        st = os.stat(path)
+        os.remove(path)
+        with open(path, 'wb') as fh:
+            fh.write('x' * st.st_size)
+        os.utime(path, (st.st_atime, st.st_mtime))
+        self.assertEqual(cache.digest(path), hashlib.sha1('x' * st.st_size).hexdigest())
+
+        build = os.path.join(self.base, 'build')
+        os.mkdir(build)
+        cache.transient(build)
+        with open(os.path.join(build, 'rendered'), 'wb') as fh:
+            fh.write('rendered')
+        self.assertEqual(cache.digest(os.path.join(build, 'rendered')), hashlib.sha1('rendered').hexdigest())
+        self.assertEqual(cache.digest(os.path.join(build, 'rendered')), hashlib.sha1('rendered').hexdigest())
+        cache.save()
+        self.assertEqual(len(fileutil.DigestCache(self.cache_path)._entries), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,220 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from foremanapi import foreman as foremanapi
+from maxhammer import foreman
+from benchmarks import bench_foreman
+from foremanstub import ForemanStub
+
+
+class Clouddata(dict):
+    """
+    Clouddata noting when templates first read it
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.rendering = threading.Event()
+
+    def __getitem__(self, key):
+        if key == 'environment':
+            self.rendering.set()
+        return dict.__getitem__(self, key)
+
+
+class FakeAPI:
+
+    def __init__(self, clouddata):
+        self.clouddata = clouddata
+        self.rendered_during_load = None
+
+    def get_hostgroups(self):
+        # only returns once a template has been rendered, which fails unless the two overlap
+        self.rendered_during_load = self.clouddata.rendering.wait(5)
+        return {'test': 1, 'test/compute': 2}
+
+    def __getattr__(self, name):
+        return lambda *args: {}
+
+
+class TestProcessConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.hostgroups = os.path.join(self.base, 'hostgroups')
+        self._write('base.yaml', 'Base:\n  environment: {{ cloud.environment }}\n')
+        self._write('roles/compute.yaml', 'compute:\n  puppetclasses: [nova]\n')
+        self._write('roles/control.yaml', 'control:\n  environment: {{ cloud.environment }}\n')
+        self.clouddata = Clouddata(name='test', environment='production', buildserver='foreman.example.com')
+        self.fc = foreman.Foreman(self.clouddata, self.hostgroups)
+        self.fc.foremanapi = FakeAPI(self.clouddata)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def _write(self, name, content):
+        path = os.path.join(self.hostgroups, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def test_templates_render_alongside_foreman_lookups(self):
+        config = self.fc.process_config()
+        self.assertTrue(self.fc.foremanapi.rendered_during_load)
+        self.assertEqual(self.fc.hostgroups, {'test': 1, 'test/compute': 2})
+        self.assertEqual(config['hostgroups'], {'Base': {'environment': 'production'},
+                                                'compute': {'puppetclasses': ['nova']},
+                                                'control': {'environment': 'production'}})
+        self.assertEqual(config['name'], 'test')
+
+    def test_duplicate_hostgroups(self):
+        self._write('roles/more.yaml', 'compute:\n  puppetclasses: [ceph]\n')
+        with self.assertRaises(Exception) as raised:
+            self.fc.process_config()
+        self.assertTrue("'compute'" in str(raised.exception))
+        self.assertTrue(os.path.join('roles', 'compute.yaml') in str(raised.exception))
+        self.assertTrue(os.path.join('roles', 'more.yaml') in str(raised.exception))
+
+    def test_template_errors(self):
+        self._write('broken.yaml', 'broken: {{ cloud.environment\n')
+        with self.assertRaises(Exception) as raised:
+            self.fc.process_config()
+        self.assertTrue('broken.yaml' in str(raised.exception))
+
+
+class RecordingAPI:
+
+    def __init__(self):
+        self.calls = []
+        self.next_id = 100
+
+    def get_hosts_for_environment(self, environment_id):
+        return [{'id': 7, 'name': 'node1', 'hostgroup_name': 'test/compute'}]
+
+    def get_puppetclass_smart_class_parameters(self, puppetclass_ids):
+        self.calls.append(('get_puppetclass_smart_class_parameters', puppetclass_ids))
+        return {'nova': {'smart_class_parameters': {'workers': 31}}}
+
+    def create_hostgroup(self, **kwargs):
+        self.calls.append(('create_hostgroup', kwargs))
+        self.next_id += 1
+        return {'id': self.next_id}
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args))
+            return {}
+        return call
+
+
+class TestCloudCreate(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {'name': 'test', 'buildserver': 'foreman.example.com', 'environment': 'production',
+                       'domain': 'example.com', 'subnet': 'internal', 'realm': 'EXAMPLE.COM', 'architecture': 'x86_64',
+                       'operatingsystem': 'RHEL 7', 'media': 'RHEL', 'ptable': 'Kickstart'}
+        self.fc = foreman.Foreman(self.config, '/nonexistent')
+        self.fc.foremanapi = RecordingAPI()
+        self.fc.hostgroups = {'test': 1, 'test/compute': 2, 'other': 3}
+        self.fc.environments = {'production': 10}
+        self.fc.proxyfeatures = {'foreman.example.com': {'id': 11}}
+        self.fc.puppetclasses = {'base': 12, 'nova': 13}
+        self.fc.domains = {'example.com': 14}
+        self.fc.subnets = {'internal': 15}
+        self.fc.realms = {'EXAMPLE.COM': 16}
+        self.fc.architectures = {'x86_64': 17}
+        self.fc.operatingsystems = {'RHEL 7': 18}
+        self.fc.media = {'RHEL': 19}
+        self.fc.ptables = {'Kickstart': 20}
+        self.config = dict(self.config,
+                           hostgroups={'Base': {'puppetclasses': ['base'], 'hostgroup_parameters': {'tier': 'gold'}},
+                                       'compute': {'puppetclasses': ['base', 'nova'],
+                                                   'parameterconfig': {'nova': {'workers': 8}}},
+                                       'control': {'puppetclasses': ['nova'],
+                                                   'parameterconfig': {'nova': {'workers': 4}}}})
+
+    def _calls(self, name):
+        return [args for call, args in self.fc.foremanapi.calls if call == name]
+
+    def test_create_runs_on_resolved_ids(self):
+        self.fc.cloud_create(self.config)
+
+        # smart class parameters are looked up once, however many hostgroups override them
+        self.assertEqual(self._calls('get_puppetclass_smart_class_parameters'), [[13]])
+        self.assertEqual(self._calls('delete_hostgroup'), [(2,), (1,)])
+        created = self._calls('create_hostgroup')
+        self.assertEqual(created[0], {'name': 'test', 'parent_id': None, 'puppetclass_ids': [12], 'environment_id': 10,
+                                      'domain_id': 14, 'subnet_id': 15, 'realm_id': 16, 'architecture_id': 17,
+                                      'operatingsystem_id': 18, 'media_id': 19, 'ptable_id': 20, 'puppet_proxy': 11,
+                                      'puppet_ca': 11})
+        # children are created alongside each other, once the base exists
+        self.assertEqual(sorted(created[1:]), [{'name': 'compute', 'parent_id': 101, 'puppetclass_ids': [12, 13]},
+                                               {'name': 'control', 'parent_id': 101, 'puppetclass_ids': [13]}])
+        self.assertEqual(self._calls('create_hostgroup_parameter'), [('tier', 101, 'gold')])
+        self.assertEqual(sorted(self._calls('create_parameter_override')),
+                         [('test/compute', 31, 8), ('test/control', 31, 4)])
+        self.assertEqual(self._calls('set_hostgroup')[-1], (7,))
+
+    def test_unknown_names_stop_everything(self):
+        self.config['domain'] = 'example.org'
+        self.config['hostgroups']['compute']['puppetclasses'].append('ceph')
+        self.config['hostgroups']['control']['parameterconfig']['nova']['threads'] = 2
+        del self.config['ptable']
+
+        with self.assertRaises(Exception) as raised:
+            self.fc.cloud_create(self.config)
+        message = str(raised.exception)
+        for name in ("domain 'example.org'", "puppetclass 'ceph' (test/compute)",
+                     "smart class parameter 'threads' (nova, test/control)", "clouddata setting 'ptable'"):
+            self.assertTrue(name in message, message)
+        self.assertEqual([call for call, args in self.fc.foremanapi.calls],
+                         ['get_puppetclass_smart_class_parameters'])
+
+
+class TestRequestBudget(unittest.TestCase):
+
+    def test_cloud_build_within_budget(self):
+        report = bench_foreman.run(hostgroups=12, hosts=8, latency=0.001)
+        self.assertEqual(bench_foreman.over_budget(report, max_seconds=20), [])
+        self.assertEqual(report['hostgroups_built'], 12)
+        self.assertEqual(report['hosts_restored'], 8)
+
+    def test_injected_failures(self):
+        with ForemanStub(rate_limit=5) as stub:
+            api = foremanapi.ForemanAPI(stub.server, 'hammer', 'hammer', use_ssl=False)
+            stub.add('environments', 'production')
+            stub.inject(503, method='GET', endpoint='environments')
+            self.assertTrue('error' in api._foreman_api_get('environments'))
+            self.assertEqual(api.get_environments(), {'production': 1})
+            for i in range(5):
+                api._foreman_api_get('hostgroups')
+            self.assertEqual(stub.count(status=429), 2)
+            self.assertEqual(stub.count(endpoint='hostgroups', status=200), 3)
+
+
+class TestAdaptiveLimits(unittest.TestCase):
+
+    def test_writes_back_off_from_a_server_turning_requests_away(self):
+        report = bench_foreman.run(hostgroups=12, hosts=8, latency=0.005, capacity=3, write_ceiling=8)
+        self.assertEqual(bench_foreman.over_budget(report), [])
+        self.assertEqual(report['hostgroups_built'], 12)
+        self.assertEqual(report['hosts_restored'], 8)
+        reads, writes = report['limits']
+        self.assertTrue(writes['decreases'] >= 1)
+        self.assertEqual(sum(writes['overloads'].values()), report['results'][1]['overloaded'])
+        self.assertEqual(reads['decreases'], 0)
+
+    def test_writes_back_off_from_a_server_slowing_under_load(self):
+        report = bench_foreman.run(hostgroups=12, hosts=8, latency=0.01, slowdown=0.03, write_ceiling=8)
+        self.assertEqual(bench_foreman.over_budget(report), [])
+        self.assertEqual(report['hostgroups_built'], 12)
+        writes = report['limits'][1]
+        self.assertTrue(writes['overloads'].get('latency') >= 1)
+        self.assertTrue(writes['limit'] < 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import unittest
+import os
+import shutil
+import tempfile
+import yaml
+from foremanapi import foreman as foremanapi
+from maxhammer import distribution, foreman, journal, metrics
+from benchmarks import bench_foreman
+from foremanstub import ForemanStub
+
+
+class FailingAPI:
+    """
+    Passes calls through to a ForemanAPI, failing the nth hostgroup creation
+    """
+
+    def __init__(self, api, fail_at):
+        self._api = api
+        self.fail_at = fail_at
+        self.created = 0
+
+    def __getattr__(self, name):
+        return getattr(self._api, name)
+
+    def create_hostgroup(self, **kwargs):
+        self.created += 1
+        if self.created == self.fail_at:
+            raise Exception("Foreman went away")
+        return self._api.create_hostgroup(**kwargs)
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = journal.journal_path(os.path.join(self.base, 'journals'), 'branch')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_resumed_entries_survive_a_cut_short_line(self):
+        run = journal.Journal(self.path)
+        run.record('hostgroup', config='abc', title='cloud', id=1)
+        run.record('hostgroup', config='abc', title='cloud/role', id=2)
+        run.close()
+        with open(self.path, 'a') as fh:
+            fh.write('{"op": "hostgr')
+
+        resumed = journal.Journal(self.path, resume=True)
+        self.assertEqual(resumed.find('hostgroup', config='abc', title='cloud/role')['id'], 2)
+        self.assertEqual(resumed.find('hostgroup', config='other'), None)
+        resumed.record('hosts_restored', config='abc')
+        resumed.close(completed=True)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_fresh_journal_forgets_earlier_runs(self):
+        run = journal.Journal(self.path)
+        run.record('hostgroup', config='abc', title='cloud', id=1)
+        run.close()
+        self.assertEqual(journal.Journal(self.path).find('hostgroup'), None)
+        with open(self.path, 'w') as fh:
+            fh.write('{"op": "journal", "version": 0}\n')
+        self.assertEqual(journal.Journal(self.path, resume=True).find('journal'), None)
+
+
+class TestResumeHostgroups(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.stub = ForemanStub()
+        self.stub.start()
+        self.hostgroup_path = os.path.join(self.base, 'hostgroups')
+        self.clouddata = bench_foreman.make_cloud(self.stub, self.hostgroup_path, hostgroups=5, hosts=4)
+        self.journal_path = os.path.join(self.base, 'branch.journal')
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.base)
+
+    def _build(self, resume, fail_at=None):
+        run = journal.Journal(self.journal_path, resume=resume)
+        fc = foreman.Foreman(self.clouddata, self.hostgroup_path, journal=run)
+        fc.foremanapi = foremanapi.ForemanAPI(self.stub.server, 'hammer', 'hammer', use_ssl=False)
+        if fail_at:
+            fc.foremanapi = FailingAPI(fc.foremanapi, fail_at)
+        try:
+            fc.cloud_create(fc.process_config())
+        finally:
+            run.close()
+
+    def test_resume_keeps_completed_hostgroups_and_restores_hosts(self):
+        with self.assertRaises(Exception):
+            self._build(resume=False, fail_at=3)
+        # children are created alongside each other, so only the one that failed is sure to be missing
+        built = dict((h['title'], h['id']) for h in self.stub.hostgroups.values())
+        self.assertEqual(len(built), 4)
+        self.assertTrue('bench' in built)
+        self.assertEqual([h for h in self.stub.hosts.values() if h['hostgroup_id'] is not None], [])
+
+        metrics.RUN.reset()
+        self.stub.reset_requests()
+        self._build(resume=True)
+        self.assertEqual(self.stub.count(method='DELETE'), 0)
+        self.assertEqual(self.stub.count(method='POST', endpoint='hostgroups'), 1)
+        counters = dict((c['name'], c['value']) for c in metrics.RUN.report()['counters'])
+        self.assertEqual(counters['hostgroups_resumed'], 4)
+
+        titles = dict((h['title'], h['id']) for h in self.stub.hostgroups.values())
+        self.assertEqual(sorted(titles), ['bench'] + ['bench/role{}'.format(i) for i in range(1, 5)])
+        for title in built:
+            self.assertEqual(titles[title], built[title])
+        self.assertEqual(len([h for h in self.stub.hosts.values() if h['hostgroup_id'] is not None]), 4)
+
+        # a completed build resumed again makes no changes at all
+        self.stub.reset_requests()
+        self._build(resume=True)
+        self.assertEqual(self.stub.count(method='GET'), self.stub.count())
+
+
+class TestResumeTransfers(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.source_base = os.path.join(self.base, 'src')
+        self.journal_path = os.path.join(self.base, 'branch.journal')
+        for module in ('good', 'bad'):
+            path = os.path.join(self.source_base, module, 'config.yaml')
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fh:
+                fh.write('name: {{ cloud.name }}')
+        # a file where the bad module's destination directory should go
+        with open(os.path.join(self.base, 'blocked'), 'w') as fh:
+            fh.write('')
+        config = {'maxhammer': {'process_paths': {
+            'good': {'process_method': 'overcloud', 'sources': ['good'],
+                     'local_destination': os.path.join(self.base, 'out', 'good')},
+            'bad': {'process_method': 'overcloud', 'sources': ['bad'],
+                    'local_destination': os.path.join(self.base, 'blocked', 'bad')}}}}
+        self.manifest_path = os.path.join(self.base, 'maxhammer.yaml')
+        with open(self.manifest_path, 'w') as fh:
+            yaml.safe_dump(config, fh)
+        self.clouddata = {'name': 'test', 'environment': 'test', 'maxhammer': {}}
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def _distribute(self, resume):
+        metrics.RUN.reset()
+        run = journal.Journal(self.journal_path, resume=resume)
+        dist = distribution.Distribution(self.manifest_path, clouddata_config=self.clouddata,
+                                         source_base=self.source_base, send_to_remote=False, journal=run)
+        try:
+            dist.distribute()
+        finally:
+            dist.close()
+            run.close()
+        counters = {}
+        for counter in metrics.RUN.report()['counters']:
+            counters[counter['name']] = counters.get(counter['name'], 0) + counter['value']
+        return counters
+
+    def test_resume_skips_verified_transfers(self):
+        counters = self._distribute(resume=False)
+        self.assertEqual(counters['templates_rendered'], 2)
+        self.assertFalse(os.path.isdir(os.path.join(self.base, 'blocked', 'bad')))
+
+        os.remove(os.path.join(self.base, 'blocked'))
+        counters = self._distribute(resume=True)
+        self.assertEqual(counters['transfers_resumed'], 1)
+        self.assertEqual(counters['templates_rendered'], 1)
+        with open(os.path.join(self.base, 'blocked', 'bad', 'config.yaml')) as fh:
+            self.assertEqual(fh.read(), 'name: test')
+
+    def test_resume_redoes_transfers_no_longer_in_place_or_current(self):
+        self._distribute(resume=False)
+        os.remove(os.path.join(self.base, 'out', '.good.mh-manifest'))
+        self.assertFalse('transfers_resumed' in self._distribute(resume=True))
+
+        self.clouddata['name'] = 'renamed'
+        counters = self._distribute(resume=True)
+        self.assertFalse('transfers_resumed' in counters)
+        with open(os.path.join(self.base, 'out', 'good', 'config.yaml')) as fh:
+            self.assertEqual(fh.read(), 'name: renamed')
+
+
+if __name__ == '__main__':
+    unittest.main()
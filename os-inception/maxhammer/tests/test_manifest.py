@@ -0,0 +1,177 @@
+import unittest
+import os
+import re
+import shutil
+import tempfile
+import yaml
+import paramiko
+from maxhammer import distribution, manifest, metrics
+from sshstub import SSHStub
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.tree = os.path.join(self.base, 'tree')
+        self._write('top', 'top')
+        self._write('sub/same', 'same')
+        self._write('sub/changing', 'version 1')
+        self._write('other/file', 'other')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def _write(self, path, content):
+        path = os.path.join(self.tree, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def test_diff_descends_only_into_changes(self):
+        previous = manifest.build(self.tree)
+        self.assertEqual(manifest.build(self.tree), previous)
+        self.assertEqual(manifest.diff(previous, previous), {'changed': [], 'deleted': []})
+
+        self._write('sub/changing', 'version 2')
+        self._write('new/file', 'new')
+        os.chmod(os.path.join(self.tree, 'top'), 0700)
+        shutil.rmtree(os.path.join(self.tree, 'other'))
+        self._write('other', 'now a file')
+        built = manifest.build(self.tree)
+
+        self.assertNotEqual(built['root'], previous['root'])
+        self.assertEqual(built['entries']['sub/same'], previous['entries']['sub/same'])
+        changes = manifest.diff(built, previous)
+        self.assertEqual(changes['changed'], ['new', 'new/file', 'other', 'sub/changing', 'top'])
+        # removing the directory that became a file takes its contents with it
+        self.assertEqual(changes['deleted'], ['other'])
+
+    def test_saved_manifest_round_trips(self):
+        dest = os.path.join(self.base, 'dest')
+        self.assertEqual(manifest.read_root(dest), None)
+        os.mkdir(dest)
+        built = manifest.build(self.tree)
+        manifest.save(dest, built)
+
+        self.assertTrue(os.path.exists(os.path.join(self.base, '.dest.mh-manifest')))
+        self.assertEqual(manifest.read_root(dest), built['root'])
+        self.assertEqual(manifest.load(dest), built)
+        manifest.remove(dest)
+        self.assertEqual(manifest.load(dest), None)
+
+
+class TestManifestDistribution(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.source_base = os.path.join(self.base, 'src')
+        self.local = os.path.join(self.base, 'local')
+        self.remote = os.path.join(self.base, 'remote')
+        self._write('module/same', 'same')
+        self._write('module/sub/changing', 'version 1')
+        self._write('module/going', 'going')
+
+        self.key_file = os.path.join(self.base, 'id_rsa')
+        paramiko.RSAKey.generate(1024).write_private_key_file(self.key_file)
+        self.stub = SSHStub().start()
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.base)
+
+    def _write(self, path, content):
+        path = os.path.join(self.source_base, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def _distribute(self):
+        config = {'maxhammer': {'process_paths': {'module': {
+            'process_method': 'none',
+            'transfer_method': 'tar',
+            'sources': ['module'],
+            'local_destination': self.local,
+            'remote_hosts': [{'host': 'undercloud', 'destination': self.remote}]}}}}
+        manifest_path = os.path.join(self.base, 'maxhammer.yaml')
+        with open(manifest_path, 'w') as fh:
+            yaml.safe_dump(config, fh)
+        clouddata = {'environment': 'test',
+                     'maxhammer': {'undercloud': {'host': '127.0.0.1', 'port': self.stub.port, 'user': 'stack',
+                                                  'dist_key': self.key_file}}}
+        metrics.RUN.reset()
+        dist = distribution.Distribution(manifest_path, clouddata_config=clouddata, source_base=self.source_base)
+        try:
+            dist.distribute()
+        finally:
+            dist.close()
+        return self._counters()
+
+    def _counters(self):
+        counters = {}
+        for counter in metrics.RUN.report()['counters']:
+            key = (counter['name'], counter['scope'].get('destination'))
+            counters[key] = counters.get(key, 0) + counter['value']
+        return counters
+
+    def _tree(self, path):
+        tree = {}
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                with open(os.path.join(root, f)) as fh:
+                    tree[os.path.relpath(os.path.join(root, f), path)] = fh.read()
+        return tree
+
+    def test_unchanged_trees_are_skipped_and_changes_sent_alone(self):
+        counters = self._distribute()
+        self.assertFalse(('transfers_skipped', 'undercloud') in counters)
+        source = self._tree(os.path.join(self.source_base, 'module'))
+        self.assertEqual(self._tree(self.remote), source)
+
+        counters = self._distribute()
+        self.assertEqual(counters[('transfers_skipped', 'undercloud')], 1)
+        self.assertEqual(counters[('transfers_skipped', 'local')], 1)
+        self.assertFalse(('bytes_transferred', 'undercloud') in counters)
+
+        self._write('module/sub/changing', 'version 2')
+        os.remove(os.path.join(self.source_base, 'module', 'going'))
+        counters = self._distribute()
+        self.assertEqual(counters[('bytes_transferred', 'undercloud')], len('version 2'))
+        source = self._tree(os.path.join(self.source_base, 'module'))
+        self.assertEqual(self._tree(self.remote), source)
+        self.assertEqual(self._tree(self.local), source)
+
+    def test_rsync_deletes_what_the_manifest_shows_was_deleted(self):
+        sent = []
+
+        class Process:
+            returncode = 0
+
+            def __init__(self, cmd, **kwargs):
+                list_path = re.search(r'--files-from=(\S+)', cmd).group(1)
+                with open(list_path) as fh:
+                    sent.append((cmd, fh.read().splitlines()))
+
+            def communicate(self):
+                return ('sent 9 bytes  received 0 bytes', None)
+
+        manifest_path = os.path.join(self.base, 'maxhammer.yaml')
+        with open(manifest_path, 'w') as fh:
+            yaml.safe_dump({'maxhammer': {'process_paths': {}}}, fh)
+        dist = distribution.Distribution(manifest_path, clouddata_config={'maxhammer': {}},
+                                         source_base=self.source_base)
+        dest_cfg = distribution.Destination('undercloud', '127.0.0.1', 22, 'stack', self.key_file)
+        original, distribution.Popen = distribution.Popen, Process
+        try:
+            sent_bytes = dist._rsync_to_remote(self.source_base, dest_cfg, '/remote',
+                                               {'changed': ['sub', 'sub/changing', 'replaced'],
+                                                'deleted': ['going', 'replaced']})
+        finally:
+            distribution.Popen = original
+            dist.close()
+        cmd, paths = sent[0]
+        self.assertEqual(paths, ['sub', 'sub/changing', 'replaced', 'going'])
+        self.assertTrue('--delete-missing-args --force' in cmd)
+        self.assertEqual(sent_bytes, 9)
@@ -0,0 +1,56 @@
+import unittest
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+from maxhammer import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_measurements_aggregate_by_name_and_scope(self):
+        measured = metrics.Metrics()
+        for i in range(3):
+            with measured.timer('transfer', module='overcloud', destination='undercloud'):
+                pass
+        measured.add_time('transfer', 2.5, module='ansible', destination=None)
+        measured.count('bytes_transferred', 1024, module='overcloud')
+        measured.count('bytes_transferred', 1024, module='overcloud')
+
+        report = measured.report()
+        self.assertEqual([(t['scope'], t['calls']) for t in report['timers']],
+                         [({'module': 'overcloud', 'destination': 'undercloud'}, 3), ({'module': 'ansible'}, 1)])
+        self.assertEqual(report['counters'], [{'name': 'bytes_transferred', 'scope': {'module': 'overcloud'},
+                                               'value': 2048}])
+        summary = measured.summary()
+        self.assertTrue(summary[1].strip().startswith('2.500s'))
+        self.assertTrue('2.0 KiB  bytes_transferred module=overcloud' in summary[-1])
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_threads_are_profiled(self):
+        def worker_only():
+            return sum(range(1000))
+
+        profiler = metrics.Profiler()
+        profiler.start()
+        thread = threading.Thread(target=worker_only)
+        thread.start()
+        thread.join()
+        path = os.path.join(self.base, 'profile.pstats')
+        profiler.stop(path)
+
+        functions = [function for filename, line, function in pstats.Stats(path).stats]
+        self.assertTrue('worker_only' in functions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+import os
+import shutil
+import tempfile
+import yaml
+import paramiko
+from maxhammer import distribution, plan
+from sshstub import SSHStub
+
+
+class TestChangePlan(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.source_base = os.path.join(self.base, 'src')
+        self._write(os.path.join(self.source_base, 'module', 'same'), 'same')
+        self._write(os.path.join(self.source_base, 'module', 'changed'), 'new content')
+        self._write(os.path.join(self.source_base, 'module', 'added'), 'added')
+
+        self.local = os.path.join(self.base, 'local')
+        self.remote = os.path.join(self.base, 'remote')
+        for destination in (self.local, self.remote):
+            self._write(os.path.join(destination, 'same'), 'same')
+            self._write(os.path.join(destination, 'changed'), 'old')
+            self._write(os.path.join(destination, 'stale'), 'stale')
+
+        self.key_file = os.path.join(self.base, 'id_rsa')
+        paramiko.RSAKey.generate(1024).write_private_key_file(self.key_file)
+        self.stub = SSHStub().start()
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.base)
+
+    def _write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def _distribution(self):
+        manifest = {'maxhammer': {'process_paths': {'module': {
+            'process_method': 'none',
+            'transfer_method': 'tar',
+            'sources': ['module'],
+            'local_destination': self.local,
+            'remote_hosts': [{'host': 'undercloud', 'destination': self.remote}]}}}}
+        manifest_path = os.path.join(self.base, 'maxhammer.yaml')
+        with open(manifest_path, 'w') as fh:
+            yaml.safe_dump(manifest, fh)
+        clouddata = {'environment': 'test',
+                     'maxhammer': {'undercloud': {'host': '127.0.0.1', 'port': self.stub.port, 'user': 'stack',
+                                                  'dist_key': self.key_file}}}
+        return distribution.Distribution(manifest_path, clouddata_config=clouddata, source_base=self.source_base)
+
+    def test_diff_snapshots(self):
+        built = {'a': (1, 0644, 'x'), 'b': (2, 0644, 'y'), 'c': (3, 0755, 'z')}
+        current = {'a': (1, 0644, 'x'), 'b': (2, 0644, 'old'), 'd': (4, 0644, 'w')}
+        diff = plan.diff_snapshots(built, current)
+        self.assertEqual(diff, {'add': ['c'], 'update': ['b'], 'delete': ['d'], 'bytes': 5})
+        self.assertEqual(plan.diff_snapshots(built, current, deletes=False)['delete'], [])
+
+    def test_remote_snapshot_matches_local(self):
+        dist = self._distribution()
+        try:
+            dest_cfg = dist._destinations['undercloud']
+            self.assertEqual(plan.remote_snapshot(dist.connections, dest_cfg, self.remote),
+                             plan.local_snapshot(self.remote))
+            self.assertEqual(plan.remote_snapshot(dist.connections, dest_cfg, os.path.join(self.base, 'missing')), {})
+        finally:
+            dist.close()
+
+    def test_plan_changes_nothing_until_applied(self):
+        plan_file = os.path.join(self.base, 'plan.json')
+        build_root = os.path.join(self.base, 'plan.json.d')
+        os.makedirs(build_root)
+
+        change_plan = plan.Plan(branch='test', build_root=build_root)
+        dist = self._distribution()
+        try:
+            dist.plan(change_plan)
+        finally:
+            dist.close()
+        change_plan.save(plan_file)
+
+        self.assertEqual(len(change_plan.transfers), 2)
+        for transfer in change_plan.transfers:
+            self.assertEqual(transfer['changes']['add'], ['added'])
+            self.assertEqual(transfer['changes']['update'], ['changed'])
+            self.assertEqual(transfer['changes']['delete'], ['stale'])
+        self.assertTrue(change_plan.summary()[-1].startswith('  Total: 2 of 2 transfers with changes, 6 files'))
+        for destination in (self.local, self.remote):
+            self.assertTrue(os.path.exists(os.path.join(destination, 'stale')))
+
+        # the rendered trees are delivered as planned, even if the sources changed since
+        self._write(os.path.join(self.source_base, 'module', 'changed'), 'newer content')
+        dist = self._distribution()
+        try:
+            dist.apply_plan(plan.Plan.load(plan_file))
+        finally:
+            dist.close()
+        for destination in (self.local, self.remote):
+            self.assertEqual(sorted(os.listdir(destination)), ['added', 'changed', 'same'])
+            with open(os.path.join(destination, 'changed')) as fh:
+                self.assertEqual(fh.read(), 'new content')
+
+
+if __name__ == '__main__':
+    unittest.main()
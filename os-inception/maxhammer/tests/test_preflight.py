@@ -0,0 +1,124 @@
+import unittest
+import os
+import shutil
+import socket
+import tempfile
+import yaml
+import paramiko
+from maxhammer import connection, distribution
+from sshstub import SSHStub
+
+
+def _unused_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestPrecheck(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.source_base = os.path.join(self.base, 'src')
+        os.makedirs(os.path.join(self.source_base, 'module'))
+        with open(os.path.join(self.source_base, 'module', 'file'), 'w') as fh:
+            fh.write('content')
+
+        self.key_file = os.path.join(self.base, 'id_rsa')
+        paramiko.RSAKey.generate(1024).write_private_key_file(self.key_file)
+        self.stub = SSHStub().start()
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.base)
+
+    def _distribution(self, port, local_destination, remote_destination):
+        manifest = {'maxhammer': {'connect_timeout': 2, 'process_paths': {'module': {
+            'process_method': 'none',
+            'transfer_method': 'tar',
+            'sources': ['module'],
+            'local_destination': local_destination,
+            'remote_hosts': [{'host': 'undercloud', 'destination': remote_destination}]}}}}
+        manifest_path = os.path.join(self.base, 'maxhammer.yaml')
+        with open(manifest_path, 'w') as fh:
+            yaml.safe_dump(manifest, fh)
+        clouddata = {'environment': 'test',
+                     'maxhammer': {'undercloud': {'host': '127.0.0.1', 'port': port, 'user': 'stack',
+                                                  'dist_key': self.key_file}}}
+        return distribution.Distribution(manifest_path, clouddata_config=clouddata, source_base=self.source_base)
+
+    def test_precheck_passes_and_reuses_connection(self):
+        remote = os.path.join(self.base, 'remote', '%environment%')
+        dist = self._distribution(self.stub.port, os.path.join(self.base, 'local'), remote)
+        try:
+            self.assertTrue(dist.precheck())
+            dist.distribute()
+        finally:
+            dist.close()
+        self.assertTrue(os.path.isfile(os.path.join(self.base, 'remote', 'test', 'file')))
+        self.assertTrue(os.path.isfile(os.path.join(self.base, 'local', 'file')))
+        self.assertEqual(len(self.stub.transports), 1)
+
+    def test_precheck_reports_every_failure(self):
+        blocker = os.path.join(self.base, 'blocker')
+        with open(blocker, 'w') as fh:
+            fh.write('not a directory')
+        dist = self._distribution(_unused_port(), os.path.join(blocker, 'local'), '/tmp/remote')
+        try:
+            checker = distribution.preflight.Preflight(dist.connections, dist.logger)
+            failures = distribution.preflight.run_concurrently(dist._local_checks(checker) + dist._remote_checks(checker))
+            self.assertFalse(dist.precheck())
+        finally:
+            dist.close()
+        self.assertEqual(len(failures), 2)
+
+    def test_precheck_unwritable_remote_path(self):
+        blocker = os.path.join(self.base, 'blocker')
+        with open(blocker, 'w') as fh:
+            fh.write('not a directory')
+        dist = self._distribution(self.stub.port, os.path.join(self.base, 'local'), os.path.join(blocker, 'remote'))
+        try:
+            checker = distribution.preflight.Preflight(dist.connections, dist.logger)
+            failures = distribution.preflight.run_concurrently(dist._remote_checks(checker))
+        finally:
+            dist.close()
+        self.assertEqual(len(failures), 1)
+        self.assertTrue('is not writable' in failures[0])
+
+
+class TestPooledCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.key_file = os.path.join(self.base, 'id_rsa')
+        paramiko.RSAKey.generate(1024).write_private_key_file(self.key_file)
+        self.stub = SSHStub().start()
+        self.dest_cfg = distribution.Destination('undercloud', '127.0.0.1', self.stub.port, 'stack', self.key_file)
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.base)
+
+    def test_output_on_both_streams(self):
+        pool = connection.ConnectionPool(timeout=2, command_timeout=10)
+        try:
+            # more stderr than the channel window, which deadlocks if stdout is read to its end first
+            rc, stdout, stderr = pool.exec_command(self.dest_cfg, 'head -c 3000000 /dev/zero >&2; echo ok; exit 3')
+        finally:
+            pool.close()
+        self.assertEqual((rc, stdout, len(stderr)), (3, 'ok\n', 3000000))
+
+    def test_hung_command_times_out(self):
+        pool = connection.ConnectionPool(timeout=2, command_timeout=0.5)
+        try:
+            with self.assertRaises(Exception) as raised:
+                pool.exec_command(self.dest_cfg, 'sleep 5')
+        finally:
+            pool.close()
+        self.assertTrue('did not complete within' in str(raised.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
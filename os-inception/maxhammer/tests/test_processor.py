@@ -0,0 +1,93 @@
+import unittest
+import os
+import shutil
+import tempfile
+from maxhammer import ansible, overcloud, processor
+
+
+class TestRenderTree(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.config = os.path.join(self.base, 'config')
+        self.output = os.path.join(self.base, 'output')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def _write(self, path, content):
+        path = os.path.join(self.config, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def _read(self, path):
+        with open(os.path.join(self.output, path)) as fh:
+            return fh.read()
+
+    def test_includes_resolve_from_the_rendered_directory(self):
+        self._write('top.yaml', '{% include "leaf.yaml" %}')
+        self._write('leaf.yaml', 'root {{ cloud.name }}')
+        self._write('sub/top.yaml', '{% include "inc/part.yaml" %}')
+        self._write('sub/leaf.yaml', 'sub {{ cloud.name }}')
+        self._write('sub/inc/part.yaml', '{% include "leaf.yaml" %}')
+        self._write('sub/inc/leaf.yaml', 'inc {{ cloud.name }}')
+
+        counts = overcloud.Overcloud(self.config).process_overcloud_config_files({'name': 'test'}, self.output)
+        self.assertEqual(counts['rendered'], 6)
+        self.assertEqual(self._read('top.yaml'), 'root test')
+        # included while rendering sub, so inc/part.yaml pulls in sub/leaf.yaml
+        self.assertEqual(self._read('sub/top.yaml'), 'sub test')
+        self.assertEqual(self._read('sub/inc/part.yaml'), 'inc test')
+
+    def test_ansible_delimiters_and_filters(self):
+        self._write('keep/site.yml', '[% for n in cloud.nodes %][{ n }] [% endfor %]{{ untouched }}')
+        self._write('keep/skip/site.yml', '[{ cloud.missing.attribute }]')
+        self._write('other/site.yml', '[{ cloud.name }]')
+
+        ansible.Ansible(self.config).process_ansible_config_files(
+            {'name': 'test', 'nodes': ['a', 'b']}, self.output,
+            include_list=[os.path.join(self.config, 'keep')],
+            exclude_list=[os.path.join(self.config, 'keep', 'skip')])
+        self.assertEqual(self._read('keep/site.yml'), 'a b {{ untouched }}')
+        self.assertEqual(os.listdir(self.output), ['keep'])
+        self.assertEqual(os.listdir(os.path.join(self.output, 'keep')), ['site.yml'])
+
+
+class TestStaticFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.config = os.path.join(self.base, 'config')
+        self.output = os.path.join(self.base, 'output')
+        os.makedirs(self.config)
+        self.files = {'template.yaml': 'name: {{ cloud.name }}\n',
+                      'static.conf': 'no templating here\r\n',
+                      'payload.bin': '\x89PNG\0{{ not a template }}\xff',
+                      'playbook.yml': 'untouched: "{{ ansible_var }}"\n'}
+        for name, content in self.files.items():
+            with open(os.path.join(self.config, name), 'wb') as fh:
+                fh.write(content)
+        os.chmod(os.path.join(self.config, 'static.conf'), 0750)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def _read(self, name):
+        with open(os.path.join(self.output, name), 'rb') as fh:
+            return fh.read()
+
+    def test_static_and_binary_files_are_copied_exactly(self):
+        proc = processor.Processor(self.config)
+        counts = proc.run({'name': 'test'}, self.output, process_method=processor.ANSIBLE)
+        # only ansible delimiters make a template, so all but the generic template are static
+        self.assertEqual((counts['rendered'], counts['static']), (0, 4))
+        for name, content in self.files.items():
+            self.assertEqual(self._read(name), content)
+        self.assertEqual(os.stat(os.path.join(self.output, 'static.conf')).st_mode & 0777, 0750)
+
+        counts = proc.run({'name': 'test'}, self.output, process_method=processor.GENERIC,
+                          changed=['payload.bin', 'template.yaml'])
+        self.assertEqual((counts['rendered'], counts['static']), (1, 1))
+        self.assertEqual(self._read('template.yaml'), 'name: test')
@@ -0,0 +1,156 @@
+import unittest
+import json
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+import logging
+import yaml
+from maxhammer import runner
+from benchmarks import bench_startup
+
+# Seconds allowed for each startup case, generous next to bench_startup.STARTUP_BUDGET
+STARTUP_SECONDS = 2
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.envpath = os.path.join(self.base, 'environments')
+        for branch in ('one', 'two', 'three'):
+            branch_path = os.path.join(self.envpath, runner.DEFAULT_PUPPETENV_PREFIX + branch)
+            self._write(os.path.join(branch_path, 'clouddata', 'clouddata', branch + '.yaml'),
+                        yaml.safe_dump({'buildserver': 'foreman', 'name': branch, 'environment': branch,
+                                        'maxhammer': {}}))
+            self._write(os.path.join(branch_path, 'module', 'config.yaml'), 'name: {{ cloud.name }}')
+            manifest = {'maxhammer': {'process_paths': {'module': {
+                'process_method': 'overcloud',
+                'sources': ['module'],
+                'local_destination': os.path.join(self.base, 'out', branch)}}}}
+            self._write(os.path.join(branch_path, runner.DEFAULT_MANIFEST_FILE), yaml.safe_dump(manifest))
+        self.argv = sys.argv
+
+    def tearDown(self):
+        sys.argv = self.argv
+        shutil.rmtree(self.base)
+
+    def _write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def _run(self, *args):
+        sys.argv = ['maxhammer', '--puppetenvpath', self.envpath, '--no-hostgroup', '--no-yaml-cache', '--no-digest-cache',
+                    '--journal-dir', os.path.join(self.base, 'journals')] + list(args)
+        batch_runner = runner.Runner()
+        batch_runner.run()
+        return batch_runner
+
+    def test_all_branches_share_compiled_templates(self):
+        batch_runner = self._run('--all-branches', '--parallel', '1')
+        for branch in ('one', 'two', 'three'):
+            with open(os.path.join(self.base, 'out', branch, 'config.yaml')) as fh:
+                self.assertEqual(fh.read(), 'name: ' + branch)
+        self.assertEqual(batch_runner.template_cache.hits, 2)
+
+    def test_report_and_profile(self):
+        report = os.path.join(self.base, 'report.json')
+        profile = os.path.join(self.base, 'profile.pstats')
+        self._run('--branch', 'one', '--report', report, '--profile', profile)
+
+        with open(report) as fh:
+            measured = json.load(fh)
+        timers = dict((t['name'], t) for t in measured['timers'])
+        self.assertEqual(timers['phase']['scope'], {'phase': 'distribution', 'branch': 'one'})
+        self.assertEqual(timers['transfer']['scope'], {'module': 'module', 'destination': 'local'})
+        counters = dict((c['name'], c['value']) for c in measured['counters'])
+        self.assertEqual(counters['templates_rendered'], 1)
+        self.assertEqual(counters['bytes_copied'], len('name: one'))
+        # no hostgroups were built, so no Foreman server was limited
+        self.assertEqual(measured['foreman_limits'], {})
+
+        functions = [function for filename, line, function in pstats.Stats(profile).stats]
+        self.assertTrue('staged_sync' in functions)
+
+    def test_failed_run_keeps_journal_for_resume(self):
+        journal_path = os.path.join(self.base, 'journals', 'two.journal')
+        module_path = os.path.join(self.envpath, runner.DEFAULT_PUPPETENV_PREFIX + 'two', 'module')
+        shutil.move(module_path, module_path + '.moved')
+        with self.assertRaises(SystemExit):
+            self._run('--branch', 'two')
+        self.assertTrue(os.path.exists(journal_path))
+
+        shutil.move(module_path + '.moved', module_path)
+        self._run('--branch', 'two', '--resume')
+        self.assertFalse(os.path.exists(journal_path))
+        self.assertTrue(os.path.exists(os.path.join(self.base, 'out', 'two', 'config.yaml')))
+
+    def test_unwritable_journal_is_not_fatal(self):
+        blocker = os.path.join(self.base, 'blocker')
+        with open(blocker, 'w') as fh:
+            fh.write('not a directory')
+        sys.argv = ['maxhammer', '--puppetenvpath', self.envpath, '--no-hostgroup', '--no-yaml-cache',
+                    '--no-digest-cache', '--journal-dir', os.path.join(blocker, 'journals'), '--branch', 'one']
+        runner.Runner().run()
+        self.assertTrue(os.path.exists(os.path.join(self.base, 'out', 'one', 'config.yaml')))
+
+    def test_failed_branch_does_not_stop_others(self):
+        os.remove(os.path.join(self.envpath, runner.DEFAULT_PUPPETENV_PREFIX + 'two', 'module', 'config.yaml'))
+        os.rmdir(os.path.join(self.envpath, runner.DEFAULT_PUPPETENV_PREFIX + 'two', 'module'))
+        with self.assertRaises(SystemExit):
+            self._run('--branches', 'one,two,missing,three')
+        self.assertTrue(os.path.exists(os.path.join(self.base, 'out', 'one', 'config.yaml')))
+        self.assertTrue(os.path.exists(os.path.join(self.base, 'out', 'three', 'config.yaml')))
+        self.assertFalse(os.path.exists(os.path.join(self.base, 'out', 'two', 'config.yaml')))
+
+
+class TestPhases(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = runner.Runner()
+        self.runner.logger = logging.getLogger(__name__)
+        self.finished = []
+        self.started = {}
+
+    def _phase(self, name, fail=False, overlaps=None):
+        self.started[name] = threading.Event()
+
+        def phase():
+            self.started[name].set()
+            # only sees the other phase start while it's still running if the two overlap
+            overlapped = self.started[overlaps].wait(5) if overlaps else None
+            self.finished.append((name, overlapped))
+            if fail:
+                raise Exception("{} broke".format(name))
+        return (name, phase)
+
+    def test_phases_overlap_and_fail_independently(self):
+        failed = self.runner._run_phases([self._phase('hostgroup', fail=True, overlaps='distribution'),
+                                          self._phase('distribution', overlaps='hostgroup')])
+        self.assertEqual([overlapped for name, overlapped in self.finished], [True, True])
+        self.assertEqual(failed, ['hostgroup'])
+        self.assertEqual(sorted(name for name, finished in self.finished), ['distribution', 'hostgroup'])
+
+    def test_serial_phases_keep_their_order(self):
+        failed = self.runner._run_phases([self._phase('hostgroup'), self._phase('distribution', fail=True)],
+                                         serial=True)
+        self.assertEqual(failed, ['distribution'])
+        self.assertEqual([name for name, finished in self.finished], ['hostgroup', 'distribution'])
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_startup_stays_within_budget(self):
+        report = bench_startup.run(repeats=3)
+        # the strict time budget is left to the benchmark, as a loaded machine can't be held to it
+        self.assertEqual(bench_startup.over_budget(report, max_seconds=STARTUP_SECONDS), [])
+        self.assertEqual([result['case'] for result in report['results']],
+                         ['import', 'help', 'argument-error', 'no-phases'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import unittest
+import os
+import stat
+import shutil
+import subprocess
+import tempfile
+import time
+from maxhammer import sftp
+from sshstub import SSHStub, LoopbackSSHD
+
+
+def _make_tree(base, dirs=3, files_per_dir=5):
+    for d in range(dirs):
+        dirpath = os.path.join(base, 'dir{}'.format(d), 'sub')
+        os.makedirs(dirpath)
+        for f in range(files_per_dir):
+            filepath = os.path.join(dirpath, 'file{}'.format(f))
+            with open(filepath, 'wb') as fh:
+                fh.write(os.urandom(100 * (f + 1)))
+    script = os.path.join(base, 'run.sh')
+    with open(script, 'wb') as fh:
+        fh.write('#!/bin/sh\n')
+    os.chmod(script, 0755)
+
+
+class TreeAssertions(object):
+
+    def assertTreesEqual(self, left, right):
+        for root, dirs, files in os.walk(left):
+            rel = os.path.relpath(root, left)
+            for f in files:
+                lpath = os.path.join(root, f)
+                rpath = os.path.join(right, rel, f)
+                self.assertTrue(os.path.isfile(rpath), rpath)
+                with open(lpath, 'rb') as lf, open(rpath, 'rb') as rf:
+                    self.assertEqual(lf.read(), rf.read())
+                self.assertEqual(stat.S_IMODE(os.stat(lpath).st_mode), stat.S_IMODE(os.stat(rpath).st_mode))
+
+
+class TestSftpServer(unittest.TestCase, TreeAssertions):
+
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.remote_root = tempfile.mkdtemp()
+        _make_tree(self.local)
+        self.stub = SSHStub(self.remote_root).start()
+        self.server = sftp.Server('127.0.0.1', username='test', password='test', port=self.stub.port)
+
+    def tearDown(self):
+        self.server.close()
+        self.stub.stop()
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.remote_root)
+
+    def test_upload_parallel(self):
+        totals = self.server.upload_parallel(self.local, '/dest', channels=4)
+        self.assertEqual(totals['files'], 16)
+        self.assertTreesEqual(self.local, os.path.join(self.remote_root, 'dest'))
+
+    def test_upload_over_readonly_files(self):
+        self.server.upload_parallel(self.local, '/dest')
+        readonly = os.path.join(self.local, 'dir0', 'sub', 'file0')
+        os.chmod(readonly, 0444)
+        os.chmod(os.path.join(self.remote_root, 'dest', 'dir0', 'sub', 'file0'), 0444)
+        with open(os.path.join(self.local, 'dir1', 'sub', 'file1'), 'wb') as fh:
+            fh.write('changed')
+
+        self.server.upload_parallel(self.local, '/dest', channels=2)
+        self.assertTreesEqual(self.local, os.path.join(self.remote_root, 'dest'))
+
+    def test_upload_filtered(self):
+        exclude = [os.path.join(self.local, 'dir1')]
+        self.server.upload_filtered(self.local, '/dest', exclude_list=exclude)
+        self.assertTrue(os.path.isdir(os.path.join(self.remote_root, 'dest', 'dir0', 'sub')))
+        self.assertFalse(os.path.exists(os.path.join(self.remote_root, 'dest', 'dir1')))
+
+    def test_upload_all(self):
+        self.server.upload_all(self.local, '/dest')
+        self.assertTreesEqual(self.local, os.path.join(self.remote_root, 'dest', os.path.basename(self.local)))
+
+    def test_sftp_walk_returns_files(self):
+        self.server.upload_parallel(self.local, '/dest')
+        walked = {}
+        for path, dirs, files in self.server.sftp_walk('/dest', channels=3):
+            walked[path] = (sorted(dirs), sorted(files))
+        self.assertEqual(walked['/dest'], (['dir0', 'dir1', 'dir2'], ['run.sh']))
+        self.assertEqual(walked['/dest/dir2/sub'], ([], ['file{}'.format(f) for f in range(5)]))
+        self.assertEqual(len(walked), 7)
+
+    def test_sftp_walk_missing_path(self):
+        self.assertEqual(list(self.server.sftp_walk('/missing')), [])
+
+    def test_sftp_walk_raises_channel_failures(self):
+        self.server.upload_parallel(self.local, '/dest')
+
+        class DroppedChannel:
+            def __init__(self, sftp):
+                self.sftp = sftp
+
+            def listdir_attr(self, path):
+                if path != '/dest':
+                    raise EOFError("channel dropped")
+                return self.sftp.listdir_attr(path)
+
+        with self.assertRaises(EOFError):
+            list(self.server._walk_attr([DroppedChannel(self.server.sftp)] * 2, '/dest'))
+
+    def test_download_all(self):
+        self.server.upload_parallel(self.local, '/dest')
+        target = tempfile.mkdtemp()
+        try:
+            totals = self.server.download_all('/dest', target, channels=4)
+            self.assertEqual(totals['files'], 16)
+            self.assertTreesEqual(self.local, os.path.join(target, 'dest'))
+        finally:
+            shutil.rmtree(target)
+
+
+class TestSftpTarStream(unittest.TestCase, TreeAssertions):
+
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.remote = tempfile.mkdtemp()
+        _make_tree(self.local)
+        self.stub = SSHStub().start()
+        self.server = sftp.Server('127.0.0.1', username='test', password='test', port=self.stub.port)
+
+    def tearDown(self):
+        self.server.close()
+        self.stub.stop()
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.remote)
+
+    def test_upload_tar_swaps_tree(self):
+        dest = os.path.join(self.remote, 'dest')
+        os.makedirs(os.path.join(dest, 'stale'))
+
+        totals = self.server.upload_tar(self.local, dest)
+        self.assertEqual(totals['files'], 16)
+        self.assertFalse(os.path.exists(os.path.join(dest, 'stale')))
+        self.assertEqual(os.listdir(self.remote), ['dest'])
+        self.assertTreesEqual(self.local, dest)
+
+    def test_remote_exchange_swaps_paths(self):
+        first, second = os.path.join(self.remote, 'first'), os.path.join(self.remote, 'second')
+        os.makedirs(os.path.join(first, 'a'))
+        os.makedirs(os.path.join(second, 'b'))
+        if subprocess.call(['python', '-c', sftp.REMOTE_EXCHANGE, first, second]):
+            self.skipTest("renameat2 is not supported here")
+        self.assertEqual(os.listdir(first), ['b'])
+        self.assertEqual(os.listdir(second), ['a'])
+
+    def test_upload_tar_failure_raises(self):
+        blocker = os.path.join(self.remote, 'blocker')
+        with open(blocker, 'w') as fh:
+            fh.write('not a directory')
+        self.assertRaises(Exception, self.server.upload_tar, self.local, os.path.join(blocker, 'dest'))
+
+
+class TestShapedConnections(unittest.TestCase, TreeAssertions):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.local = os.path.join(self.base, 'local')
+        _make_tree(self.local)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_latency_and_bandwidth(self):
+        with SSHStub(latency=0.05, bandwidth=200000) as stub:
+            with sftp.Server('127.0.0.1', username='test', password='test', port=stub.port) as server:
+                start = time.time()
+                server.sftp.listdir(self.base)
+                # a request and its response each take the latency
+                self.assertTrue(time.time() - start >= 0.1)
+
+                with open(os.path.join(self.base, 'big'), 'wb') as fh:
+                    fh.write(os.urandom(100000))
+                start = time.time()
+                server.sftp.put(os.path.join(self.base, 'big'), os.path.join(self.base, 'copy'))
+                self.assertTrue(time.time() - start >= 0.5)
+
+                server.upload_parallel(self.local, os.path.join(self.base, 'remote'), channels=4)
+        self.assertTreesEqual(self.local, os.path.join(self.base, 'remote'))
+
+    def test_loopback_sshd(self):
+        if not LoopbackSSHD.available():
+            self.skipTest('sshd is unavailable')
+        with LoopbackSSHD(latency=0.01) as sshd:
+            output = subprocess.check_output([os.path.join(sshd.bin_dir, 'ssh'), '-i', sshd.client_key,
+                                              '-p', str(sshd.port), '{}@127.0.0.1'.format(sshd.user), 'echo ok'])
+        self.assertEqual(output.strip(), 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
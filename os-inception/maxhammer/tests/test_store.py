@@ -0,0 +1,86 @@
+import unittest
+import os
+import shutil
+import tempfile
+from maxhammer import processor, store
+
+
+class TestArtifactStore(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.store = store.ArtifactStore(os.path.join(self.base, 'store'))
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def _write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def test_identical_content_is_stored_once(self):
+        first = self.store.put_content('same', 0644)
+        second = self.store.put_content('same', 0644)
+        executable = self.store.put_content('same', 0755)
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, executable)
+
+        build = self.store.mkdtemp()
+        self.store.link(first, os.path.join(build, 'a'))
+        self.store.link(second, os.path.join(build, 'b'))
+        self.assertEqual(os.stat(os.path.join(build, 'a')).st_ino, os.stat(os.path.join(build, 'b')).st_ino)
+        self.assertEqual(os.stat(os.path.join(build, 'b')).st_mode & 0777, 0644)
+
+    def test_eviction_skips_linked_objects(self):
+        self.store.max_size = 10
+        in_use = self.store.put_content('x' * 8, 0644)
+        self.store.link(in_use, os.path.join(self.store.mkdtemp(), 'in-use'))
+        unused = self.store.put_content('y' * 8, 0644)
+
+        self.assertEqual(self.store.evict(), 8)
+        self.assertTrue(os.path.exists(self.store._object_path(in_use)))
+        self.assertFalse(os.path.exists(self.store._object_path(unused)))
+
+    def test_processor_reuses_renders_across_sources(self):
+        for source in ('branch1', 'branch2'):
+            self._write(os.path.join(self.base, source, 'plain.yaml'), 'name: {{ cloud.name }}\n')
+            self._write(os.path.join(self.base, source, 'wrapper.yaml'), '{% include "plain.yaml" %}')
+        clouddata = {'name': 'test'}
+
+        outputs = []
+        for source in ('branch1', 'branch2'):
+            output = self.store.mkdtemp()
+            proc = processor.Processor(os.path.join(self.base, source), store=self.store)
+            proc.run(clouddata, output)
+            outputs.append(output)
+
+        with open(os.path.join(outputs[1], 'plain.yaml')) as fh:
+            self.assertEqual(fh.read(), 'name: test')
+        self.assertEqual(os.stat(os.path.join(outputs[0], 'plain.yaml')).st_ino,
+                         os.stat(os.path.join(outputs[1], 'plain.yaml')).st_ino)
+        # templates pulling in other templates are rendered every time, but still stored once
+        self.assertEqual(len(self.store._index['renders']), 1)
+        self.assertEqual(os.stat(os.path.join(outputs[0], 'wrapper.yaml')).st_ino,
+                         os.stat(os.path.join(outputs[1], 'wrapper.yaml')).st_ino)
+
+    def test_processor_copies_with_the_umask_it_was_given(self):
+        source = os.path.join(self.base, 'branch')
+        self._write(os.path.join(source, '.mhignore'), '[processing]\nfilterlist = blob.bin\n')
+        self._write(os.path.join(source, 'blob.bin'), '{{ not a template')
+        output = self.store.mkdtemp()
+        proc = processor.Processor(source, store=self.store, umask=0027)
+
+        def umask(mask):
+            raise AssertionError("the umask is process-wide, so only read at startup")
+        original, os.umask = os.umask, umask
+        try:
+            proc.run({'name': 'test'}, output)
+        finally:
+            os.umask = original
+        self.assertEqual(os.stat(os.path.join(output, 'blob.bin')).st_mode & 0777, 0640)
+
+
+if __name__ == '__main__':
+    unittest.main()
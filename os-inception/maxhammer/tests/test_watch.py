@@ -0,0 +1,133 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import yaml
+from maxhammer import distribution, watch
+
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.tree = os.path.join(self.base, 'tree')
+        os.makedirs(os.path.join(self.tree, 'sub'))
+        self.single = os.path.join(self.base, 'single.yaml')
+        self._write(self.single, 'a: 1')
+        self.watcher = watch.Watcher([self.tree, self.single], debounce=0.2, poll_interval=0.1)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.base)
+
+    def _write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def _changes(self, change):
+        # a burst of changes spread over less than the debounce period is reported in one go
+        timer = threading.Timer(0.1, change)
+        timer.start()
+        try:
+            return self.watcher.wait(timeout=5)
+        finally:
+            timer.join()
+
+    def _check_changes(self):
+        def change():
+            self._write(os.path.join(self.tree, 'sub', 'file'), 'content')
+            self._write(os.path.join(self.tree, 'new', 'deeper', 'file'), 'content')
+            self._write(os.path.join(self.tree, 'file.swp'), 'scratch')
+            self._write(os.path.join(self.base, 'unwatched'), 'content')
+        changed = self._changes(change)
+        self.assertTrue(os.path.join(self.tree, 'sub', 'file') in changed)
+        self.assertTrue(os.path.join(self.tree, 'new', 'deeper', 'file') in changed)
+        self.assertFalse(os.path.join(self.tree, 'file.swp') in changed)
+        self.assertFalse(os.path.join(self.base, 'unwatched') in changed)
+
+        # the watched file is still seen after being replaced, the way editors save
+        def replace():
+            self._write(self.single + '.tmp', 'a: 2')
+            os.rename(self.single + '.tmp', self.single)
+            os.remove(os.path.join(self.tree, 'new', 'deeper', 'file'))
+        changed = self._changes(replace)
+        self.assertTrue(self.single in changed)
+        self.assertTrue(os.path.join(self.tree, 'new', 'deeper', 'file') in changed)
+
+        self.assertEqual(self.watcher.wait(timeout=0.3), [])
+
+    def test_inotify(self):
+        if self.watcher._fd is None:
+            self.skipTest('inotify is unavailable')
+        self._check_changes()
+
+    def test_polling(self):
+        self.watcher.close()
+        self.watcher._snapshot = self.watcher._scan()
+        self._check_changes()
+
+
+class TestRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.source_base = os.path.join(self.base, 'src')
+        self.module = os.path.join(self.source_base, 'module')
+        self._write(os.path.join(self.module, 'first.yaml'), 'name: {{ cloud.name }}')
+        self._write(os.path.join(self.module, 'second.yaml'), 'env: {{ cloud.environment }}')
+        self.local = os.path.join(self.base, 'local')
+
+        manifest = {'maxhammer': {'process_paths': {'module': {
+            'process_method': 'overcloud',
+            'sources': ['module'],
+            'local_destination': self.local}}}}
+        manifest_path = os.path.join(self.base, 'maxhammer.yaml')
+        with open(manifest_path, 'w') as fh:
+            yaml.safe_dump(manifest, fh)
+        clouddata = {'name': 'test', 'environment': 'test', 'maxhammer': {}}
+        self.dist = distribution.Distribution(manifest_path, clouddata_config=clouddata, source_base=self.source_base)
+
+    def tearDown(self):
+        self.dist.release()
+        self.dist.close()
+        shutil.rmtree(self.base)
+
+    def _write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def _read(self, path):
+        with open(path) as fh:
+            return fh.read()
+
+    def test_refresh_processes_only_changed_files(self):
+        self.assertEqual(self.dist.refresh(), 1)
+        self.assertEqual(self._read(os.path.join(self.local, 'first.yaml')), 'name: test')
+        proc_build_dir = self.dist._builds[('module', self.module)][0]
+
+        self.assertEqual(self.dist.refresh([os.path.join(self.base, 'elsewhere')]), 0)
+
+        self._write(os.path.join(self.module, 'first.yaml'), 'renamed: {{ cloud.name }}')
+        os.remove(os.path.join(self.module, 'second.yaml'))
+        self._write(os.path.join(self.module, 'third.yaml'), 'third')
+        self.assertEqual(self.dist.refresh([os.path.join(self.module, name)
+                                            for name in ('first.yaml', 'second.yaml', 'third.yaml')]), 1)
+        self.assertEqual(self._read(os.path.join(self.local, 'first.yaml')), 'renamed: test')
+        self.assertEqual(sorted(os.listdir(self.local)), ['first.yaml', 'third.yaml'])
+
+        self._write(os.path.join(self.module, 'third.yaml'), 'still third')
+        self._write(os.path.join(self.module, 'second.yaml'), 'env: {{ cloud.environment }}')
+        untouched = os.stat(os.path.join(proc_build_dir, 'first.yaml')).st_ino
+        self.dist.refresh([os.path.join(self.module, 'second.yaml')])
+        self.assertEqual(self._read(os.path.join(self.local, 'second.yaml')), 'env: test')
+        self.assertEqual(self._read(os.path.join(self.local, 'third.yaml')), 'third')
+        self.assertEqual(os.stat(os.path.join(proc_build_dir, 'first.yaml')).st_ino, untouched)
+
+
+if __name__ == '__main__':
+    unittest.main()
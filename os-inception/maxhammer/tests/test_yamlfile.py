@@ -0,0 +1,71 @@
+import unittest
+import os
+import shutil
+import tempfile
+from maxhammer import metrics, yamlfile
+
+
+class TestParsedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.document = os.path.join(self.base, 'clouddata.yaml')
+        self.cache_path = os.path.join(self.base, 'cache', 'parsed-yaml')
+        self._write('name: test\nnodes: [a, b]\n')
+        metrics.RUN.reset()
+
+    def tearDown(self):
+        metrics.RUN.reset()
+        shutil.rmtree(self.base)
+
+    def _write(self, content, mtime=None):
+        with open(self.document, 'w') as fh:
+            fh.write(content)
+        if mtime is not None:
+            os.utime(self.document, (mtime, mtime))
+
+    def _counter(self, name):
+        return sum(c['value'] for c in metrics.RUN.report()['counters'] if c['name'] == name)
+
+    def test_unchanged_files_are_not_parsed_again(self):
+        cache = yamlfile.ParsedCache(self.cache_path)
+        first = cache.load(self.document)
+        self.assertEqual(first, {'name': 'test', 'nodes': ['a', 'b']})
+        first['nodes'].append('c')
+        self.assertEqual(cache.load(self.document)['nodes'], ['a', 'b'])
+        self.assertEqual((self._counter('yaml_parsed'), self._counter('yaml_cached')), (1, 1))
+
+        # same size, different modification time
+        self._write('name: tost\nnodes: [a, b]\n', mtime=1000000000)
+        self.assertEqual(cache.load(self.document)['name'], 'tost')
+        self.assertEqual(self._counter('yaml_parsed'), 2)
+
+        # same size and modification time, as a checkout or a restore keeping times can leave it
+        self._write('name: tast\nnodes: [a, b]\n', mtime=1000000000)
+        self.assertEqual(cache.load(self.document)['name'], 'tast')
+        self.assertEqual(self._counter('yaml_parsed'), 3)
+
+    def test_cache_persists(self):
+        cache = yamlfile.ParsedCache(self.cache_path)
+        cache.load(self.document)
+        cache.save()
+        self.assertTrue(os.path.exists(self.cache_path))
+
+        self.assertEqual(yamlfile.ParsedCache(self.cache_path).load(self.document)['name'], 'test')
+        self.assertEqual((self._counter('yaml_parsed'), self._counter('yaml_cached')), (1, 1))
+
+        # an unreadable cache is ignored rather than failing the run
+        with open(self.cache_path, 'w') as fh:
+            fh.write('garbage')
+        self.assertEqual(yamlfile.ParsedCache(self.cache_path).load(self.document)['name'], 'test')
+        self.assertEqual(self._counter('yaml_parsed'), 2)
+
+    def test_memory_only(self):
+        cache = yamlfile.ParsedCache()
+        cache.load(self.document)
+        cache.save()
+        self.assertFalse(os.path.exists(os.path.dirname(self.cache_path)))
+
+
+if __name__ == '__main__':
+    unittest.main()